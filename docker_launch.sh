@@ -1,16 +1,37 @@
 #!/bin/bash
 
-echo "#### Update Subscribes ####"
+CONFIG=../config.yaml
+UPDATE_ARGS=(
+    --timeout 15000
+    --cache ../subscribe_cache
+    --template ../config.template.yaml
+    --output "$CONFIG"
+    --target-type clash
+    --geo-dir ..
+    -Dallow_lan:bool=true
+    -Denable_tun:bool=false
+)
 
-python3 ./scripts/main.py \
-    --timeout 15000 \
-    --cache ../subscribe_cache \
-    --template ../config.template.yaml \
-    --target-type clash \
-    -Dallow_lan:bool=true \
-    -Denable_tun:bool=false \
-    ./subscribe.json
+if [ ! -f "$CONFIG" ]; then
+    echo "#### Render from Cache ####"
+    python3 ./scripts/main.py "${UPDATE_ARGS[@]}" --no-update ./subscribe.json
+fi
+
+if [ ! -f "$CONFIG" ]; then
+    # first start, nothing cached yet: the core has to wait for the downloads
+    echo "#### Update Subscribes ####"
+    python3 ./scripts/main.py "${UPDATE_ARGS[@]}" ./subscribe.json
+    echo "#### Launch Clash ####"
+    exec clash.meta -d ../
+fi
 
 echo "#### Launch Clash ####"
+clash.meta -d ../ &
+CORE_PID=$!
+trap 'kill -TERM $CORE_PID; wait $CORE_PID' TERM INT
+
+echo "#### Update Subscribes in Background ####"
+# the new config is swapped in atomically and applied through the controller, then warmed up
+python3 ./scripts/main.py "${UPDATE_ARGS[@]}" --reload --warmup ./subscribe.json &
 
-clash.meta -d ../
+wait $CORE_PID
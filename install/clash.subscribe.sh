@@ -11,6 +11,7 @@ fi
     --template %clash_dir%/config.template.yaml \
     --output %clash_dir%/config.yaml \
     --target-type clash \
+    --geo-dir %clash_dir% \
     $ARG_NO_UPDATE \
     -Dallow_lan:bool=true \
     %clash_dir%/subscribe.json
\ No newline at end of file
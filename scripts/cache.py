@@ -0,0 +1,514 @@
+import hashlib
+import lzma
+import sqlite3
+import zlib
+from io import BufferedReader, RawIOBase
+from os import fdopen, listdir, makedirs, path, remove, replace
+from tempfile import mkstemp
+from time import time
+from typing import BinaryIO, Collection, Dict, List, Optional, Tuple
+
+CODEC_ZLIB = 'zlib'
+CODEC_LZMA = 'lzma'
+CODECS = (CODEC_ZLIB, CODEC_LZMA)
+
+BLOB_CHUNK_SIZE = 64 * 1024
+TMP_FILE_MAX_AGE = 3600
+MIRROR_BACKOFF_BASE = 60.0
+MIRROR_BACKOFF_MAX = 6 * 3600.0
+# reads only move `last_used` forward by at least this much, so most of them do not write
+LAST_USED_GRANULARITY = 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    codec TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT NOT NULL,
+    created REAL NOT NULL,
+    type TEXT NOT NULL,
+    hash TEXT NOT NULL REFERENCES blobs(hash),
+    PRIMARY KEY (name, created)
+);
+CREATE INDEX IF NOT EXISTS versions_hash ON versions(hash);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    name TEXT PRIMARY KEY,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mirrors (
+    url TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    retry_after REAL NOT NULL,
+    latency REAL
+);
+CREATE TABLE IF NOT EXISTS fetches (
+    name TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    status INTEGER NOT NULL,
+    encoding TEXT NOT NULL,
+    wire_bytes INTEGER NOT NULL,
+    body_bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS validators (
+    name TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT
+);
+"""
+
+
+def _compressor(codec: str):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(9)
+    elif codec == CODEC_LZMA:
+        return lzma.LZMACompressor()
+    raise ValueError(f'unknown cache codec: {codec}')
+
+
+def _decompressor(codec: str):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    raise ValueError(f'unknown cache codec: {codec}')
+
+
+class CacheEntry(object):
+
+    name: str
+    type: str
+    hash: str
+    created: float
+    codec: str
+    size: int
+    stored_size: int
+
+    def __init__(self, name: str, type: str, hash: str, created: float, codec: str, size: int, stored_size: int):
+        self.name = name
+        self.type = type
+        self.hash = hash
+        self.created = created
+        self.codec = codec
+        self.size = size
+        self.stored_size = stored_size
+
+    def __repr__(self) -> str:
+        return f'CacheEntry(name={self.name}, type={self.type}, hash={self.hash[:12]}, size={self.size}, stored_size={self.stored_size})'
+
+
+class GcReport(object):
+
+    removed_subscriptions: List[str]
+    removed_versions: int
+    removed_blobs: int
+    removed_files: int
+    freed_bytes: int
+    total_bytes: int
+
+    def __init__(self):
+        self.removed_subscriptions = []
+        self.removed_versions = 0
+        self.removed_blobs = 0
+        self.removed_files = 0
+        self.freed_bytes = 0
+        self.total_bytes = 0
+
+    def __repr__(self) -> str:
+        return (f'GcReport(removed_subscriptions={self.removed_subscriptions}, removed_versions={self.removed_versions}, '
+                f'removed_blobs={self.removed_blobs}, removed_files={self.removed_files}, freed_bytes={self.freed_bytes}, total_bytes={self.total_bytes})')
+
+
+class _BlobReader(RawIOBase):
+    """
+    Decompress a blob file on the fly and verify its hash once the end is reached.
+    """
+
+    def __init__(self, filepath: str, codec: str, expected_hash: str):
+        self._file = open(filepath, 'rb')
+        self._decompressor = _decompressor(codec)
+        self._hash = hashlib.sha256()
+        self._expected_hash = expected_hash
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer and not self._eof:
+            data = self._file.read(BLOB_CHUNK_SIZE)
+            if data:
+                self._buffer = self._decompressor.decompress(data)
+                self._hash.update(self._buffer)
+            else:
+                self._eof = True
+                flush = getattr(self._decompressor, 'flush', None)
+                if flush is not None:
+                    self._buffer = flush()
+                    self._hash.update(self._buffer)
+                if self._hash.hexdigest() != self._expected_hash:
+                    raise ValueError(f'cache blob {self._expected_hash} is corrupted')
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+class CacheWriter(object):
+    """
+    Write-only sink handed to `ISubscribeReader.read` as `ofile_cache`.
+    Content is hashed and compressed into a temporary file, and only becomes visible in the store on `commit`.
+    """
+
+    _store: 'CacheStore'
+    name: str
+    type: str
+    _codec: str
+
+    def __init__(self, store: 'CacheStore', name: str, type: str, codec: str):
+        self._store = store
+        self.name = name
+        self.type = type
+        self._codec = codec
+        self._compressor = _compressor(codec)
+        self._hash = hashlib.sha256()
+        self._size = 0
+        fd, self._tmp_path = mkstemp(dir=store.tmp_dir, suffix='.part')
+        self._file = fdopen(fd, 'wb')
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self._size += len(data)
+        self._file.write(self._compressor.compress(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def commit(self) -> CacheEntry:
+        self._file.write(self._compressor.flush())
+        self._file.close()
+        stored_size = path.getsize(self._tmp_path)
+        return self._store._commit(self, self._tmp_path, self._hash.hexdigest(), self._codec, self._size, stored_size)
+
+    def abort(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+        if path.exists(self._tmp_path):
+            remove(self._tmp_path)
+
+    def __enter__(self) -> 'CacheWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.abort()
+
+
+class CacheStore(object):
+    """
+    Content-addressed subscription cache.
+
+    Payloads are stored once per content hash as compressed blobs under `blobs/`, and `cache.db` (sqlite)
+    keeps the last `keep_versions` versions of every subscription.
+    """
+
+    root: str
+    blob_dir: str
+    tmp_dir: str
+    codec: str
+    keep_versions: int
+    _db: sqlite3.Connection
+
+    def __init__(self, root: str, codec: str = CODEC_ZLIB, keep_versions: int = 3, threaded: bool = False):
+        if codec not in CODECS:
+            raise ValueError(f'unknown cache codec: {codec}')
+        if keep_versions < 1:
+            raise ValueError('keep_versions should be at least 1')
+        self.root = root
+        self.blob_dir = path.join(root, 'blobs')
+        self.tmp_dir = path.join(root, 'tmp')
+        self.codec = codec
+        self.keep_versions = keep_versions
+        makedirs(self.blob_dir, exist_ok=True)
+        makedirs(self.tmp_dir, exist_ok=True)
+        # with `threaded`, the connection may be used from several threads; the caller serializes the calls
+        self._db = sqlite3.connect(path.join(root, 'cache.db'), check_same_thread=not threaded)
+        self._db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> 'CacheStore':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def blob_path(self, hash: str) -> str:
+        return path.join(self.blob_dir, hash[:2], hash)
+
+    def latest(self, name: str) -> Optional[CacheEntry]:
+        row = self._db.execute(
+            'SELECT v.name, v.type, v.hash, v.created, b.codec, b.size, b.stored_size '
+            'FROM versions v JOIN blobs b ON b.hash = v.hash '
+            'WHERE v.name = ? ORDER BY v.created DESC LIMIT 1',
+            (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(*row)
+
+    def history(self, name: str) -> List[CacheEntry]:
+        rows = self._db.execute(
+            'SELECT v.name, v.type, v.hash, v.created, b.codec, b.size, b.stored_size '
+            'FROM versions v JOIN blobs b ON b.hash = v.hash '
+            'WHERE v.name = ? ORDER BY v.created DESC',
+            (name,)
+        ).fetchall()
+        return [CacheEntry(*row) for row in rows]
+
+    def open(self, name: str, type: str) -> Optional[BinaryIO]:
+        entry = self.latest(name)
+        if entry is None:
+            return None
+        if entry.type != type:
+            raise ValueError(f'cache of {name} is of type {entry.type}, expect {type}')
+        now = time()
+        row = self._db.execute('SELECT last_used FROM subscriptions WHERE name = ?', (name,)).fetchone()
+        if row is None or now - row[0] >= LAST_USED_GRANULARITY:
+            self.touch(name, now)
+        return BufferedReader(_BlobReader(self.blob_path(entry.hash), entry.codec, entry.hash), BLOB_CHUNK_SIZE)
+
+    def touch(self, name: str, when: Optional[float] = None) -> None:
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO subscriptions (name, last_used) VALUES (?, ?)',
+                (name, time() if when is None else when)
+            )
+
+    def record_fetch(self, name: str, status: int, encoding: str, wire_bytes: int, body_bytes: int) -> None:
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO fetches (name, fetched, status, encoding, wire_bytes, body_bytes) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, time(), status, encoding, wire_bytes, body_bytes)
+            )
+
+    def validators(self, name: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        `ETag` and `Last-Modified` of the latest version of `name`, for a conditional request.
+        """
+        row = self._db.execute('SELECT etag, last_modified FROM validators WHERE name = ?', (name,)).fetchone()
+        return (row[0], row[1]) if row is not None else (None, None)
+
+    def record_validators(self, name: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO validators (name, etag, last_modified) VALUES (?, ?, ?)',
+                (name, etag, last_modified)
+            )
+
+    def names(self, type: str) -> List[str]:
+        return [name for (name,) in self._db.execute('SELECT DISTINCT name FROM versions WHERE type = ?', (type,))]
+
+    def order_mirrors(self, urls: List[str]) -> List[str]:
+        """
+        Keep the configured order but move mirrors in backoff to the end, soonest retry first.
+        """
+        now = time()
+        healthy = []
+        backoff = []
+        for url in urls:
+            row = self._db.execute('SELECT retry_after FROM mirrors WHERE url = ?', (url,)).fetchone()
+            if row is None or row[0] <= now:
+                healthy.append(url)
+            else:
+                backoff.append((row[0], url))
+        backoff.sort()
+        return healthy + [url for _, url in backoff]
+
+    def record_mirror(self, url: str, ok: bool, latency: float) -> None:
+        with self._db:
+            if ok:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO mirrors (url, failures, retry_after, latency) VALUES (?, 0, 0, ?)',
+                    (url, latency)
+                )
+                return
+            row = self._db.execute('SELECT failures FROM mirrors WHERE url = ?', (url,)).fetchone()
+            failures = (row[0] if row is not None else 0) + 1
+            delay = min(MIRROR_BACKOFF_BASE * 2 ** (failures - 1), MIRROR_BACKOFF_MAX)
+            self._db.execute(
+                'INSERT INTO mirrors (url, failures, retry_after, latency) VALUES (?, ?, ?, NULL) '
+                'ON CONFLICT(url) DO UPDATE SET failures = excluded.failures, retry_after = excluded.retry_after',
+                (url, failures, time() + delay)
+            )
+
+    def total_bytes(self) -> int:
+        (total,) = self._db.execute('SELECT COALESCE(SUM(stored_size), 0) FROM blobs').fetchone()
+        return total
+
+    def gc(self, max_bytes: Optional[int] = None, max_age: Optional[float] = None, keep_names: Optional[Collection[str]] = None) -> GcReport:
+        """
+        Apply the retention policy:
+        - subscriptions not in `keep_names` (when given) are removed;
+        - subscriptions unused for more than `max_age` seconds are removed, as are older versions past that age;
+        - versions are evicted in LRU order until the blobs fit in `max_bytes`;
+        - files under `blobs/` unknown to the index and stale files under `tmp/` are removed.
+        """
+        report = GcReport()
+        before = self.total_bytes()
+        now = time()
+        last_used: Dict[str, float] = dict(self._db.execute('SELECT name, last_used FROM subscriptions'))
+        # (name, created, hash) ordered from newest to oldest per subscription
+        versions: Dict[str, List[Tuple[float, str]]] = {}
+        for name, created, hash in self._db.execute('SELECT name, created, hash FROM versions ORDER BY name, created DESC'):
+            versions.setdefault(name, []).append((created, hash))
+        evict: List[Tuple[str, float]] = []
+        for name, items in versions.items():
+            used = last_used.get(name, items[0][0])
+            if (keep_names is not None and name not in keep_names) or (max_age is not None and now - used > max_age):
+                evict.extend((name, created) for created, _ in items)
+                report.removed_subscriptions.append(name)
+            elif max_age is not None:
+                evict.extend((name, created) for created, _ in items[1:] if now - created > max_age)
+        self._delete_versions(evict)
+        report.removed_versions += len(evict)
+        if max_bytes is not None:
+            report.removed_versions += self._evict_lru(max_bytes, last_used, report)
+        with self._db:
+            for name in report.removed_subscriptions:
+                self._db.execute('DELETE FROM subscriptions WHERE name = ?', (name,))
+                self._db.execute('DELETE FROM fetches WHERE name = ?', (name,))
+                self._db.execute('DELETE FROM validators WHERE name = ?', (name,))
+        report.removed_blobs = self._remove_orphan_blobs()
+        report.removed_files = self._remove_stray_files()
+        report.total_bytes = self.total_bytes()
+        report.freed_bytes = before - report.total_bytes
+        return report
+
+    def _evict_lru(self, max_bytes: int, last_used: Dict[str, float], report: GcReport) -> int:
+        rows = self._db.execute(
+            'SELECT v.name, v.created, v.hash, b.stored_size FROM versions v JOIN blobs b ON b.hash = v.hash'
+        ).fetchall()
+        refs: Dict[str, int] = {}
+        sizes: Dict[str, int] = {}
+        latest: Dict[str, float] = {}
+        for name, created, hash, stored_size in rows:
+            refs[hash] = refs.get(hash, 0) + 1
+            sizes[hash] = stored_size
+            latest[name] = max(latest.get(name, created), created)
+        total = sum(sizes.values())
+        if total <= max_bytes:
+            return 0
+        # older versions go first, then whole subscriptions, least recently used first
+        rows.sort(key=lambda r: (r[1] == latest[r[0]], last_used.get(r[0], latest[r[0]]), r[1]))
+        evict: List[Tuple[str, float]] = []
+        for name, created, hash, _ in rows:
+            if total <= max_bytes:
+                break
+            evict.append((name, created))
+            refs[hash] -= 1
+            if refs[hash] == 0:
+                total -= sizes[hash]
+            if created == latest[name]:
+                report.removed_subscriptions.append(name)
+        self._delete_versions(evict)
+        return len(evict)
+
+    def _delete_versions(self, versions: List[Tuple[str, float]]) -> None:
+        with self._db:
+            self._db.executemany('DELETE FROM versions WHERE name = ? AND created = ?', versions)
+
+    def _remove_stray_files(self) -> int:
+        known = set(hash for (hash,) in self._db.execute('SELECT hash FROM blobs'))
+        count = 0
+        for prefix in listdir(self.blob_dir):
+            prefix_dir = path.join(self.blob_dir, prefix)
+            if not path.isdir(prefix_dir):
+                continue
+            for filename in listdir(prefix_dir):
+                if filename not in known:
+                    remove(path.join(prefix_dir, filename))
+                    count += 1
+        # leftovers of interrupted writes; recent ones may still be in progress
+        now = time()
+        for filename in listdir(self.tmp_dir):
+            filepath = path.join(self.tmp_dir, filename)
+            if now - path.getmtime(filepath) > TMP_FILE_MAX_AGE:
+                remove(filepath)
+                count += 1
+        return count
+
+    def writer(self, name: str, type: str) -> CacheWriter:
+        return CacheWriter(self, name, type, self.codec)
+
+    def put_file(self, name: str, type: str, filepath: str) -> CacheEntry:
+        with open(filepath, 'rb') as ifile, self.writer(name, type) as w:
+            while True:
+                data = ifile.read(BLOB_CHUNK_SIZE)
+                if not data:
+                    break
+                w.write(data)
+            return w.commit()
+
+    def import_legacy(self, index: Dict[str, str], types: Dict[str, str]) -> int:
+        """
+        Import the `cache.json` index of the old file-per-subscription cache and remove the imported files.
+        """
+        count = 0
+        for name, filepath in index.items():
+            type = types.get(name)
+            if type is None or self.latest(name) is not None or not path.isfile(filepath):
+                continue
+            self.put_file(name, type, filepath)
+            remove(filepath)
+            count += 1
+        return count
+
+    def _commit(self, w: CacheWriter, tmp_path: str, hash: str, codec: str, size: int, stored_size: int) -> CacheEntry:
+        blob_path = self.blob_path(hash)
+        known = self._db.execute('SELECT codec, stored_size FROM blobs WHERE hash = ?', (hash,)).fetchone()
+        if known is not None and path.exists(blob_path):
+            remove(tmp_path)
+            codec, stored_size = known
+        else:
+            makedirs(path.dirname(blob_path), exist_ok=True)
+            replace(tmp_path, blob_path)
+        created = time()
+        self.touch(w.name, created)
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO blobs (hash, codec, size, stored_size) VALUES (?, ?, ?, ?)',
+                (hash, codec, size, stored_size)
+            )
+            self._db.execute('DELETE FROM versions WHERE name = ? AND hash = ?', (w.name, hash))
+            self._db.execute(
+                'INSERT INTO versions (name, created, type, hash) VALUES (?, ?, ?, ?)',
+                (w.name, created, w.type, hash)
+            )
+            self._db.execute(
+                'DELETE FROM versions WHERE name = ? AND created NOT IN '
+                '(SELECT created FROM versions WHERE name = ? ORDER BY created DESC LIMIT ?)',
+                (w.name, w.name, self.keep_versions)
+            )
+        self._remove_orphan_blobs()
+        return CacheEntry(w.name, w.type, hash, created, codec, size, stored_size)
+
+    def _remove_orphan_blobs(self) -> int:
+        rows = self._db.execute('SELECT hash FROM blobs WHERE hash NOT IN (SELECT hash FROM versions)').fetchall()
+        with self._db:
+            for (hash,) in rows:
+                self._db.execute('DELETE FROM blobs WHERE hash = ?', (hash,))
+        for (hash,) in rows:
+            blob_path = self.blob_path(hash)
+            if path.exists(blob_path):
+                remove(blob_path)
+        return len(rows)
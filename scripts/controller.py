@@ -0,0 +1,250 @@
+import http.client
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+from yaml import load as yaml_load
+
+# top level keys of a clash config; read line by line so that a large config is not parsed for two values
+_TOP_LEVEL_KEY = re.compile(r'^("?)(external-controller|secret)\1\s*:(.*)$')
+
+# group types, as reported by the controller
+SELECTOR_TYPE = 'Selector'
+TESTED_GROUP_TYPES = ('URLTest', 'Fallback', 'LoadBalance')
+
+
+class ControllerError(Exception):
+
+    status: int
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f'{status} {message}')
+        self.status = status
+
+
+class Controller(object):
+    """
+    Client of the RESTful api of the core (`external-controller`). Requests go straight to the controller,
+    never through the proxy settings of the environment, which may point to the core itself. Connections are
+    kept alive and shared by the threads issuing requests.
+    """
+
+    url: str
+    secret: str
+    timeout: float
+    max_idle: int
+
+    def __init__(self, url: str, secret: str = '', timeout: float = 5.0, max_idle: int = 8):
+        if '://' not in url:
+            url = f'http://{url}'
+        self.url = url.rstrip('/')
+        self.secret = secret
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, filename: str) -> Optional['Controller']:
+        """
+        The controller of a generated clash config, or None when it has no `external-controller`.
+        """
+        values = {}
+        with open(filename, 'r', encoding='utf-8') as ifile:
+            for line in ifile:
+                m = _TOP_LEVEL_KEY.match(line)
+                if m is not None:
+                    values[m.group(2)] = yaml_load(m.group(3), Loader=SafeLoader)
+        address = values.get('external-controller')
+        if not address:
+            return None
+        host, _, port = str(address).rpartition(':')
+        # listening on every interface; the core is reachable locally
+        if host in ('', '0.0.0.0', '[::]', '::'):
+            host = '127.0.0.1'
+        secret = values.get('secret')
+        return cls(f'http://{host}:{port}', '' if secret is None else str(secret))
+
+    def _connect(self, timeout: float) -> http.client.HTTPConnection:
+        parts = urlsplit(self.url)
+        if parts.scheme == 'https':
+            return http.client.HTTPSConnection(parts.hostname, parts.port, timeout=timeout)
+        return http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+    def _acquire(self, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            return self._connect(timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method: str, path: str, body: Any = None, timeout: Optional[float] = None) -> Any:
+        headers = {'Accept': 'application/json'}
+        if self.secret:
+            headers['Authorization'] = f'Bearer {self.secret}'
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        target = urlsplit(self.url).path + path
+        conn, reused = self._acquire(timeout or self.timeout)
+        try:
+            try:
+                conn.request(method, target, body=data, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # the controller closed the idle connection; once more on a fresh one
+                conn = self._connect(timeout or self.timeout)
+                conn.request(method, target, body=data, headers=headers)
+                resp = conn.getresponse()
+            content = resp.read()
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        if resp.status >= 400:
+            message = content.decode('utf-8', errors='replace')
+            try:
+                message = json.loads(message).get('message', message)
+            except (ValueError, AttributeError):
+                pass
+            raise ControllerError(resp.status, message)
+        if not content:
+            return None
+        return json.loads(content)
+
+    def version(self) -> str:
+        return self.request('GET', '/version').get('version', '')
+
+    def wait_ready(self, timeout: float) -> str:
+        """
+        Wait for the controller to answer, e.g. right after the core was started; returns the version of the core.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                return self.version()
+            except (OSError, http.client.HTTPException) as e:
+                if monotonic() >= deadline:
+                    raise e
+            sleep(0.2)
+
+    def reload(self, config_path: str) -> None:
+        """
+        Load the config file again, without restarting the core; `force` applies the listener settings too.
+        """
+        self.request('PUT', '/configs?force=true', {'path': config_path, 'payload': ''})
+
+    def proxies(self) -> Dict[str, Dict]:
+        """
+        Every proxy and group of the running config by name, with `type`, and `now`/`all` for groups.
+        """
+        return self.request('GET', '/proxies').get('proxies', {})
+
+    def selections(self) -> Dict[str, str]:
+        """
+        Current choice of every select group.
+        """
+        return {name: p['now'] for name, p in self.proxies().items() if p.get('type') == SELECTOR_TYPE and p.get('now')}
+
+    def select(self, group: str, name: str) -> None:
+        self.request('PUT', f'/proxies/{quote(group, safe="")}', {'name': name})
+
+    def group_delay(self, group: str, url: str, timeout: int) -> Dict[str, int]:
+        """
+        Test the delay of every member of the group (`timeout` in ms); the core picks the best one of a url-test
+        group right away instead of at its next interval. Returns the delay of the members that answered.
+        """
+        query = urlencode({'url': url, 'timeout': timeout})
+        return self.request('GET', f'/group/{quote(group, safe="")}/delay?{query}', timeout=timeout / 1000 + self.timeout) or {}
+
+
+class WarmupReport(object):
+
+    restored: List[Tuple[str, str, str]]  # (group, previous choice, restored choice)
+    lost: List[Tuple[str, str]]  # (group, previous choice) that could not be mapped to the new config
+    delays: Dict[str, Dict[str, int]]  # group -> member -> ms
+    failed: Dict[str, str]  # group -> error
+
+    def __init__(self):
+        self.restored = []
+        self.lost = []
+        self.delays = {}
+        self.failed = {}
+
+
+def restore_selections(controller: Controller, previous: Dict[str, str], resolve: Callable[[str], Optional[str]], report: WarmupReport) -> None:
+    """
+    Select again, after a reload, what was selected before it; `resolve` maps a name of the previous config
+    to its name in the new one, or None when it is gone.
+    """
+    current = controller.proxies()
+    done = set()
+    # groups still there under the same name first, they take precedence over renamed ones mapped to the same group
+    for group, choice in sorted(previous.items(), key=lambda item: item[0] not in current):
+        new_group = group if group in current else resolve(group)
+        if new_group in done:
+            continue
+        state = current.get(new_group) if new_group is not None else None
+        members = state.get('all', ()) if state is not None else ()
+        new_choice = choice if choice in members else resolve(choice)
+        if state is None or state.get('type') != SELECTOR_TYPE or new_choice not in members:
+            report.lost.append((group, choice))
+            continue
+        done.add(new_group)
+        if state.get('now') != new_choice:
+            controller.select(new_group, new_choice)
+        report.restored.append((new_group, choice, new_choice))
+
+
+def test_group_delays(controller: Controller, url: str, timeout: int, concurrency: int, report: WarmupReport) -> None:
+    """
+    Run the delay tests of every url-test, fallback and load-balance group at once, at most `concurrency` at a time.
+    """
+    groups = [name for name, p in controller.proxies().items() if p.get('type') in TESTED_GROUP_TYPES]
+    if not groups:
+        return
+
+    def run(group: str) -> Tuple[str, Any]:
+        try:
+            return group, controller.group_delay(group, url, timeout)
+        except (OSError, http.client.HTTPException, ControllerError) as e:
+            return group, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(groups)))) as executor:
+        for group, result in executor.map(run, groups):
+            if isinstance(result, Exception):
+                report.failed[group] = str(result) or type(result).__name__
+            else:
+                report.delays[group] = result
@@ -1,30 +1,217 @@
+import hashlib
+import re
 from abc import ABC, abstractmethod
 from enum import Enum
+from functools import lru_cache
+from operator import attrgetter
+from sys import intern as sys_intern
+from weakref import WeakValueDictionary
 from io import BufferedIOBase
-from typing import BinaryIO, Callable, Dict, List, Optional, Set, Tuple
+from typing import Any, BinaryIO, Callable, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
 
+from diagnostics import MISSING_SUB_RULE, collector
 
-class Proxy(object):
 
-    inner: dict
+# keys of a proxy that only tune the local socket; `udp` and `dialer-proxy` change what the proxy can carry and the way out
+FINGERPRINT_IGNORED_KEYS = frozenset(('name', 'tfo', 'mptcp', 'interface-name', 'routing-mark', 'ip-version'))
 
-    def __init__(self, inner: Dict):
-        self.inner = inner
 
-    @property
-    def name(self) -> str:
-        return self.inner['name']
-    
-    @name.setter
-    def name(self, name: str):
-        self.inner['name'] = name
+def _canonical(value):
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v) for v in value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+# attribute of a proxy -> clash key, where the key is not the attribute with '-' for '_'
+PROXY_KEYS: Dict[str, str] = {'alter_id': 'alterId'}
+
+
+class Proxy(object):
+    """
+    A proxy, typed by protocol: the settings known for the protocol are slots of a subclass, built once by `parse`,
+    and anything else passes through in `extras`. Writers read the attributes; `to_clash` gives the clash mapping back.
+    """
+
+    __slots__ = ('name', 'server', 'port', 'udp', 'extras', '_fingerprint')
+
+    type: str
+    name: str
+    server: Optional[str]
+    port: Optional[int]
+    udp: Optional[bool]
+    extras: Optional[Dict[str, Any]]  # settings without a slot, in the clash form
+
+    ATTRS: Tuple[str, ...] = ('name', 'type', 'server', 'port', 'udp')  # emitted in this order
+    INTERNED: FrozenSet[str] = frozenset()  # attributes whose values repeat across proxies
+    _slots: Tuple[str, ...] = ('name', 'server', 'port', 'udp')  # attributes held in slots
+    _keys: Tuple[str, ...]
+    _getter: Callable[['Proxy'], Tuple]
+    _fields: Dict[str, str]  # clash key -> attribute
+
+    def __init_subclass__(cls, **kwargs):
+        # the emitter of a protocol is prepared once: its keys and a getter of every attribute at once
+        super().__init_subclass__(**kwargs)
+        own = cls.__dict__.get('__slots__', ())
+        # the settings of the protocol come before the inherited transport settings
+        base = len(Proxy.ATTRS)
+        cls.ATTRS = cls.ATTRS[:base] + tuple(a for a in own if a not in cls.ATTRS) + cls.ATTRS[base:]
+        cls._slots = cls._slots + own
+        cls._keys = tuple(PROXY_KEYS.get(a, a.replace('_', '-')) for a in cls.ATTRS)
+        cls._getter = attrgetter(*cls.ATTRS)
+        cls._fields = {k: a for k, a in zip(cls._keys, cls.ATTRS) if a in cls._slots}
+
+    @staticmethod
+    def parse(inner: Dict) -> 'Proxy':
+        """
+        The typed proxy of a clash proxy mapping.
+        """
+        cls = PROXY_TYPES.get(inner['type'], GenericProxy)
+        proxy = cls.__new__(cls)
+        for attr in cls._slots:
+            setattr(proxy, attr, None)
+        proxy._fingerprint = None
+        fields = cls._fields
+        interned = cls.INTERNED
+        extras = None
+        for key, value in inner.items():
+            attr = fields.get(key)
+            if attr is not None:
+                if attr in interned and isinstance(value, str):
+                    value = sys_intern(value)
+                setattr(proxy, attr, value)
+            elif key != 'type':
+                if extras is None:
+                    extras = {}
+                extras[sys_intern(str(key))] = value
+        proxy.extras = extras
+        if proxy.name is None:
+            raise KeyError('name')
+        if isinstance(proxy.port, str) and proxy.port.isdigit():
+            proxy.port = int(proxy.port)
+        return proxy
+
+    def to_clash(self) -> Dict[str, Any]:
+        result = {k: v for k, v in zip(self._keys, self._getter(self)) if v is not None}
+        if self.extras:
+            result.update(self.extras)
+        return result
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        A setting by its clash key.
+        """
+        attr = self._fields.get(key)
+        if attr is not None:
+            value = getattr(self, attr)
+            return default if value is None else value
+        if key == 'type':
+            return self.type
+        if self.extras:
+            return self.extras.get(key, default)
+        return default
+
+    def tls_server_name(self) -> Optional[str]:
+        """
+        Server name of the tls handshake, or None when the proxy does not connect over tls.
+        """
+        if self.get('tls'):
+            return self.get('servername') or self.get('sni') or self.server
+        return None
 
     @property
-    def type(self) -> str:
-        return self.inner['type']
+    def fingerprint(self) -> bytes:
+        """
+        Digest of the endpoint (type, server, port, credentials, transport options, udp, dialer-proxy), whatever the name.
+        """
+        if self._fingerprint is None:
+            items = {k: v for k, v in self.to_clash().items() if k not in FINGERPRINT_IGNORED_KEYS}
+            if 'server' in items:
+                items['server'] = str(items['server']).strip().rstrip('.').lower()
+            if 'port' in items and str(items['port']).isdigit():
+                items['port'] = int(items['port'])
+            # off unless enabled
+            items['udp'] = bool(items.get('udp'))
+            items['type'] = str(self.type).lower()
+            self._fingerprint = hashlib.blake2b(repr(_canonical(items)).encode('utf-8'), digest_size=16).digest()
+        return self._fingerprint
 
     def __repr__(self) -> str:
-        return self.inner.__repr__()
+        return self.to_clash().__repr__()
+
+
+class GenericProxy(Proxy):
+    # a protocol without its own class; every other setting is in `extras`
+    __slots__ = ('type',)
+
+
+class ShadowsocksProxy(Proxy):
+    __slots__ = ('cipher', 'password', 'plugin', 'plugin_opts')
+    type = 'ss'
+    INTERNED = frozenset(('cipher', 'plugin'))
+
+
+class _TlsProxy(Proxy):
+    __slots__ = ('tls', 'servername', 'sni', 'skip_cert_verify', 'alpn', 'client_fingerprint', 'network',
+                 'ws_opts', 'http_opts', 'h2_opts', 'grpc_opts', 'reality_opts')
+    INTERNED = frozenset(('network', 'client_fingerprint'))
+
+
+class VmessProxy(_TlsProxy):
+    __slots__ = ('uuid', 'alter_id', 'cipher')
+    type = 'vmess'
+    INTERNED = _TlsProxy.INTERNED | {'cipher'}
+
+
+class VlessProxy(_TlsProxy):
+    __slots__ = ('uuid', 'flow')
+    type = 'vless'
+    INTERNED = _TlsProxy.INTERNED | {'flow'}
+
+
+class TrojanProxy(_TlsProxy):
+    __slots__ = ('password',)
+    type = 'trojan'
+
+    def tls_server_name(self) -> Optional[str]:
+        # always over tls
+        return self.sni or self.server
+
+
+class Hysteria2Proxy(Proxy):
+    __slots__ = ('password', 'up', 'down', 'obfs', 'obfs_password', 'sni', 'skip_cert_verify', 'alpn')
+    type = 'hysteria2'
+    INTERNED = frozenset(('obfs',))
+
+
+class Socks5Proxy(Proxy):
+    __slots__ = ('username', 'password', 'tls', 'skip_cert_verify')
+    type = 'socks5'
+
+
+class HttpProxy(Proxy):
+    __slots__ = ('username', 'password', 'tls', 'sni', 'skip_cert_verify')
+    type = 'http'
+
+
+# clash type -> class
+PROXY_TYPES: Dict[str, type] = {cls.type: cls for cls in (ShadowsocksProxy, VmessProxy, VlessProxy, TrojanProxy, Hysteria2Proxy, Socks5Proxy, HttpProxy)}
+
+
+# keys of a proxy group that select proxies dynamically; resolved by `expand_proxy_groups`
+DYNAMIC_GROUP_KEYS = ('include-all', 'include-all-proxies', 'include-all-providers', 'filter', 'exclude-filter', 'exclude-type')
+# left to the core when a group includes the proxies of providers, which are not known here
+PROVIDER_GROUP_KEYS = ('include-all-providers', 'filter', 'exclude-filter', 'exclude-type')
+
+# clash config proxy type -> adapter type name used by `exclude-type`
+ADAPTER_TYPES = {
+    'ss': 'shadowsocks',
+    'ssr': 'shadowsocksr',
+    'socks5': 'socks5',
+}
 
 
 class ProxyGroup(object):
@@ -33,22 +220,16 @@ class ProxyGroup(object):
 
     def __init__(self, inner: Dict):
         self.inner = inner
-        if not 'proxies' in self.inner:
-            raise ValueError('\"proxies\" not found in proxy group')
         if 'use' in self.inner:
             raise ValueError('\"use\" unimplemented in proxy group')
-        if 'include-all' in self.inner:
-            raise ValueError('\"include-all\" unimplemented in proxy group')
-        if 'include-all-proxies' in self.inner:
-            raise ValueError('\"include-all-proxies\" unimplemented in proxy group')
-        if 'include-all-providers' in self.inner:
-            raise ValueError('\"include-all-providers\" unimplemented in proxy group')
-        if 'filter' in self.inner:
-            raise ValueError('\"filter\" unimplemented in proxy group')
-        if 'exclude-filter' in self.inner:
-            raise ValueError('\"exclude-filter\" unimplemented in proxy group')
-        if 'exclude-type' in self.inner:
-            raise ValueError('\"exclude-type\" unimplemented in proxy group')
+        if not 'proxies' in self.inner:
+            if not self.is_dynamic:
+                raise ValueError('\"proxies\" not found in proxy group')
+            self.inner['proxies'] = []
+
+    @property
+    def is_dynamic(self) -> bool:
+        return any(key in self.inner for key in DYNAMIC_GROUP_KEYS)
 
     @property
     def name(self) -> str:
@@ -76,9 +257,71 @@ class ProxyGroup(object):
     def copy(self, name: str):
         new_inner = self.inner.copy()
         new_inner['name'] = name
+        if new_inner.get('proxies') is not None:
+            new_inner['proxies'] = list(new_inner['proxies'])
         return ProxyGroup(new_inner)
 
 
+@lru_cache(maxsize=None)
+def _compile_filter(expr: str) -> Tuple[re.Pattern, ...]:
+    # several expressions may be separated by '`'
+    return tuple(re.compile(e) for e in expr.split('`') if e)
+
+
+def expand_proxy_groups(proxies: List[Proxy], groups: List[ProxyGroup]) -> int:
+    """
+    Resolve `include-all*`, `filter`, `exclude-filter` and `exclude-type` of the groups against `proxies` into
+    explicit member lists, in a single pass over the proxies. As in mihomo, the filters apply to the included
+    proxies and not to the explicitly listed ones. Groups sharing the same selection are evaluated once.
+    A group with `include-all-providers` keeps it and its filters, for the core to add the proxies of providers.
+    Returns the number of groups expanded.
+    """
+    specs: Dict[Tuple, List[ProxyGroup]] = {}
+    for g in groups:
+        if not g.is_dynamic:
+            continue
+        include_all = bool(g.inner.get('include-all') or g.inner.get('include-all-proxies'))
+        spec = (include_all, g.inner.get('filter') or '', g.inner.get('exclude-filter') or '', (g.inner.get('exclude-type') or '').lower())
+        specs.setdefault(spec, []).append(g)
+    if not specs:
+        return 0
+    matchers = []
+    for spec in specs.keys():
+        include_all, filter_expr, exclude_expr, exclude_type = spec
+        matchers.append((
+            include_all,
+            _compile_filter(filter_expr),
+            _compile_filter(exclude_expr),
+            frozenset(t for t in exclude_type.split('|') if t),
+            [],
+        ))
+    for p in proxies:
+        name = p.name
+        adapter_type = ADAPTER_TYPES.get(p.type, p.type)
+        for include_all, filters, excludes, exclude_types, matched in matchers:
+            if not include_all:
+                continue
+            if filters and not any(f.search(name) for f in filters):
+                continue
+            if excludes and any(f.search(name) for f in excludes):
+                continue
+            if adapter_type in exclude_types:
+                continue
+            matched.append(name)
+    count = 0
+    for spec_groups, (_, _, _, _, matched) in zip(specs.values(), matchers):
+        for g in spec_groups:
+            members = g.inner['proxies']
+            known = set(members)
+            members.extend(n for n in matched if n not in known)
+            providers = bool(g.inner.get('include-all-providers'))
+            for key in DYNAMIC_GROUP_KEYS:
+                if not (providers and key in PROVIDER_GROUP_KEYS):
+                    g.inner.pop(key, None)
+            count += 1
+    return count
+
+
 class RuleType(Enum):
     DOMAIN = 'DOMAIN'
     DOMAIN_SUFFIX = 'DOMAIN-SUFFIX'
@@ -116,59 +359,235 @@ class RuleType(Enum):
     MATCH = 'MATCH'
 
 
-class Rule(object):
+LOGICAL_RULE_TYPES = (RuleType.LOGICAL_AND, RuleType.LOGICAL_OR, RuleType.LOGICAL_NOT)
+
+
+def _match_parentheses(raw: str) -> Dict[int, int]:
+    # position of '(' -> position of its ')'
+    match: Dict[int, int] = {}
+    stack: List[int] = []
+    for i, c in enumerate(raw):
+        if c == '(':
+            stack.append(i)
+        elif c == ')':
+            if len(stack) == 0:
+                raise ValueError('Invalid rule format')
+            match[stack.pop()] = i
+    if len(stack) > 0:
+        raise ValueError('Invalid rule format')
+    return match
+
+
+def _split_fields(raw: str, start: int, end: int, match: Dict[int, int]) -> List[Tuple[int, int]]:
+    # split raw[start:end] on the commas outside parentheses; nested parentheses are skipped in one step,
+    # so every character is visited at a single nesting level and parsing stays linear
+    parts = []
+    last = start
+    i = start
+    while i < end:
+        c = raw[i]
+        if c == '(':
+            i = match[i] + 1
+            continue
+        if c == ',':
+            parts.append((last, i))
+            last = i + 1
+        i += 1
+    if last < end:
+        parts.append((last, end))
+    return parts
+
+
+def _unwrap(raw: str, part: Tuple[int, int], match: Dict[int, int]) -> Tuple[int, int]:
+    start, end = part
+    if end - start < 2 or raw[start] != '(' or match.get(start) != end - 1:
+        raise ValueError(f'Invalid rule format: expect parenthesized expression at {start}')
+    return start + 1, end - 1
+
+
+class Condition(object):
+    """
+    Hash-consed node of the rule AST: a leaf `TYPE,match[,no-resolve]`, a logical node over its children,
+    or the condition of a `SUB-RULE`. Equal conditions are the same object, so subtrees repeated across
+    rules and subscriptions are stored once.
+    """
+
+    __slots__ = ('type', 'match', 'no_resolve', 'children', '_raw', '__weakref__')
 
     type: RuleType
-    match: str
-    strategy: str
+    match: Optional[str]
     no_resolve: Optional[bool]
+    children: Tuple['Condition', ...]
+
+    _interned: 'WeakValueDictionary[Tuple, Condition]' = WeakValueDictionary()
+
+    def __init__(self, type: RuleType, match: Optional[str], no_resolve: Optional[bool], children: Tuple['Condition', ...]):
+        self.type = type
+        self.match = match
+        self.no_resolve = no_resolve
+        self.children = children
+        self._raw = None
+
+    @classmethod
+    def make(cls, type: RuleType, match: Optional[str] = None, no_resolve: Optional[bool] = None, children: Tuple['Condition', ...] = ()) -> 'Condition':
+        key = (type, match, no_resolve, children)
+        cond = cls._interned.get(key)
+        if cond is None:
+            if match is not None:
+                match = sys_intern(match)
+            cond = cls(type, match, no_resolve, children)
+            cls._interned[key] = cond
+        return cond
+
+    @classmethod
+    def parse(cls, raw: str) -> 'Condition':
+        return cls._parse(raw, 0, len(raw), _match_parentheses(raw))
+
+    @classmethod
+    def _parse(cls, raw: str, start: int, end: int, match: Dict[int, int]) -> 'Condition':
+        parts = _split_fields(raw, start, end, match)
+        if len(parts) < 2:
+            raise ValueError(f'Invalid rule format: {raw[start:end]}')
+        type = RuleType(raw[parts[0][0]:parts[0][1]])
+        if type in LOGICAL_RULE_TYPES:
+            return cls._parse_logical(type, raw, parts[1], match)
+        if type == RuleType.SUB_RULE or type == RuleType.MATCH:
+            raise ValueError(f'{type.value} is not allowed in a logical rule')
+        no_resolve = None
+        if len(parts) > 2:
+            no_resolve = raw[parts[2][0]:parts[2][1]] == 'no-resolve'
+        return cls.make(type, raw[parts[1][0]:parts[1][1]], no_resolve)
+
+    @classmethod
+    def _parse_logical(cls, type: RuleType, raw: str, payload: Tuple[int, int], match: Dict[int, int]) -> 'Condition':
+        start, end = _unwrap(raw, payload, match)
+        children = tuple(cls._parse(raw, *_unwrap(raw, part, match), match) for part in _split_fields(raw, start, end, match))
+        if len(children) == 0 or (type == RuleType.LOGICAL_NOT and len(children) != 1):
+            raise ValueError(f'Invalid number of conditions in {type.value} rule')
+        return cls.make(type, children=children)
+
+    @property
+    def payload(self) -> Optional[str]:
+        if self.type in LOGICAL_RULE_TYPES:
+            return '(' + ','.join(f'({c.raw})' for c in self.children) + ')'
+        if self.type == RuleType.SUB_RULE:
+            return f'({self.children[0].raw})'
+        return self.match
+
+    @property
+    def raw(self) -> str:
+        if self._raw is None:
+            if self.no_resolve:
+                self._raw = f'{self.type.value},{self.payload},no-resolve'
+            else:
+                self._raw = f'{self.type.value},{self.payload}'
+        return self._raw
+
+    def walk(self) -> Iterator['Condition']:
+        yield self
+        for c in self.children:
+            yield from c.walk()
+
+    def __repr__(self) -> str:
+        return self.raw
+
+
+class Rule(object):
+
+    __slots__ = ('cond', 'strategy', 'sub_rules')
+
+    cond: Condition
+    strategy: str   # target; the sub-rule name for SUB-RULE
+    sub_rules: Optional[List['Rule']]   # rules of the referenced sub-rule, linked by `Info`
     #src: Optional[str]
 
     def __init__(self, raw: str):
-        inside = 0
-        last = 0
-        parts = []
-        for i, c in enumerate(raw):
-            if c == ',' and inside == 0:
-                parts.append(raw[last:i])
-                last = i + 1
-            elif c == '(':
-                inside += 1
-            elif c == ')':
-                inside -= 1
-        if inside == 0:
-            if last < len(raw):
-                parts.append(raw[last:])
-        else:
-            raise ValueError('Invalid rule format')
-        self.type = RuleType(parts[0])
-        if self.type in (RuleType.LOGICAL_AND, RuleType.LOGICAL_OR, RuleType.LOGICAL_NOT, RuleType.SUB_RULE):
-            raise ValueError(f'unimplemented rule type: {self.type}')
-        if self.type == RuleType.MATCH:
-            self.match = None
-            self.strategy = parts[1]
-            self.no_resolve = None
+        match = _match_parentheses(raw)
+        parts = _split_fields(raw, 0, len(raw), match)
+        fields = [raw[s:e] for s, e in parts]
+        type = RuleType(fields[0])
+        self.sub_rules = None
+        if type == RuleType.MATCH:
+            self.cond = Condition.make(type)
+            self.strategy = fields[1]
+        elif type in LOGICAL_RULE_TYPES:
+            self.cond = Condition._parse_logical(type, raw, parts[1], match)
+            self.strategy = fields[2]
+        elif type == RuleType.SUB_RULE:
+            child = Condition._parse(raw, *_unwrap(raw, parts[1], match), match)
+            self.cond = Condition.make(type, children=(child,))
+            self.strategy = fields[2]
         else:
-            self.match = parts[1]
-            self.strategy = parts[2]
-            if len(parts) > 3:
-                self.no_resolve = parts[3] == 'no-resolve'
-            else:
-                self.no_resolve = None
+            no_resolve = None
+            if len(fields) > 3:
+                no_resolve = fields[3] == 'no-resolve'
+            self.cond = Condition.make(type, fields[1], no_resolve)
+            self.strategy = fields[2]
+
+    @classmethod
+    def of(cls, cond: Condition, strategy: str) -> 'Rule':
+        rule = cls.__new__(cls)
+        rule.cond = cond
+        rule.strategy = strategy
+        rule.sub_rules = None
+        return rule
+
+    @property
+    def type(self) -> RuleType:
+        return self.cond.type
+
+    @property
+    def match(self) -> Optional[str]:
+        return self.cond.payload
+
+    @property
+    def no_resolve(self) -> Optional[bool]:
+        return self.cond.no_resolve
 
     @property
     def raw(self) -> str:
-        if self.match is None:
-            return f'{self.type.value},{self.strategy}'
-        elif self.no_resolve:
-            return f'{self.type.value},{self.match},{self.strategy},no-resolve'
+        cond = self.cond
+        if cond.type == RuleType.MATCH:
+            return f'{cond.type.value},{self.strategy}'
+        elif cond.no_resolve:
+            return f'{cond.type.value},{cond.payload},{self.strategy},no-resolve'
         else:
-            return f'{self.type.value},{self.match},{self.strategy}'
+            return f'{cond.type.value},{cond.payload},{self.strategy}'
     
     def __repr__(self) -> str:
         return self.raw
 
 
+def collect_sub_rules(rules: List[Rule], result: Optional[Dict[str, List[Rule]]] = None) -> Dict[str, List[Rule]]:
+    """
+    Collect the sub-rules referenced by `rules`, including those referenced from within sub-rules.
+    """
+    if result is None:
+        result = {}
+    for r in rules:
+        if r.sub_rules is not None and r.strategy not in result:
+            result[r.strategy] = r.sub_rules
+            collect_sub_rules(r.sub_rules, result)
+    return result
+
+
+def rule_set_names(rules: List[Rule]) -> Set[str]:
+    """
+    Names of the rule providers the `RULE-SET` conditions of `rules` refer to, including within the sub-rules they use.
+    """
+    names: Set[str] = set()
+    seen: Set[Condition] = set()
+    for items in (rules, *collect_sub_rules(rules).values()):
+        for r in items:
+            if r.cond in seen:
+                continue
+            seen.add(r.cond)
+            for cond in r.cond.walk():
+                if cond.type == RuleType.RULE_SET:
+                    names.add(cond.match)
+    return names
+
+
 
 class ISubscribeReader(ABC):
 
@@ -199,17 +618,37 @@ class ISubscribeReader(ABC):
     def get_rules(self) -> List[Rule]:
         pass
 
+    def get_sub_rules(self) -> Dict[str, List[Rule]]:
+        return {}
+
+    def get_rule_providers(self) -> Dict[str, Dict]:
+        return {}
+
 
 
 class IConfigWriter(ABC):
 
+    dropped_rules: int  # rules the last `write` could not express in the target format
+
     def __init__(self):
+        self.dropped_rules = 0
+
+    def configure(self, **options) -> None:
+        """
+        Environment dependent options (e.g. `geodata`); a writer ignores the options it does not use.
+        """
         pass
 
     @abstractmethod
     def template(self, ifile: BinaryIO) -> None:
         pass
 
+    def rule_providers(self, **kwargs) -> Dict[str, Dict]:
+        """
+        The `rule-providers` the template declares once rendered with the variables of `write`.
+        """
+        return {}
+
     @abstractmethod
     def write(self, ofile: BinaryIO, proxies: List[Proxy], proxy_groups: List[ProxyGroup], rules: List[Rule], **kwargs) -> None:
         pass
@@ -232,11 +671,15 @@ class Info(object):
     proxy_groups_general: Dict[GeneralGroup, ProxyGroup]  # general group -> proxy group name -> proxy group
     proxy_groups_other: Dict[str, ProxyGroup]  # proxy group name -> proxy group
     rules: List[Rule]
+    sub_rules: Dict[str, List[Rule]]   # sub-rule name -> rules
+    rule_providers: Dict[str, Dict]     # rule provider name -> clash provider
+    renames: Dict[str, str]     # name given by `modify_by_name` -> name in the subscription
 
     def __init__(self, reader: ISubscribeReader, name: str, priority: int, use_rules: bool, group_info: Optional[Dict[str, GeneralGroup]] = None):
         self.name = name
         self.priority = priority
         self.use_rules = use_rules
+        self.renames = {}
         # self.proxies
         proxies_raw = reader.get_proxies()
         self.proxies = {}
@@ -248,6 +691,8 @@ class Info(object):
             group_info = {}
         self.proxy_groups_general = {}
         self.proxy_groups_other = {}
+        # groups selecting proxies dynamically are resolved within this subscription, before names get prefixed
+        expand_proxy_groups(proxies_raw or [], proxy_groups_raw or [])
         for g in proxy_groups_raw:
             category = group_info.get(g.name)
             if category is None or category == GeneralGroup._GLOBAL:
@@ -260,6 +705,42 @@ class Info(object):
                 self.proxy_groups_general[category] = reader.get_all_proxies(category.value)
         # self.rules
         self.rules = reader.get_rules()
+        # self.sub_rules
+        self.sub_rules = reader.get_sub_rules() or {}
+        if self.rules is not None:
+            self.rules = self._link_sub_rules(self.rules)
+        for sub_name, sub_rules in self.sub_rules.items():
+            self.sub_rules[sub_name] = self._link_sub_rules(sub_rules)
+        # self.rule_providers
+        self.rule_providers = reader.get_rule_providers() or {}
+
+    def _link_sub_rules(self, rules: List[Rule]) -> List[Rule]:
+        result = []
+        for r in rules:
+            if r.type == RuleType.SUB_RULE:
+                r.sub_rules = self.sub_rules.get(r.strategy)
+                if r.sub_rules is None:
+                    collector.record(MISSING_SUB_RULE, r)
+                    continue
+            result.append(r)
+        return result
+
+    def copy(self) -> 'Info':
+        """
+        Copy for another `merge`: proxies and rules are shared, the proxy groups, which merging modifies, are copied.
+        """
+        info = Info.__new__(Info)
+        info.name = self.name
+        info.priority = self.priority
+        info.use_rules = self.use_rules
+        info.proxies = self.proxies
+        info.proxy_groups_general = {category: g.copy(g.name) for category, g in self.proxy_groups_general.items()}
+        info.proxy_groups_other = {name: g.copy(g.name) for name, g in self.proxy_groups_other.items()}
+        info.rules = self.rules
+        info.sub_rules = self.sub_rules
+        info.rule_providers = self.rule_providers
+        info.renames = self.renames
+        return info
 
     def modify_by_name(self, prefix: str) -> None:
         # modify proxy name
@@ -281,6 +762,9 @@ class Info(object):
             new_name = f'[{prefix}]-{name}'
             proxy_groups_names[g.name] = new_name
             g.name = new_name
+        for names in (proxies_names, proxy_groups_names):
+            for name, new_name in names.items():
+                self.renames[new_name] = name
         # modify proxy name in proxy group
         def inner_modifier(name: str) -> str:
             new_name = proxies_names.get(name)
@@ -294,10 +778,38 @@ class Info(object):
             g.modify_proxy(inner_modifier)
         for name, g in self.proxy_groups_other.items():
             g.modify_proxy(inner_modifier)
-        # modify rule strategy
-        for r in self.rules:
-            r.strategy = inner_modifier(r.strategy)
-            #TODO: modify sub-rule name
+        # modify sub-rule name
+        sub_rules = {}
+        sub_rules_names = {}
+        for name, rules in self.sub_rules.items():
+            new_name = f'[{prefix}]-{name}'
+            sub_rules_names[name] = new_name
+            sub_rules[new_name] = rules
+        self.sub_rules = sub_rules
+        # modify rule provider name; RULE-SET naming a provider of the template is kept
+        rule_providers_names = {name: f'[{prefix}]-{name}' for name in self.rule_providers}
+        self.rule_providers = {rule_providers_names[name]: provider for name, provider in self.rule_providers.items()}
+        def cond_modifier(cond: Condition) -> Condition:
+            if cond.type == RuleType.RULE_SET:
+                return Condition.make(cond.type, rule_providers_names.get(cond.match, cond.match), cond.no_resolve)
+            if not cond.children:
+                return cond
+            children = tuple(cond_modifier(c) for c in cond.children)
+            return Condition.make(cond.type, cond.match, cond.no_resolve, children)
+        # modify rule strategy, including the rules inside sub-rules
+        def rule_modifier(r: Rule) -> None:
+            if r.type == RuleType.SUB_RULE:
+                r.strategy = sub_rules_names.get(r.strategy, r.strategy)
+            else:
+                r.strategy = inner_modifier(r.strategy)
+            if rule_providers_names:
+                r.cond = cond_modifier(r.cond)
+        if self.rules is not None:
+            for r in self.rules:
+                rule_modifier(r)
+        for rules in self.sub_rules.values():
+            for r in rules:
+                rule_modifier(r)
 
 def merge(data: List[Info]) -> Tuple[List[Proxy], List[ProxyGroup], List[Rule]]:
     # sort by priority from high to low
@@ -358,5 +870,129 @@ def merge(data: List[Info]) -> Tuple[List[Proxy], List[ProxyGroup], List[Rule]]:
 
 
 
+class DedupeReport(object):
+
+    proxies: int    # before deduplication
+    aliases: Dict[str, str]     # removed proxy -> proxy kept in its place
+    sources: Dict[Tuple[str, str], int]     # (subscription of the removed, subscription of the kept) -> count
+
+    def __init__(self, proxies: int):
+        self.proxies = proxies
+        self.aliases = {}
+        self.sources = {}
+
+    @property
+    def removed(self) -> int:
+        return len(self.aliases)
+
+
+def _remap_rules(rules: List[Rule], aliases: Dict[str, str], memo: Dict[int, List[Rule]]) -> List[Rule]:
+    # rules may be shared with other merges: those to change are replaced, never modified
+    result = rules
+    for i, r in enumerate(rules):
+        new = r
+        if r.sub_rules is not None:
+            sub_rules = memo.get(id(r.sub_rules))
+            if sub_rules is None:
+                memo[id(r.sub_rules)] = r.sub_rules     # a sub-rule referring to itself is left as is
+                sub_rules = _remap_rules(r.sub_rules, aliases, memo)
+                memo[id(r.sub_rules)] = sub_rules
+            if sub_rules is not r.sub_rules:
+                new = Rule.of(r.cond, r.strategy)
+                new.sub_rules = sub_rules
+        elif r.strategy in aliases:
+            new = Rule.of(r.cond, aliases[r.strategy])
+        if new is not r:
+            if result is rules:
+                result = list(rules)
+            result[i] = new
+    return result
+
+
+def dedupe_proxies(data: List[Info], proxies: List[Proxy], proxy_groups: List[ProxyGroup], rules: List[Rule]) -> Tuple[List[Proxy], List[Rule], DedupeReport]:
+    """
+    Keep a single proxy per endpoint fingerprint: the first one in merge order (`data` as sorted by `merge`, i.e.
+    the subscription of highest priority, then the order of the subscription). Group members and rule targets
+    naming a removed proxy are rewritten to the kept one.
+    """
+    report = DedupeReport(len(proxies))
+    merged = set(p.name for p in proxies)
+    kept: Dict[bytes, Tuple[str, str]] = {}    # fingerprint -> (name, subscription)
+    for info in data:
+        for p in info.proxies.values():
+            if p.name not in merged or p.name in report.aliases:
+                continue
+            survivor = kept.get(p.fingerprint)
+            if survivor is None:
+                kept[p.fingerprint] = (p.name, info.name)
+            elif survivor[0] != p.name:
+                report.aliases[p.name] = survivor[0]
+                key = (info.name, survivor[1])
+                report.sources[key] = report.sources.get(key, 0) + 1
+    if not report.aliases:
+        return proxies, rules, report
+    aliases = report.aliases
+    for g in proxy_groups:
+        members = g.inner.get('proxies')
+        if not members:
+            continue
+        seen = set()
+        result = []
+        for m in members:
+            m = aliases.get(m, m)
+            if m not in seen:
+                seen.add(m)
+                result.append(m)
+        g.inner['proxies'] = result
+    proxies = [p for p in proxies if p.name not in aliases]
+    return proxies, _remap_rules(rules, aliases, {}), report
+
+
+_PREFIXED_NAME = re.compile(r'^\[[^\]]*\]-(.*)$', re.S)
+
+
+class NameMap(object):
+    """
+    Maps a proxy or group name of a previous config to its name in the new one: kept as is when it still exists,
+    to the surviving copy when deduplicated, else through the name in the subscription (`Info.renames`) when it
+    is unique, which follows a renamed or reordered subscription.
+    """
+
+    names: Set[str]
+    aliases: Dict[str, str]     # proxy of this build, removed -> proxy with the same endpoint that was kept
+    originals: Dict[str, List[str]]     # name in the subscription -> names in the new config
+
+    def __init__(self, data: List[Info], proxies: List[Proxy], proxy_groups: List[ProxyGroup]):
+        self.names = set(p.name for p in proxies)
+        self.names.update(g.name for g in proxy_groups)
+        kept: Dict[bytes, str] = {}
+        for p in proxies:
+            kept.setdefault(p.fingerprint, p.name)
+        self.aliases = {}
+        self.originals = {}
+        for info in data:
+            for p in info.proxies.values():
+                if p.name not in self.names and p.fingerprint in kept:
+                    self.aliases[p.name] = kept[p.fingerprint]
+            for name, original in info.renames.items():
+                name = self.aliases.get(name, name)
+                if name in self.names:
+                    candidates = self.originals.setdefault(original, [])
+                    if name not in candidates:
+                        candidates.append(name)
+
+    def resolve(self, name: str) -> Optional[str]:
+        if name in self.names:
+            return name
+        alias = self.aliases.get(name)
+        if alias is not None:
+            return alias
+        m = _PREFIXED_NAME.match(name)
+        candidates = self.originals.get(m.group(1) if m is not None else name)
+        if candidates is not None and len(candidates) == 1:
+            return candidates[0]
+        return None
+
+
 if __name__ == '__main__':
     print('This is a library, not a standalone script')
\ No newline at end of file
@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+from json import dump as json_dump
+from threading import Lock, local
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+MAX_SAMPLES = 5
+SAMPLE_WIDTH = 100
+
+# categories
+UNSUPPORTED_LINK = 'unsupported link'
+INVALID_PROXY = 'invalid proxy'
+INVALID_PROXY_GROUP = 'invalid proxy group'
+INVALID_RULE = 'invalid rule'
+MISSING_SUB_RULE = 'missing sub-rule'
+UNKNOWN_GEO_KEY = 'unknown geo key'
+UNSUPPORTED_PROXY = 'unsupported proxy'
+UNSUPPORTED_PROXY_GROUP = 'unsupported proxy group'
+UNSUPPORTED_RULE = 'unsupported rule'
+UNINDEXED_RULE = 'unindexed rule'
+UNRESOLVED_RULE_PROVIDER = 'unresolved rule provider'
+DROPPED_PROXY = 'dropped proxy'
+
+# (category, source)
+IssueKey = Tuple[str, str]
+
+
+class Diagnostics(object):
+    """
+    Counts the issues met while reading and writing, by category and source, keeping the first
+    `max_samples` examples of each; recording is a dict update, the formatting happens once in `summary`.
+    The source is per thread, so the renders of `serve` can record concurrently.
+    """
+
+    max_samples: int
+    _counts: Dict[IssueKey, int]
+    _samples: Dict[IssueKey, List[Tuple[Any, Any]]]
+    _local: local
+    _lock: Lock
+
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._counts = {}
+        self._samples = {}
+        self._local = local()
+        self._lock = Lock()
+
+    @property
+    def source(self) -> str:
+        return getattr(self._local, 'source', '')
+
+    @source.setter
+    def source(self, source: str) -> None:
+        self._local.source = source
+
+    def record(self, category: str, example: Any = None, detail: Any = None) -> None:
+        key = (category, self.source)
+        with self._lock:
+            n = self._counts.get(key, 0)
+            self._counts[key] = n + 1
+            if n < self.max_samples:
+                self._samples.setdefault(key, []).append((example, detail))
+
+    @contextmanager
+    def scope(self, source: str) -> Iterator[None]:
+        """
+        Attribute the issues recorded inside to `source` (a subscription, a writer...).
+        """
+        previous = self.source
+        self.source = source
+        try:
+            yield
+        finally:
+            self.source = previous
+
+    @property
+    def total(self) -> int:
+        return sum(self._counts.values())
+
+    def by_category(self) -> Dict[str, int]:
+        result: Dict[str, int] = {}
+        for (category, _), n in self._counts.items():
+            result[category] = result.get(category, 0) + n
+        return result
+
+    def summary(self) -> List[str]:
+        if not self._counts:
+            return []
+        width = max(len(category) for category, _ in self._counts)
+        lines = [f'># {self.total} issues:']
+        for (category, source), n in sorted(self._counts.items(), key=lambda x: -x[1]):
+            example, detail = self._samples[(category, source)][0]
+            sample = str(example) if detail is None else f'{example} ({detail})'
+            if len(sample) > SAMPLE_WIDTH:
+                sample = sample[:SAMPLE_WIDTH - 3] + '...'
+            lines.append(f'>! {n:>8}  {category:<{width}}  [{source or "-"}] e.g. {sample}')
+        return lines
+
+    def print_summary(self, file=None) -> None:
+        for line in self.summary():
+            print(line, file=file)
+
+    def dump(self, filename: str) -> None:
+        issues = []
+        for (category, source), n in self._counts.items():
+            issues.append({
+                'category': category,
+                'source': source,
+                'count': n,
+                'samples': [{'example': str(e), 'detail': None if d is None else str(d)} for e, d in self._samples[(category, source)]],
+            })
+        with open(filename, 'w', encoding='utf-8') as ofile:
+            json_dump({'total': self.total, 'issues': issues}, ofile, ensure_ascii=False, indent=2)
+
+    def snapshot(self) -> List[Tuple[IssueKey, int, List[Tuple[str, Optional[str]]]]]:
+        """
+        Counts and samples as plain strings, to be handed to another process and merged with `absorb`.
+        """
+        return [
+            (key, n, [(str(e), None if d is None else str(d)) for e, d in self._samples[key]])
+            for key, n in self._counts.items()
+        ]
+
+    def absorb(self, snapshot: List[Tuple[IssueKey, int, List[Tuple[str, Optional[str]]]]]) -> None:
+        for key, n, samples in snapshot:
+            self._counts[key] = self._counts.get(key, 0) + n
+            kept = self._samples.setdefault(key, [])
+            kept.extend(samples[:self.max_samples - len(kept)])
+
+    def clear(self) -> None:
+        self._counts.clear()
+        self._samples.clear()
+
+
+collector = Diagnostics()
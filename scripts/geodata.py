@@ -0,0 +1,251 @@
+from ipaddress import ip_address
+from mmap import ACCESS_READ, mmap
+from os import path
+from typing import Dict, List, Optional, Tuple
+
+from data import Condition, Rule, RuleType, collect_sub_rules
+from diagnostics import UNKNOWN_GEO_KEY, collector
+
+GEOSITE_FILE = 'geosite.dat'
+GEOIP_FILE = 'geoip.dat'
+GEOIP_METADB_FILE = 'geoip.metadb'
+
+# `Domain.Type` of the v2ray geosite format
+DOMAIN_PLAIN = 0    # keyword
+DOMAIN_REGEX = 1
+DOMAIN_ROOT = 2     # domain and its subdomains
+DOMAIN_FULL = 3
+
+GEOSITE_RULE_TYPES: Dict[int, RuleType] = {
+    DOMAIN_PLAIN: RuleType.DOMAIN_KEYWORD,
+    DOMAIN_REGEX: RuleType.DOMAIN_REGEX,
+    DOMAIN_ROOT: RuleType.DOMAIN_SUFFIX,
+    DOMAIN_FULL: RuleType.DOMAIN,
+}
+
+GEOIP_RULE_TYPES = (RuleType.GEOIP, RuleType.SRC_GEOIP)
+
+
+def _read_varint(buf: mmap, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf: mmap, start: int, end: int):
+    # yields (field number, wire type, value or (start, end) of a length-delimited payload)
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _read_varint(buf, pos)
+            yield field, wire, value
+        elif wire == 2:
+            length, pos = _read_varint(buf, pos)
+            yield field, wire, (pos, pos + length)
+            pos += length
+        elif wire == 1:
+            pos += 8
+        elif wire == 5:
+            pos += 4
+        else:
+            raise ValueError(f'unsupported protobuf wire type {wire} at {pos}')
+
+
+class GeoDomain(object):
+
+    __slots__ = ('type', 'value', 'attributes')
+
+    type: int
+    value: str
+    attributes: Tuple[str, ...]
+
+    def __init__(self, type: int, value: str, attributes: Tuple[str, ...]):
+        self.type = type
+        self.value = value
+        self.attributes = attributes
+
+
+class _GeoFile(object):
+    """
+    Memory-mapped `GeoSiteList`/`GeoIPList`; the index of country codes (upper case) -> entry span
+    is built on first use by reading only the code of every entry.
+    """
+
+    filename: str
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._buf = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        self._index: Optional[Dict[str, Tuple[int, int]]] = None
+
+    @property
+    def index(self) -> Dict[str, Tuple[int, int]]:
+        if self._index is None:
+            index = {}
+            buf = self._buf
+            for field, wire, span in _iter_fields(buf, 0, len(buf)):
+                if field != 1 or wire != 2:
+                    continue
+                for inner_field, inner_wire, value in _iter_fields(buf, *span):
+                    if inner_field == 1 and inner_wire == 2:
+                        index[buf[value[0]:value[1]].decode('utf-8').upper()] = span
+                        break
+            self._index = index
+        return self._index
+
+    def close(self) -> None:
+        self._buf.close()
+        self._file.close()
+
+
+class GeoData(object):
+    """
+    Local geo databases of the core (`geosite.dat`, `geoip.dat` in the v2ray protobuf format), used to
+    validate `GEOSITE`/`GEOIP` keys and to turn them into plain domain and cidr lists.
+
+    `geoip.metadb` (MaxMind format) cannot list its country codes without walking the whole search tree,
+    so it is only detected; `GEOIP` keys are validated against `geoip.dat` when it is present.
+    """
+
+    directory: str
+    geosite: Optional[_GeoFile]
+    geoip: Optional[_GeoFile]
+    has_metadb: bool
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        geosite_file = path.join(directory, GEOSITE_FILE)
+        geoip_file = path.join(directory, GEOIP_FILE)
+        self.geosite = _GeoFile(geosite_file) if path.isfile(geosite_file) else None
+        self.geoip = _GeoFile(geoip_file) if path.isfile(geoip_file) else None
+        self.has_metadb = path.isfile(path.join(directory, GEOIP_METADB_FILE))
+
+    @property
+    def available(self) -> bool:
+        return self.geosite is not None or self.geoip is not None
+
+    def has_geosite(self, key: str) -> Optional[bool]:
+        # None when there is nothing to check against
+        if self.geosite is None:
+            return None
+        return key.split('@', 1)[0].upper() in self.geosite.index
+
+    def has_geoip(self, key: str) -> Optional[bool]:
+        if self.geoip is None:
+            return None
+        return key.upper() in self.geoip.index
+
+    def geosite_domains(self, key: str) -> List[GeoDomain]:
+        """
+        Domains of a geosite tag; `tag@attr` keeps those carrying the attribute, `tag@!attr` those without.
+        """
+        name, _, attribute = key.partition('@')
+        span = self.geosite.index.get(name.upper())
+        if span is None:
+            raise KeyError(f'geosite {name} not found in {self.geosite.filename}')
+        negate = attribute.startswith('!')
+        attribute = attribute.lstrip('!')
+        buf = self.geosite._buf
+        result = []
+        for field, wire, value in _iter_fields(buf, *span):
+            if field != 2 or wire != 2:
+                continue
+            type = DOMAIN_PLAIN
+            text = ''
+            attributes = []
+            for inner_field, inner_wire, inner_value in _iter_fields(buf, *value):
+                if inner_field == 1 and inner_wire == 0:
+                    type = inner_value
+                elif inner_field == 2 and inner_wire == 2:
+                    text = buf[inner_value[0]:inner_value[1]].decode('utf-8')
+                elif inner_field == 3 and inner_wire == 2:
+                    for attr_field, attr_wire, attr_value in _iter_fields(buf, *inner_value):
+                        if attr_field == 1 and attr_wire == 2:
+                            attributes.append(buf[attr_value[0]:attr_value[1]].decode('utf-8'))
+            if attribute and (attribute in attributes) == negate:
+                continue
+            result.append(GeoDomain(type, text, tuple(attributes)))
+        return result
+
+    def geoip_cidrs(self, key: str) -> Tuple[List[str], bool]:
+        """
+        Networks of a geoip tag, and whether the tag matches everything outside of them (`reverse_match`).
+        """
+        span = self.geoip.index.get(key.upper())
+        if span is None:
+            raise KeyError(f'geoip {key} not found in {self.geoip.filename}')
+        buf = self.geoip._buf
+        cidrs = []
+        reverse = False
+        for field, wire, value in _iter_fields(buf, *span):
+            if field == 2 and wire == 2:
+                ip = b''
+                prefix = 0
+                for inner_field, inner_wire, inner_value in _iter_fields(buf, *value):
+                    if inner_field == 1 and inner_wire == 2:
+                        ip = buf[inner_value[0]:inner_value[1]]
+                    elif inner_field == 2 and inner_wire == 0:
+                        prefix = inner_value
+                cidrs.append(f'{ip_address(ip)}/{prefix}')
+            elif field == 3 and wire == 0:
+                reverse = bool(value)
+        return cidrs, reverse
+
+    def check(self, cond: Condition) -> Optional[str]:
+        """
+        The first geo key of the condition missing from the local databases, as `GEOSITE,key`, or None.
+        """
+        for c in cond.walk():
+            if c.type == RuleType.GEOSITE and self.has_geosite(c.match) == False:
+                return c.raw
+            if c.type in GEOIP_RULE_TYPES and self.has_geoip(c.match) == False:
+                return c.raw
+        return None
+
+    def validate(self, rules: List[Rule]) -> List[Rule]:
+        """
+        Drop the rules (and sub-rule entries) referring to geo keys unknown to the local databases.
+        """
+        def keep(items: List[Rule]) -> List[Rule]:
+            result = []
+            for r in items:
+                missing = self.check(r.cond)
+                if missing is not None:
+                    collector.record(UNKNOWN_GEO_KEY, r, missing)
+                    continue
+                result.append(r)
+            return result
+        for items in collect_sub_rules(rules).values():
+            items[:] = keep(items)
+        return keep(rules)
+
+    def close(self) -> None:
+        if self.geosite is not None:
+            self.geosite.close()
+        if self.geoip is not None:
+            self.geoip.close()
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    geo = GeoData(argv[1])
+    if geo.geosite is not None:
+        print(f'># geosite: {len(geo.geosite.index)} tags')
+    if geo.geoip is not None:
+        print(f'># geoip: {len(geo.geoip.index)} tags')
+    for key in argv[2:]:
+        if geo.has_geosite(key):
+            print(f'GEOSITE,{key}: {len(geo.geosite_domains(key))} domains')
+        if geo.has_geoip(key):
+            print(f'GEOIP,{key}: {len(geo.geoip_cidrs(key)[0])} cidrs')
+    geo.close()
@@ -0,0 +1,240 @@
+import http.client
+import ssl
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Mapping, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+MAX_REDIRECTS = 5
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+# (scheme, host, port, proxy)
+PoolKey = Tuple[str, str, int, Optional[str]]
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPS connection resuming the TLS session of a previous connection to the same host.
+    """
+
+    _pool: 'HTTPPool'
+    _pool_key: PoolKey
+
+    def __init__(self, host: str, port: int, timeout: float, context: ssl.SSLContext, pool: 'HTTPPool', pool_key: PoolKey):
+        super().__init__(host, port, timeout=timeout, context=context)
+        self._pool = pool
+        self._pool_key = pool_key
+
+    def connect(self) -> None:
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        session = self._pool._get_session(self._pool_key)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+
+
+class PooledResponse(object):
+    """
+    Response of `HTTPPool.request`; the connection goes back to the pool once the body is fully read and closed.
+    """
+
+    url: str
+    status: int
+    reason: str
+
+    def __init__(self, pool: 'HTTPPool', key: PoolKey, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse, url: str):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+
+    @property
+    def headers(self) -> http.client.HTTPMessage:
+        return self._resp.headers
+
+    def getheader(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self._resp.getheader(name, default)
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._resp.read(amt)
+
+    def read1(self, amt: int) -> bytes:
+        # at most one system call: a slow server does not hold back the caller between reads
+        data = self._resp.read1(amt)
+        if self._resp.length == 0:
+            # the body is complete; reading its end releases the connection for reuse
+            self._resp.read()
+        return data
+
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        reusable = self._resp.isclosed() and not self._resp.will_close
+        self._resp.close()
+        if reusable:
+            self._pool._release(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self) -> 'PooledResponse':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class HTTPPool(object):
+    """
+    Keep-alive connection pool on top of `http.client`, shared by every download of a run.
+
+    Idle connections are kept per host (at most `max_idle_per_host`, for at most `idle_timeout` seconds)
+    and TLS sessions are resumed on new connections to a host already visited.
+    Proxies from the environment (`http_proxy`, `https_proxy`, `no_proxy`) are honored.
+    """
+
+    max_idle_per_host: int
+    idle_timeout: float
+    context: ssl.SSLContext
+    _idle: Dict[PoolKey, List[Tuple[http.client.HTTPConnection, float]]]
+    _sessions: Dict[PoolKey, ssl.SSLSession]
+
+    def __init__(self, max_idle_per_host: int = 4, idle_timeout: float = 60.0, context: Optional[ssl.SSLContext] = None):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.context = context if context is not None else ssl.create_default_context()
+        self._idle = {}
+        self._sessions = {}
+        self._proxies = getproxies()
+        self._lock = Lock()
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def request(self, method: str, url: str, headers: Optional[Mapping[str, str]] = None, timeout: float = 5.0, body: Optional[bytes] = None) -> PooledResponse:
+        headers = dict(headers) if headers is not None else {}
+        for _ in range(MAX_REDIRECTS + 1):
+            # a redirect may lead to another host, which gets its own `Host`
+            hop_headers = dict(headers)
+            resp = self._request_once(method, url, hop_headers, timeout, body)
+            if resp.status in REDIRECT_STATUS:
+                location = resp.getheader('Location')
+                resp.read()
+                resp.close()
+                if not location:
+                    raise HTTPError(url, resp.status, 'redirect without location', resp.headers, None)
+                url = urljoin(url, location)
+                if resp.status == 303:
+                    method, body = 'GET', None
+                continue
+            if resp.status >= 400:
+                resp.close()
+                raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            return resp
+        raise HTTPError(url, resp.status, 'too many redirects', resp.headers, None)
+
+    def close(self) -> None:
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def __enter__(self) -> 'HTTPPool':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def _request_once(self, method: str, url: str, headers: Dict[str, str], timeout: float, body: Optional[bytes]) -> PooledResponse:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported url scheme: {scheme}')
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        proxy = self._proxies.get(scheme)
+        if proxy is not None and proxy_bypass(host):
+            proxy = None
+        key = (scheme, host, port, proxy)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        if proxy is not None and scheme == 'http':
+            target = url
+        headers['Host'] = parts.netloc.rsplit('@', 1)[-1]
+        conn, reused = self._acquire(key, timeout)
+        try:
+            conn.request(method, target, body=body, headers=headers)
+            resp = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            # stale keep-alive connection; retry once on a fresh one
+            conn = self._connect(key, timeout)
+            conn.request(method, target, body=body, headers=headers)
+            resp = conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+        if scheme == 'https' and conn.sock is not None:
+            session = conn.sock.session
+            if session is not None:
+                with self._lock:
+                    self._sessions[key] = session
+        return PooledResponse(self, key, conn, resp, url)
+
+    def _acquire(self, key: PoolKey, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        now = monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            conns = self._idle.get(key)
+            while conns:
+                candidate, released = conns.pop()
+                if now - released > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            self.connections_reused += 1
+            return conn, True
+        return self._connect(key, timeout), False
+
+    def _connect(self, key: PoolKey, timeout: float) -> http.client.HTTPConnection:
+        scheme, host, port, proxy = key
+        self.connections_opened += 1
+        if proxy is None:
+            if scheme == 'https':
+                return _HTTPSConnection(host, port, timeout, self.context, self, key)
+            return http.client.HTTPConnection(host, port, timeout=timeout)
+        proxy_parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        proxy_port = proxy_parts.port or 80
+        if scheme == 'https':
+            conn = _HTTPSConnection(proxy_parts.hostname, proxy_port, timeout, self.context, self, key)
+            conn.set_tunnel(host, port)
+            return conn
+        return http.client.HTTPConnection(proxy_parts.hostname, proxy_port, timeout=timeout)
+
+    def _release(self, key: PoolKey, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append((conn, monotonic()))
+                return
+        conn.close()
+
+    def _get_session(self, key: PoolKey) -> Optional[ssl.SSLSession]:
+        with self._lock:
+            return self._sessions.get(key)
@@ -1,13 +1,34 @@
-from argparse import Action, ArgumentParser
-from io import BytesIO, TextIOWrapper
-from os import makedirs, path
-from typing import Dict, Tuple
-from typing import Dict
-from io import TextIOWrapper
-from data import GeneralGroup, ISubscribeReader, IConfigWriter, Info, merge
+import filecmp
+import hashlib
+from argparse import Action, ArgumentParser, Namespace
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
+from contextlib import nullcontext, redirect_stdout
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import repeat
+from mmap import ACCESS_READ, mmap
+from multiprocessing import get_all_start_methods, get_context
+from os import cpu_count, makedirs, path, remove, replace, stat
+from sys import exit, stderr, stdin, stdout
+from threading import Event, Lock
+from time import monotonic, perf_counter
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+from cache import CODECS, CacheStore, GcReport
+from controller import Controller, WarmupReport, restore_selections, test_group_delays
+from diagnostics import collector
+from data import GeneralGroup, ISubscribeReader, IConfigWriter, Info, NameMap, Proxy, ProxyGroup, Rule, dedupe_proxies, merge, rule_set_names
 from json import load as json_load, dump as json_dump
 
-from utils import DynamicLoad, download_config
+from geodata import GeoData
+from http_pool import HTTPPool
+from probe import PROBE_DEMOTE, PROBE_DROP, ProbeResult, apply_probe, drop_rules, probe_proxies
+from matcher import RuleMatcher, query_lines
+from metrics import SOURCE_CACHE, SOURCE_FILE, SOURCE_REMOTE, RunMetrics, SubscriptionMetrics, Timer
+from reader_clash import ClashSubscribeReader
+from region import DEFAULT_TEST_URL, add_region_groups, make_region_groups
+from rule_provider import RULE_PROVIDER_TYPE, RuleProviders
+from serializer import JSON_SERIALIZERS, YAML_SERIALIZERS
+from server import ConfigServer, IConfigRenderer
+from utils import DynamicLoad, MirrorAttempt, download_hedged
 
 
 class SubscribeItem:
@@ -16,6 +37,8 @@ class SubscribeItem:
     priority: int
     type: str
     url: str
+    urls: List[str]
+    hedge_delay: int
     file: str
     use_rules: bool
     general_group: Dict[str, GeneralGroup]
@@ -25,7 +48,10 @@ class SubscribeItem:
         self.name = raw['name']
         self.priority = raw['priority']
         self.type = raw['type']
-        self.url = raw.get('url', '')
+        url = raw.get('url') or []
+        self.urls = [url] if isinstance(url, str) else list(url)
+        self.url = self.urls[0] if len(self.urls) > 0 else ''
+        self.hedge_delay = raw.get('hedge_delay', 2000)
         self.file = raw.get('file', '')
         self.use_rules = raw.get('use_rules', False)
         self.update_interval = raw.get('update_interval', 0)
@@ -37,57 +63,178 @@ class SubscribeItem:
         self.ignore = raw.get('ignore', False)
         pass
 
-    def load(self, cache_dir: str, dl: DynamicLoad, timeout: int = 5000, no_update: bool = False, cache_index: Dict[str, str] = None) -> Info:
+    def load(self, store: CacheStore, dl: DynamicLoad, timeout: int = 5000, no_update: bool = False, pool: Optional[HTTPPool] = None, metrics: Optional[SubscriptionMetrics] = None, refresh: Optional['Refresh'] = None) -> Info:
+        m = metrics if metrics is not None else SubscriptionMetrics(self.name)
         reader = None
         if self.url and not no_update:
-            print(f'># downloading {self.url} for {self.name} ...')
             try:
-                raw, filename = download_config(self.url)
-                with BytesIO(raw) as ifile:
-                    reader = dl.get_reader(self.type)
-                    filename = reader.get_cache_name(self._get_valid_filename(filename))
-                    print(f'># downloaded {self.url} as {filename}')
-                    filepath = path.join(cache_dir, filename)
-                    with open(filepath, 'wb') as ofile_cache:
-                        reader.read(ifile, False, ofile_cache)
-                    if cache_index is not None:
-                        cache_index[self.name] = filepath
-                    print(f'># saved file {filepath}')
+                if refresh is not None:
+                    download = refresh.take(self.name)
+                    if download is None:
+                        print(f'>! {self.name} is still downloading at the deadline; the download goes on for the next run')
+                        m.set('download_late', 1)
+                    else:
+                        reader = self._store_download(store, dl, *download, m)
+                else:
+                    print(f'># downloading {self.url} for {self.name} ...')
+                    reader = self._fetch(store, dl, pool, m, timeout)
+                if reader is not None:
+                    m.source = SOURCE_REMOTE
             except Exception as e:
                 print(f'>! failed with remote {self.name}', e)
+                m.set('http_status', getattr(e, 'code', 0) or 0)
                 reader = None
         
         if reader is None:
             if self.file:
                 print(f'># load file {self.file} for {self.name}')
                 try:
-                    with open(self.file, 'rb') as ifile:
+                    with open(self.file, 'rb') as ifile, Timer() as t:
                         reader = dl.get_reader(self.type)
                         reader.read(ifile, False, None)
+                    m.set('parse_seconds', t.elapsed)
+                    m.source = SOURCE_FILE
                 except Exception as e:
                     print(f'>! failed with local {self.name}', e)
                     reader = None
             else:
-                if cache_index is not None:
-                    filepath = cache_index.get(self.name)
-                    if filepath:
-                        print(f'># load cache {filepath} for {self.name}')
-                        try:
-                            with open(filepath, 'rb') as ifile:
-                                reader = dl.get_reader(self.type)
-                                reader.read(ifile, True, None)
-                        except Exception as e:
-                            print(f'>! failed with cache {self.name}', e)
-                            reader = None
+                try:
+                    ifile = store.open(self.name, self.type)
+                    if ifile is not None:
+                        print(f'># load cache for {self.name}')
+                        with ifile, Timer() as t:
+                            reader = dl.get_reader(self.type)
+                            reader.read(ifile, True, None)
+                        m.set('parse_seconds', t.elapsed)
+                        m.set('cache_hit', 1)
+                        m.source = SOURCE_CACHE
+                except Exception as e:
+                    print(f'>! failed with cache {self.name}', e)
+                    reader = None
         if reader is None:
             return None
-        return Info(reader, self.name, self.priority, self.use_rules, self.general_group)
+        info = Info(reader, self.name, self.priority, self.use_rules, self.general_group)
+        m.set('proxies', len(info.proxies))
+        m.set('proxy_groups', len(info.proxy_groups_general) + len(info.proxy_groups_other))
+        m.set('rules', len(info.rules or []))
+        return info
+
+    def download(self, store: CacheStore, timeout: int, pool: Optional[HTTPPool]) -> Tuple[Optional[MirrorAttempt], List[MirrorAttempt]]:
+        return download_hedged(store.order_mirrors(self.urls), store.tmp_dir, timeout, pool, self.hedge_delay)
+
+    def _fetch(self, store: CacheStore, dl: DynamicLoad, pool: Optional[HTTPPool], m: SubscriptionMetrics, timeout: int) -> ISubscribeReader:
+        return self._store_download(store, dl, *self.download(store, timeout, pool), m)
+
+    def _store_download(self, store: CacheStore, dl: DynamicLoad, winner: Optional[MirrorAttempt], attempts: List[MirrorAttempt], m: SubscriptionMetrics) -> ISubscribeReader:
+        # the body goes to a temporary file once, the reader parses a memory-mapped view of it and
+        # tees its cache representation into the store, which only replaces the previous version on commit
+        for attempt in attempts:
+            if attempt.cancelled:
+                continue
+            store.record_mirror(attempt.url, attempt.error is None, attempt.latency)
+            if attempt.error is not None:
+                print(f'>! mirror {attempt.url} failed after {attempt.latency:.2f}s', attempt.error)
+        if winner is None:
+            raise attempts[-1].error
+        try:
+            result = winner.result
+            print(f'># downloaded {winner.url} in {winner.latency:.2f}s' + (f' as {result.filename}' if result.filename else '') + f' ({result.size} bytes, sha256 {result.sha256[:12]})')
+            if result.encoding != 'identity':
+                print(f'># transfer {result.encoding}: {result.wire_size} bytes on wire, saved {result.size - result.wire_size} bytes (ratio {result.ratio:.1f})')
+            store.record_fetch(self.name, result.status, result.encoding, result.wire_size, result.size)
+            m.set('download_seconds', winner.latency)
+            m.set('download_wire_bytes', result.wire_size)
+            m.set('download_bytes', result.size)
+            m.set('http_status', result.status)
+            m.set('download_success', 1)
+            with open(winner.path, 'rb') as ifile_download, mmap(ifile_download.fileno(), 0, access=ACCESS_READ) as ifile, Timer() as t:
+                reader = dl.get_reader(self.type)
+                with store.writer(self.name, self.type) as ofile_cache:
+                    reader.read(ifile, False, ofile_cache)
+                    entry = ofile_cache.commit()
+            m.set('parse_seconds', t.elapsed)
+            print(f'># cached {self.name} as {entry.hash[:12]} ({entry.size} -> {entry.stored_size} bytes)')
+            return reader
+        finally:
+            remove(winner.path)
 
     def __repr__(self) -> str:
-        return f"SubscribeItem(name={self.name}, priority={self.priority}, type={self.type}, url={self.url}, file={self.file}, use_rules={self.use_rules}, general_group={self.general_group})"  
+        return f"SubscribeItem(name={self.name}, priority={self.priority}, type={self.type}, urls={self.urls}, file={self.file}, use_rules={self.use_rules}, general_group={self.general_group})"  
+
+class Refresh(object):
+    """
+    Downloads of the subscriptions, run in parallel from the start of the run. Those still running at the
+    deadline are skipped by `SubscribeItem.load`, which falls back to the cached copy; they go on in the
+    background and `finish` stores them in the cache for the next run, if they complete in time.
+    """
+
+    pool: HTTPPool
+    downloads: Dict[str, Future]    # subscription name -> download not taken yet
+    cancels: Dict[str, Event]   # subscription name -> event aborting its download
+
+    def __init__(self, sub_items: List[SubscribeItem], store: CacheStore, timeout: int, max_workers: int = 16):
+        self.pool = HTTPPool()
+        self.downloads = {}
+        self.cancels = {}
+        self._items = {item.name: item for item in sub_items}
+        self._start = monotonic()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sub_items))))
+        for item in sub_items:
+            print(f'># downloading {item.url} for {item.name} ...')
+            # mirror order is read from the store here, in the thread owning it
+            mirrors = store.order_mirrors(item.urls)
+            self.cancels[item.name] = Event()
+            self.downloads[item.name] = self._executor.submit(download_hedged, mirrors, store.tmp_dir, timeout, self.pool, item.hedge_delay, self.cancels[item.name])
+
+    def wait(self, deadline: Optional[int]) -> None:
+        """
+        Wait for every download, or until `deadline` ms after the start.
+        """
+        timeout = None if deadline is None else max(0.0, deadline / 1000.0 - (monotonic() - self._start))
+        _, not_done = wait_futures(self.downloads.values(), timeout)
+        if not_done:
+            print(f'># fetch deadline of {deadline}ms reached with {len(not_done)} downloads running')
+
+    def take(self, name: str) -> Optional[Tuple[Optional[MirrorAttempt], List[MirrorAttempt]]]:
+        future = self.downloads.get(name)
+        if future is None or not future.done():
+            return None
+        del self.downloads[name]
+        return future.result()
+
+    def finish(self, store: CacheStore, dl: DynamicLoad, timeout: Optional[float] = None) -> None:
+        """
+        Store the late downloads that complete within `timeout` seconds, and cancel the others.
+        """
+        not_done = set()
+        if self.downloads:
+            print('')
+            print(f'># waiting for {len(self.downloads)} late downloads to refresh the cache')
+            _, not_done = wait_futures(self.downloads.values(), timeout)
+        for name, future in self.downloads.items():
+            if future in not_done:
+                print(f'>! late download of {name} cancelled after {monotonic() - self._start:.1f}s')
+                self.cancels[name].set()
+                continue
+            try:
+                self._items[name]._store_download(store, dl, *future.result(), SubscriptionMetrics(name))
+                print(f'># cache of {name} refreshed after {monotonic() - self._start:.1f}s')
+            except Exception as e:
+                print(f'>! late download of {name} failed', e)
+        self.downloads.clear()
+        # the cancelled attempts stop at their next chunk, or after `timeout` ms without progress
+        self._executor.shutdown()
+        for future in not_done:
+            try:
+                winner, _ = future.result()
+                if winner is not None and winner.path is not None:
+                    remove(winner.path)
+            except Exception:
+                pass
+        if self.pool.connections_reused > 0:
+            print(f'># http connections: {self.pool.connections_opened} opened, {self.pool.connections_reused} reused')
+        self.pool.close()
 
-    def _get_valid_filename(self, network_filename: str | None) -> str:
-        return self.name #TODO implement this
 
 class VariableAction(Action):
 
@@ -139,88 +286,798 @@ class VariableAction(Action):
         _value = _type(value[value_sp+1:])
         return _name, _value
 
-if __name__ == '__main__':
-    
-    root = path.curdir
-    p = ArgumentParser(
-        prog='clash-subscribe-tool',
-        description='a simple subscribe tool for clash-core'
-    )
-    p.add_argument('--timeout', type=int, dest='timeout', default=10000)
+class Profile:
+    """
+    One output built from the shared subscriptions; unset fields take the value of the command line.
+    """
+
+    name: str
+    subscriptions: Optional[List[str]]  # None: every subscription
+    template: Optional[str]
+    target_type: Optional[str]
+    output: str
+    variables: Dict[str, Any]
+    compact: Optional[bool]
+    serializer: Optional[str]
+    rule_set_dir: Optional[str]
+
+    def __init__(self, raw: Dict, root: str):
+        self.name = raw['name']
+        self.subscriptions = raw.get('subscriptions')
+        self.template = path.join(root, raw['template']) if raw.get('template') else None
+        self.target_type = raw.get('target_type')
+        self.output = path.join(root, raw['output'])
+        self.variables = raw.get('variables') or {}
+        self.compact = raw.get('compact')
+        self.serializer = raw.get('serializer')
+        self.rule_set_dir = path.join(root, raw['rule_set_dir']) if raw.get('rule_set_dir') else None
+
+    def includes(self, subscription: str) -> bool:
+        return self.subscriptions is None or subscription in self.subscriptions
+
+    def apply(self, args: Namespace) -> Namespace:
+        values = vars(args).copy()
+        for key in ('template', 'target_type', 'output', 'compact', 'serializer', 'rule_set_dir'):
+            value = getattr(self, key)
+            if value is not None:
+                values[key] = value
+        values['variables'] = {**args.variables, **self.variables}
+        return Namespace(**values)
+
+    def __repr__(self) -> str:
+        return f"Profile(name={self.name}, subscriptions={self.subscriptions}, target_type={self.target_type}, output={self.output})"
+
+
+def load_profiles(profiles_file: str, sub_items: List[SubscribeItem]) -> List[Profile]:
+    root = path.dirname(profiles_file)
+    with open(profiles_file, 'r', encoding='utf-8') as ifile_profiles:
+        profiles = [Profile(raw, root) for raw in json_load(ifile_profiles)]
+    names = set(item.name for item in sub_items)
+    outputs = set()
+    for profile in profiles:
+        unknown = [name for name in profile.subscriptions or [] if name not in names]
+        if unknown:
+            raise ValueError(f'profile {profile.name} refers to unknown subscriptions: {", ".join(unknown)}')
+        if profile.output in outputs:
+            raise ValueError(f'profile {profile.name} writes to {profile.output} as well as another profile')
+        outputs.add(profile.output)
+    return profiles
+
+
+def add_cache_arguments(p: ArgumentParser, root: str) -> None:
     p.add_argument('-s', '--cache', dest='cache', default=path.join(root, 'cache'))
+    p.add_argument('--cache-codec', dest='cache_codec', choices=CODECS, default=CODECS[0])
+    p.add_argument('--cache-keep', dest='cache_keep', type=int, default=3)
+    p.add_argument('--cache-max-bytes', dest='cache_max_bytes', type=int, default=None)
+    p.add_argument('--cache-max-age', dest='cache_max_age', type=float, default=None, help='days')
+
+
+def add_build_arguments(p: ArgumentParser, root: str) -> None:
     p.add_argument('-T', '--template', dest='template', default=path.join(root, 'config.template.yaml'))
     p.add_argument('-K', '--target-type', dest='target_type', default='clash')
     p.add_argument('-o', '--output', dest='output', default=path.join(root, 'config.yaml'))
     p.add_argument('-D', '--variable', dest='variables', action=VariableAction, default={})
-    p.add_argument('-l', '--no-update', dest='no_update', action='store_true', default=False)
-    p.add_argument('subs_file', default=path.join(root, 'subscribe.json'), nargs='?')
-    args = p.parse_args()
+    p.add_argument('--probe', dest='probe', action='store_true', default=False, help='probe proxy latency after merging')
+    p.add_argument('--probe-tls', dest='probe_tls', action='store_true', default=False, help='include the tls handshake for tls proxies')
+    p.add_argument('--probe-timeout', dest='probe_timeout', type=int, default=3000)
+    p.add_argument('--probe-concurrency', dest='probe_concurrency', type=int, default=64)
+    p.add_argument('--probe-max-latency', dest='probe_max_latency', type=int, default=None)
+    p.add_argument('--probe-mode', dest='probe_mode', choices=(PROBE_DEMOTE, PROBE_DROP), default=PROBE_DEMOTE)
+    p.add_argument('--region-groups', dest='region_groups', choices=('url-test', 'fallback'), default=None, help='build a group per region')
+    p.add_argument('--region-url', dest='region_url', default=DEFAULT_TEST_URL)
+    p.add_argument('--region-interval', dest='region_interval', type=int, default=300)
+    p.add_argument('--region-tolerance', dest='region_tolerance', type=int, default=50)
+    p.add_argument('--region-min', dest='region_min', type=int, default=1, help='minimum proxies for a region group')
+    p.add_argument('--geo-dir', dest='geo_dir', default=None, help='directory of the geosite.dat/geoip.dat of the core, to check geo keys')
+    p.add_argument('--rule-set-dir', dest='rule_set_dir', default=None, help='where local rule sets are written; default: ruleset next to the output')
+    p.add_argument('--compact', dest='compact', action='store_true', default=False, help='write the config without indentation')
+    p.add_argument('--serializer', dest='serializer', default=None, help=f'json: {", ".join(JSON_SERIALIZERS)}; yaml: {", ".join(YAML_SERIALIZERS)}; default: the first available')
+    p.add_argument('--no-dedupe', dest='dedupe', action='store_false', default=True, help='keep proxies with the same endpoint under every name')
+    p.add_argument('--profiles', dest='profiles', default=None, help='json list of profiles (name, subscriptions, template, target_type, output, variables) rendered from one fetch')
+
+
+def resolve_paths(args) -> None:
     args.cache = path.abspath(args.cache)
     args.template = path.abspath(args.template)
     args.output = path.abspath(args.output)
     args.subs_file = path.abspath(args.subs_file)
-    print(args)
+    if args.profiles is not None:
+        args.profiles = path.abspath(args.profiles)
+
+
+def load_subscribe_items(subs_file: str) -> List[SubscribeItem]:
+    with open(subs_file, 'r', encoding='utf-8') as ifile_subs:
+        sub_items = json_load(ifile_subs)
+        return [SubscribeItem(item) for item in sub_items]
 
+
+def open_store(args, sub_items: List[SubscribeItem], threaded: bool = False) -> CacheStore:
     if not path.exists(args.cache):
         makedirs(args.cache, exist_ok=True)
-    
-    sub_items = []
-    with open(args.subs_file, 'r', encoding='utf-8') as ifile_subs:
-        sub_items = json_load(ifile_subs)
-        sub_items = [SubscribeItem(item) for item in sub_items]
-    cache_index = {}
-    cache_index_path = path.join(args.cache, 'cache.json')
-    try:
-        with open(cache_index_path, 'r', encoding='utf-8') as ifile_cache_index:
-            cache_index = json_load(ifile_cache_index)
-    except FileNotFoundError as e:
-        pass
-    except Exception as e:
-        print(f'>! failed to load cache index', e)
+    store = CacheStore(args.cache, args.cache_codec, args.cache_keep, threaded)
+    legacy_index_path = path.join(args.cache, 'cache.json')
+    if path.exists(legacy_index_path):
+        try:
+            with open(legacy_index_path, 'r', encoding='utf-8') as ifile_cache_index:
+                legacy_index = json_load(ifile_cache_index)
+            count = store.import_legacy(legacy_index, {item.name: item.type for item in sub_items})
+            remove(legacy_index_path)
+            print(f'># imported {count} entries from legacy cache index')
+        except Exception as e:
+            print(f'>! failed to import legacy cache index', e)
+    return store
 
-    print('')
-    for item in sub_items:
-        print(item)
 
+def collect_cache(store: CacheStore, args, sub_items: List[SubscribeItem]) -> GcReport:
+    max_age = args.cache_max_age * 86400 if args.cache_max_age is not None else None
+    keep_names = set(item.name for item in sub_items)
+    # rule providers are only dropped by age or size
+    keep_names.update(store.names(RULE_PROVIDER_TYPE))
+    report = store.gc(args.cache_max_bytes, max_age, keep_names)
+    if report.removed_subscriptions:
+        print(f'># cache evicted: {", ".join(report.removed_subscriptions)}')
+    print(f'># cache gc: freed {report.freed_bytes} bytes ({report.removed_versions} versions, {report.removed_blobs} blobs, {report.removed_files} stray files); {report.total_bytes} bytes in use')
+    return report
+
+
+def open_geodata(geo_dir: Optional[str]) -> Optional[GeoData]:
+    if geo_dir is None:
+        return None
+    geodata = GeoData(path.abspath(geo_dir))
+    if not geodata.available:
+        print(f'>! no geosite.dat or geoip.dat in {geodata.directory}, geo keys are not checked')
+        geodata.close()
+        return None
+    if geodata.geoip is None and geodata.has_metadb:
+        print(f'># only geoip.metadb in {geodata.directory}, GEOIP keys are not checked')
+    return geodata
+
+
+def make_dynamic_load() -> DynamicLoad:
     dl = DynamicLoad()
     dl.register_reader('clash', 'reader_clash:ClashSubscribeReader')
     dl.register_reader('subscribe', 'reader_subs:SubscribeReaderSimple')
+    dl.register_reader('singbox', 'reader_singbox:SingboxSubscribeReader')
     dl.register_writer('clash', 'writer_clash:ClashConfigWriter')
     dl.register_writer('singbox', 'writer_singbox:SingboxConfigWriter')
+    return dl
+
 
+def load_infos(sub_items: List[SubscribeItem], store: CacheStore, dl: DynamicLoad, timeout: int, no_update: bool, metrics: Optional[RunMetrics] = None, refresh: Optional[Refresh] = None) -> List[Info]:
     data = []
-    for item in sub_items:
-        if item.ignore:
-            continue
+    # with a refresh, the downloads already run on its own pool
+    with HTTPPool() if refresh is None else nullcontext() as pool:
+        for item in sub_items:
+            if item.ignore:
+                continue
+            print('')
+            with collector.scope(item.name):
+                info = item.load(store, dl, timeout, no_update, pool, metrics.subscription(item.name) if metrics is not None else None, refresh)
+            if info is None:
+                continue
+            print(f"># modify {item.name}")
+            info.modify_by_name(item.name)
+            data.append(info)
+        if pool is not None and pool.connections_reused > 0:
+            print(f'># http connections: {pool.connections_opened} opened, {pool.connections_reused} reused')
+    return data
+
+
+def resolve_rule_providers(targets: List[Any], data: List[Info], store: CacheStore, dl: DynamicLoad, timeout: int, no_update: bool, metrics: Optional[RunMetrics] = None) -> RuleProviders:
+    """
+    Collect the rule providers of the configs to write (`targets` are the args of each of them): those their
+    template declares and those of the subscriptions the rules refer to; then fetch them once for all.
+    """
+    providers = RuleProviders()
+    names = set()
+    for info in data:
+        providers.specs.update(info.rule_providers)
+        if info.use_rules and info.rules:
+            names.update(rule_set_names(info.rules))
+    for target in targets:
+        home_dir = path.dirname(target.output)
+        for name in sorted(names):
+            spec = providers.spec(name)
+            if spec is not None:
+                providers.add(name, spec, home_dir)
+        writer = dl.get_writer(target.target_type)
+        try:
+            with open(target.template, 'rb') as ifile_template:
+                writer.template(ifile_template)
+            for name, spec in writer.rule_providers(**target.variables).items():
+                providers.add(name, spec, home_dir)
+        except Exception as e:
+            print(f'>! failed to read the rule providers of {target.template}', e)
+    if len(providers.providers) > 0:
         print('')
-        info = item.load(args.cache, dl, args.timeout, args.no_update, cache_index)
-        if info is None:
-            continue
-        print(f"># modify {item.name}")
-        info.modify_by_name(item.name)
-        data.append(info)
+        print(f'># resolving {len(providers.providers)} rule providers ...')
+        with collector.scope('rule-providers'):
+            providers.resolve(store, timeout, no_update)
+        failed = len(providers.providers) - providers.resolved
+        print(f'># rule providers: {providers.resolved} resolved' + (f', {failed} left to the core' if failed else ''))
+        if metrics is not None:
+            metrics.set('rule_providers', providers.resolved)
+            metrics.set('rule_providers_failed', failed)
+    return providers
 
+
+def main_update(argv: List[str]) -> None:
+    root = path.curdir
+    p = ArgumentParser(
+        prog='clash-subscribe-tool',
+        description='a simple subscribe tool for clash-core'
+    )
+    p.add_argument('--timeout', type=int, dest='timeout', default=10000, help='ms without progress before a download fails')
+    p.add_argument('--deadline', type=int, dest='deadline', default=None, help='ms for the downloads of the run; later ones use the cache and refresh it when they complete')
+    add_cache_arguments(p, root)
+    add_build_arguments(p, root)
+    p.add_argument('-l', '--no-update', dest='no_update', action='store_true', default=False)
+    p.add_argument('--metrics-file', dest='metrics_file', default=None, help='node_exporter textfile collector file (*.prom) written at the end of the run')
+    p.add_argument('--diagnostics-file', dest='diagnostics_file', default=None, help='json file with every issue category, its count and samples')
+    p.add_argument('--workers', dest='workers', type=int, default=None, help='processes rendering the profiles; default: the number of cpus')
+    p.add_argument('--reload', dest='reload', action='store_true', default=False, help='hot reload the running core through its controller when the config changed')
+    p.add_argument('--controller', dest='controller', default=None, help='controller address; default: external-controller of the generated config')
+    p.add_argument('--controller-secret', dest='controller_secret', default=None, help='default: secret of the generated config')
+    p.add_argument('--controller-wait', dest='controller_wait', type=float, default=30, help='seconds to wait for the controller of a starting core')
+    p.add_argument('--warmup', dest='warmup', action='store_true', default=False, help='after a reload, restore the choices of select groups and run the delay tests of url-test groups')
+    p.add_argument('--warmup-url', dest='warmup_url', default=DEFAULT_TEST_URL)
+    p.add_argument('--warmup-timeout', dest='warmup_timeout', type=int, default=5000, help='ms for a delay test')
+    p.add_argument('--warmup-concurrency', dest='warmup_concurrency', type=int, default=8, help='groups tested at once')
+    p.add_argument('subs_file', default=path.join(root, 'subscribe.json'), nargs='?')
+    args = p.parse_args(argv)
+    resolve_paths(args)
+    print(args)
+
+    metrics = RunMetrics()
+    failed = 0
     try:
-        with open(cache_index_path, 'w', encoding='utf-8') as ofile_cache_index:
-            json_dump(cache_index, ofile_cache_index, indent=4)
-    except Exception as e:
-        print(f'>! failed to save cache index', e)
+        failed = run_update(args, metrics)
+    finally:
+        print('')
+        collector.print_summary()
+        if args.diagnostics_file is not None:
+            try:
+                collector.dump(args.diagnostics_file)
+                print(f'># diagnostics written to {args.diagnostics_file}')
+            except Exception as e:
+                print(f'>! failed to write diagnostics', e)
+        metrics.set_issues(collector.by_category())
+        if args.metrics_file is not None:
+            try:
+                metrics.write_textfile(args.metrics_file)
+                print(f'># metrics written to {args.metrics_file}')
+            except Exception as e:
+                print(f'>! failed to write metrics', e)
+    if failed:
+        exit(1)
 
-    del sub_items
+
+def run_update(args, metrics: RunMetrics) -> int:
+    """
+    Returns the number of profiles that failed; a failure of the single config raises.
+    """
+    sub_items = load_subscribe_items(args.subs_file)
+    profiles = load_profiles(args.profiles, sub_items) if args.profiles is not None else None
+    store = open_store(args, sub_items)
 
     print('')
-    ROOT = ''
-    proxies, proxy_groups, rules = merge(data)
+    for item in sub_items:
+        print(item)
+
+    # subscriptions no profile refers to are not downloaded
+    load_items = sub_items
+    if profiles is not None:
+        load_items = [item for item in sub_items if any(profile.includes(item.name) for profile in profiles)]
+
+    dl = make_dynamic_load()
+    refresh = None
+    failed = 0
+    if not args.no_update:
+        print('')
+        refresh = Refresh([item for item in load_items if item.url and not item.ignore], store, args.timeout)
+    try:
+        with Timer() as t:
+            if refresh is not None:
+                refresh.wait(args.deadline)
+            data = load_infos(load_items, store, dl, args.timeout, args.no_update, metrics, refresh)
+        metrics.set('load_seconds', t.elapsed)
+
+        targets = [args] if profiles is None else [profile.apply(args) for profile in profiles]
+        providers = resolve_rule_providers(targets, data, store, dl, args.timeout, args.no_update, metrics)
+        geodata = open_geodata(args.geo_dir)
+        try:
+            if profiles is None:
+                proxies, proxy_groups, rules = build_config(args, data, geodata, None, metrics)
+                changed = write_config(args, dl, geodata, proxies, proxy_groups, rules, metrics, providers)
+                if args.reload:
+                    print('')
+                    if changed:
+                        reload_core(args, NameMap(data, proxies, proxy_groups) if args.warmup else None)
+                    else:
+                        print('># core not reloaded, the config is the same')
+            else:
+                if args.reload:
+                    print('>! --reload is ignored with --profiles')
+                failed = run_profiles(args, profiles, data, geodata, metrics, providers)
+        finally:
+            if geodata is not None:
+                geodata.close()
+    finally:
+        # the cache is refreshed by late downloads before it is collected
+        if refresh is not None:
+            # late downloads get another deadline at most
+            refresh.finish(store, dl, args.deadline / 1000.0 if args.deadline is not None else None)
+
+    print('')
+    collect_cache(store, args, sub_items)
+    store.close()
+    return failed
+
+
+def probe(args, proxies: List[Proxy]) -> Dict[str, ProbeResult]:
+    print('')
+    print(f'># probing {len(proxies)} proxies ...')
+    return probe_proxies(proxies, args.probe_concurrency, args.probe_timeout, args.probe_tls)
+
+
+def build_config(args, data: List[Info], geodata: Optional[GeoData], probe_results: Optional[Dict[str, ProbeResult]], metrics: RunMetrics) -> Tuple[List[Proxy], List[ProxyGroup], List[Rule]]:
+    print('')
+    with Timer() as t:
+        proxies, proxy_groups, rules = merge(data)
+    metrics.set('merge_seconds', t.elapsed)
     print(f'># merged into: proxies[{len(proxies)}], proxy_groups[{len(proxy_groups)}], rules[{len(rules)}]')
 
+    if args.dedupe:
+        proxies, rules, report = dedupe_proxies(data, proxies, proxy_groups, rules)
+        metrics.set('proxies_duplicate', report.removed)
+        if report.removed > 0:
+            print(f'># deduplicated proxies: {report.proxies} -> {len(proxies)} ({report.removed / report.proxies:.0%} fewer endpoints for the core to check and connect)')
+            for (removed_from, kept_in), n in sorted(report.sources.items(), key=lambda x: -x[1]):
+                print(f'>#   {n:>6}  of {removed_from} kept in {kept_in}')
+
+    if geodata is not None:
+        count = len(rules)
+        rules = geodata.validate(rules)
+        metrics.set('rules_invalid', count - len(rules))
+
+    if args.probe:
+        results = probe_results if probe_results is not None else probe(args, proxies)
+        proxies, bad = apply_probe(proxies, proxy_groups, results, args.probe_max_latency, args.probe_mode)
+        if args.probe_mode == PROBE_DROP and bad:
+            rules = drop_rules(rules, bad - set(p.name for p in proxies))
+        measured = [r.latency for r in results.values() if r.latency is not None]
+        print(f'># probed: {len(measured)} reachable, {len(bad)} {args.probe_mode}d' + (f', median {sorted(measured)[len(measured) // 2]:.0f}ms' if measured else ''))
+
+    if args.region_groups is not None:
+        region_groups = make_region_groups(proxies, args.region_groups, args.region_url, args.region_interval, args.region_tolerance, args.region_min)
+        add_region_groups(proxy_groups, region_groups)
+        summary = ', '.join(f"{g.name}[{len(g.inner['proxies'])}]" for g in region_groups)
+        print(f'># region groups: {summary}')
+    return proxies, proxy_groups, rules
+
+
+def render_config(args, dl: DynamicLoad, geodata: Optional[GeoData], proxies: List[Proxy], proxy_groups: List[ProxyGroup], rules: List[Rule], ofile: BinaryIO, metrics: RunMetrics, providers: Optional[RuleProviders] = None) -> None:
     print('')
     writer = dl.get_writer(args.target_type)
     print(f'># writer: {args.target_type}')
+    rule_set_dir = path.abspath(args.rule_set_dir) if args.rule_set_dir is not None else path.join(path.dirname(args.output), 'ruleset')
+    writer.configure(geodata=geodata, rule_set_dir=rule_set_dir, pretty=not args.compact, serializer=args.serializer, rule_providers=providers, home_dir=path.dirname(args.output))
     with open(args.template, 'rb') as ifile_template:
         writer.template(ifile_template)
         print(f'># template loaded from {args.template}')
-    with open(args.output, 'wb') as ofile:
+    metrics.set('proxies', len(proxies))
+    metrics.set('proxy_groups', len(proxy_groups))
+    metrics.set('rules', len(rules))
+    source = f'writer:{args.target_type}'
+    if collector.source:
+        source = f'{collector.source}/{source}'
+    with Timer() as t, collector.scope(source):
         writer.write(ofile, proxies, proxy_groups, rules, **args.variables)
-        print(f'># config written to {args.output}')
+    metrics.set('write_seconds', t.elapsed)
+    metrics.set('rules_dropped', writer.dropped_rules)
+
+
+def write_config(args, dl: DynamicLoad, geodata: Optional[GeoData], proxies: List[Proxy], proxy_groups: List[ProxyGroup], rules: List[Rule], metrics: RunMetrics, providers: Optional[RuleProviders] = None) -> bool:
+    """
+    Render into a temporary file next to the output and swap it in, so the core never reads a partial config
+    and the last good one stays in place on failure. Returns False when the config did not change. A merge
+    without any proxy (every subscription failed, say) is a failure too: the core is left on the last config.
+    """
+    if not proxies:
+        raise ValueError(f'no proxies in the merged config; {args.output} is kept')
+    tmp_output = path.join(path.dirname(args.output), f'.{path.basename(args.output)}.tmp')
+    try:
+        with open(tmp_output, 'wb') as ofile:
+            render_config(args, dl, geodata, proxies, proxy_groups, rules, ofile, metrics, providers)
+        changed = not (path.exists(args.output) and filecmp.cmp(tmp_output, args.output, shallow=False))
+        if changed:
+            replace(tmp_output, args.output)
+            print(f'># config written to {args.output}')
+        else:
+            print(f'># config unchanged: {args.output}')
+    finally:
+        if path.exists(tmp_output):
+            remove(tmp_output)
+    metrics.set('output_bytes', path.getsize(args.output))
+    metrics.set('success', 1)
+    return changed
+
+
+def reload_core(args, names: Optional[NameMap] = None) -> None:
+    if args.target_type != 'clash':
+        print(f'>! hot reload is only supported for clash configs, not {args.target_type}')
+        return
+    if args.controller is not None:
+        controller = Controller(args.controller, args.controller_secret or '')
+    else:
+        controller = Controller.from_config(args.output)
+        if controller is None:
+            print(f'>! no external-controller in {args.output}, core not reloaded')
+            return
+        if args.controller_secret is not None:
+            controller.secret = args.controller_secret
+    try:
+        version = controller.wait_ready(args.controller_wait)
+        previous = None
+        if args.warmup:
+            try:
+                previous = controller.selections()
+            except Exception as e:
+                print(f'>! failed to read the selections of the core', e)
+        controller.reload(args.output)
+        print(f'># core {version} reloaded through {controller.url}')
+        if args.warmup:
+            warm_up(args, controller, previous, names)
+    except Exception as e:
+        print(f'>! failed to reload the core through {controller.url}', e)
+    finally:
+        controller.close()
+
+
+def warm_up(args, controller: Controller, previous: Optional[Dict[str, str]], names: Optional[NameMap]) -> None:
+    """
+    Bring back the choices of the select groups, whose names may have changed with the config, and test the
+    url-test groups now instead of at their first interval.
+    """
+    report = WarmupReport()
+    with Timer() as t:
+        try:
+            if previous and names is not None:
+                restore_selections(controller, previous, names.resolve, report)
+            test_group_delays(controller, args.warmup_url, args.warmup_timeout, args.warmup_concurrency, report)
+        except Exception as e:
+            print(f'>! warmup failed', e)
+            return
+    print(f'># warmed up in {t.elapsed:.1f}s: {len(report.restored)} selections restored, {len(report.delays)} groups tested')
+    for group, choice, new_choice in report.restored:
+        if new_choice != choice:
+            print(f'>#   {group}: {choice} -> {new_choice}')
+    for group, choice in report.lost:
+        print(f'>! selection {choice} of {group} has no counterpart in the new config')
+    for group, delays in report.delays.items():
+        best = f', best {min(delays.values())}ms' if delays else ''
+        print(f'>#   {group}: {len(delays)} alive{best}')
+    for group, error in report.failed.items():
+        print(f'>! delay test of {group} failed', error)
+
+
+class ProfileResult(object):
+
+    name: str
+    output: str
+    values: Dict[str, float]   # run metrics of the profile
+    error: Optional[str]
+    log: str
+    issues: list    # `Diagnostics.snapshot` when rendered in a worker process
+
+    def __init__(self, name: str, output: str):
+        self.name = name
+        self.output = output
+        self.values = {}
+        self.error = None
+        self.log = ''
+        self.issues = []
+
+
+# (args, profiles, infos, geodata, probe results, rule providers); set before the worker processes are forked, which inherit
+# the parsed subscriptions instead of receiving them pickled
+_fanout: Optional[Tuple] = None
+
+
+def render_profile(index: int, isolated: bool) -> ProfileResult:
+    args, profiles, data, geodata, probe_results, providers = _fanout
+    profile: Profile = profiles[index]
+    profile_args = profile.apply(args)
+    result = ProfileResult(profile.name, profile_args.output)
+    metrics = RunMetrics()
+    if isolated:
+        # the collector was inherited with the issues of the parent
+        collector.clear()
+    log = StringIO()
+    try:
+        with redirect_stdout(log), collector.scope(profile.name):
+            profile_data = [info.copy() for info in data if profile.includes(info.name)]
+            proxies, proxy_groups, rules = build_config(profile_args, profile_data, geodata, probe_results, metrics)
+            write_config(profile_args, make_dynamic_load(), geodata, proxies, proxy_groups, rules, metrics, providers)
+    except Exception as e:
+        result.error = f'{type(e).__name__}: {e}'
+    result.values = metrics.values
+    result.log = log.getvalue()
+    if isolated:
+        result.issues = collector.snapshot()
+    return result
+
+
+def run_profiles(args, profiles: List[Profile], data: List[Info], geodata: Optional[GeoData], metrics: RunMetrics, providers: Optional[RuleProviders] = None) -> int:
+    global _fanout
+    probe_results = None
+    if args.probe:
+        # every proxy is probed once, whatever the number of profiles using it
+        proxies: Dict[str, Proxy] = {}
+        for info in data:
+            for p in info.proxies.values():
+                proxies.setdefault(p.name, p)
+        probe_results = probe(args, list(proxies.values()))
+    workers = min(args.workers or cpu_count() or 1, len(profiles))
+    isolated = workers > 1 and 'fork' in get_all_start_methods()
+    print('')
+    print(f'># rendering {len(profiles)} profiles' + (f' in {workers} processes' if isolated else ''))
+    _fanout = (args, profiles, data, geodata, probe_results, providers)
+    try:
+        with Timer() as t:
+            if isolated:
+                with ProcessPoolExecutor(workers, mp_context=get_context('fork')) as executor:
+                    results = list(executor.map(render_profile, range(len(profiles)), repeat(True)))
+            else:
+                results = [render_profile(i, False) for i in range(len(profiles))]
+    finally:
+        _fanout = None
+
+    failed = 0
+    for result in results:
+        print('')
+        print(f'># profile {result.name}')
+        print(result.log, end='')
+        collector.absorb(result.issues)
+        if result.error is not None:
+            print(f'>! profile {result.name} failed', result.error)
+            failed += 1
+    print('')
+    print(f'># {len(profiles) - failed} of {len(profiles)} profiles written in {t.elapsed:.2f}s')
+    for key in ('rules_invalid', 'rules_dropped', 'output_bytes'):
+        metrics.set(key, sum(result.values.get(key, 0) for result in results))
+    metrics.set('write_seconds', t.elapsed)
+    metrics.set('profiles', len(profiles))
+    metrics.set('profiles_failed', failed)
+    metrics.set('success', 1 if failed == 0 else 0)
+    return failed
 
-    pass
+
+def main_gc(argv: List[str]) -> None:
+    root = path.curdir
+    p = ArgumentParser(
+        prog='clash-subscribe-tool gc',
+        description='apply the cache retention policy and report what was reclaimed'
+    )
+    add_cache_arguments(p, root)
+    p.add_argument('subs_file', default=path.join(root, 'subscribe.json'), nargs='?')
+    args = p.parse_args(argv)
+    args.cache = path.abspath(args.cache)
+    args.subs_file = path.abspath(args.subs_file)
+    sub_items = load_subscribe_items(args.subs_file)
+    store = open_store(args, sub_items)
+    try:
+        collect_cache(store, args, sub_items)
+    finally:
+        store.close()
+
+
+def main_query(argv: List[str]) -> None:
+    root = path.curdir
+    p = ArgumentParser(
+        prog='clash-subscribe-tool query',
+        description='report the first rule matching every domain or ip of a file, without running the core'
+    )
+    add_cache_arguments(p, root)
+    p.add_argument('-c', '--config', dest='config', default=None, help='take the rules of a generated clash config instead of the cached subscriptions')
+    p.add_argument('-i', '--input', dest='input', default='-', help='one query per line: a domain and/or an ip, optionally a port and tcp/udp')
+    p.add_argument('-o', '--output', dest='output', default='-')
+    p.add_argument('--geo-dir', dest='geo_dir', default=None, help='directory of the geosite.dat/geoip.dat of the core, to evaluate geo rules')
+    p.add_argument('subs_file', default=path.join(root, 'subscribe.json'), nargs='?')
+    args = p.parse_args(argv)
+
+    # progress goes to stderr, stdout may carry the results
+    with redirect_stdout(stderr):
+        if args.config is not None:
+            with open(args.config, 'rb') as ifile_config:
+                reader = ClashSubscribeReader()
+                reader.read(ifile_config, True, None)
+            rules = Info(reader, 'config', 0, True).rules or []
+        else:
+            args.cache = path.abspath(args.cache)
+            sub_items = load_subscribe_items(path.abspath(args.subs_file))
+            store = open_store(args, sub_items)
+            try:
+                _, _, rules = merge(load_infos(sub_items, store, make_dynamic_load(), 0, True))
+            finally:
+                store.close()
+        geodata = open_geodata(args.geo_dir)
+
+    start = perf_counter()
+    matcher = RuleMatcher(rules, geodata)
+    print(f'># indexed {len(rules)} rules in {perf_counter() - start:.2f}s', file=stderr)
+
+    count = 0
+    undecided = 0
+    strategies: Dict[str, int] = {}
+    start = perf_counter()
+    ifile = stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8', errors='replace')
+    ofile = stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        for q, result in query_lines(matcher, ifile):
+            strategy = result.strategy or '-'
+            line = f'{q.raw}\t{strategy}\t{result.rule.raw if result.rule is not None else "-"}'
+            if result.undecided is not None:
+                line += f'\t?{result.undecided.raw}'
+                undecided += 1
+            ofile.write(line + '\n')
+            count += 1
+            strategies[strategy] = strategies.get(strategy, 0) + 1
+    finally:
+        if ifile is not stdin:
+            ifile.close()
+        if ofile is not stdout:
+            ofile.close()
+    elapsed = perf_counter() - start
+    print(f'># matched {count} queries in {elapsed:.2f}s; {undecided} depend on rules undecidable offline', file=stderr)
+    for strategy, n in sorted(strategies.items(), key=lambda x: -x[1]):
+        print(f'># {n:>10}  {strategy}', file=stderr)
+    collector.print_summary(stderr)
+    if geodata is not None:
+        geodata.close()
+
+
+CONTENT_TYPES = {
+    'clash': 'text/yaml; charset=utf-8',
+    'singbox': 'application/json',
+}
+
+
+class ProfileRenderer(IConfigRenderer):
+    """
+    Renders the profiles of `serve` from the cached subscriptions; no download happens on request. A parsed
+    subscription is kept until its cache entry (or file) changes, and every render merges copies of it.
+    """
+
+    args: Namespace
+    profiles: Dict[str, Profile]
+    sub_items: List[SubscribeItem]
+    store: CacheStore
+    geodata: Optional[GeoData]
+
+    def __init__(self, args, profiles: List[Profile], sub_items: List[SubscribeItem], store: CacheStore, geodata: Optional[GeoData]):
+        self.args = args
+        self.profiles = {profile.name: profile for profile in profiles}
+        self.sub_items = [item for item in sub_items if not item.ignore]
+        self.store = store
+        self.geodata = geodata
+        self._profile_args = {profile.name: profile.apply(args) for profile in profiles}
+        self._dl = make_dynamic_load()
+        self._lock = Lock()     # guards the store and the parsed subscriptions
+        self._infos: Dict[str, Tuple[str, Optional[Info]]] = {}    # subscription name -> (source, parsed)
+
+    def names(self) -> List[str]:
+        return list(self.profiles)
+
+    def _source(self, item: SubscribeItem) -> str:
+        # with self._lock; what `SubscribeItem.load` would read without updating
+        if item.file:
+            try:
+                st = stat(item.file)
+                return f'file:{st.st_mtime_ns}:{st.st_size}'
+            except OSError:
+                return 'file:-'
+        entry = self.store.latest(item.name)
+        return f'cache:{entry.hash}' if entry is not None else 'cache:-'
+
+    def fingerprint(self, name: str) -> str:
+        profile = self.profiles[name]
+        profile_args = self._profile_args[name]
+        st = stat(profile_args.template)
+        parts = [repr(sorted(vars(profile_args).items())), f'template:{st.st_mtime_ns}:{st.st_size}']
+        with self._lock:
+            for item in self.sub_items:
+                if profile.includes(item.name):
+                    parts.append(f'{item.name}={self._source(item)}')
+            for provider_name in self.store.names(RULE_PROVIDER_TYPE):
+                entry = self.store.latest(provider_name)
+                parts.append(f'{provider_name}={entry.hash if entry is not None else "-"}')
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def _info(self, item: SubscribeItem) -> Optional[Info]:
+        # with self._lock
+        source = self._source(item)
+        cached = self._infos.get(item.name)
+        if cached is not None and cached[0] == source:
+            return cached[1]
+        with collector.scope(item.name):
+            info = item.load(self.store, self._dl, 0, True)
+        if info is not None:
+            info.modify_by_name(item.name)
+        self._infos[item.name] = (source, info)
+        return info
+
+    def render(self, name: str) -> Tuple[bytes, str]:
+        profile = self.profiles[name]
+        profile_args = self._profile_args[name]
+        start = perf_counter()
+        metrics = RunMetrics()
+        with self._lock:
+            infos = [self._info(item) for item in self.sub_items if profile.includes(item.name)]
+            infos = [info for info in infos if info is not None]
+            # from the cache only, refreshed by the update timer
+            providers = resolve_rule_providers([profile_args], infos, self.store, self._dl, 0, True, metrics)
+        data = [info.copy() for info in infos]
+        ofile = BytesIO()
+        with collector.scope(name):
+            proxies, proxy_groups, rules = build_config(profile_args, data, self.geodata, None, metrics)
+            render_config(profile_args, self._dl, self.geodata, proxies, proxy_groups, rules, ofile, metrics, providers)
+        body = ofile.getvalue()
+        print(f'># rendered {name}: {len(body)} bytes in {(perf_counter() - start) * 1000:.0f}ms')
+        return body, CONTENT_TYPES.get(profile_args.target_type, 'application/octet-stream')
+
+
+def main_serve(argv: List[str]) -> None:
+    root = path.curdir
+    p = ArgumentParser(
+        prog='clash-subscribe-tool serve',
+        description='serve the config of every profile over http, rendered on request from the cached subscriptions'
+    )
+    add_cache_arguments(p, root)
+    add_build_arguments(p, root)
+    p.add_argument('--host', dest='host', default='127.0.0.1')
+    p.add_argument('--port', dest='port', type=int, default=8090)
+    p.add_argument('--render-concurrency', dest='render_concurrency', type=int, default=2)
+    p.add_argument('--cache-entries', dest='cache_entries', type=int, default=32, help='rendered configs kept in memory')
+    p.add_argument('subs_file', default=path.join(root, 'subscribe.json'), nargs='?')
+    args = p.parse_args(argv)
+    resolve_paths(args)
+    # long running: the log should reach the journal as it is written
+    stdout.reconfigure(line_buffering=True)
+
+    sub_items = load_subscribe_items(args.subs_file)
+    if args.profiles is not None:
+        profiles = load_profiles(args.profiles, sub_items)
+    else:
+        # the command line options make up a single profile named after the output
+        profiles = [Profile({'name': path.splitext(path.basename(args.output))[0], 'output': args.output}, root)]
+    store = open_store(args, sub_items, threaded=True)
+    geodata = open_geodata(args.geo_dir)
+    server = ConfigServer((args.host, args.port), ProfileRenderer(args, profiles, sub_items, store, geodata), args.render_concurrency, args.cache_entries)
+    print(f'># serving {", ".join(profile.name for profile in profiles)} on http://{args.host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'># {server.renders} renders')
+        if geodata is not None:
+            geodata.close()
+        store.close()
+
+
+MAIN_COMMANDS = {
+    'gc': main_gc,
+    'query': main_query,
+    'serve': main_serve,
+}
+
+if __name__ == '__main__':
+    from sys import argv
+    args = argv[1:]
+    command = MAIN_COMMANDS.get(args[0]) if len(args) > 0 else None
+    if command is None:
+        main_update(args)
+    else:
+        command(args[1:])
@@ -0,0 +1,472 @@
+import re
+from array import array
+from bisect import bisect_right
+from fnmatch import translate as fnmatch_translate
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from data import LOGICAL_RULE_TYPES, Condition, Rule, RuleType
+from diagnostics import UNINDEXED_RULE, collector
+from geodata import GEOSITE_RULE_TYPES, GeoData
+
+IPAddress = Union[IPv4Address, IPv6Address]
+
+# what a query carries; a rule depending on something the query lacks is undecided
+HAS_HOST = 1
+HAS_IP = 2
+HAS_PORT = 4
+HAS_NETWORK = 8
+QUERY_MASKS = range(16)
+
+NO_MATCH = 1 << 62
+
+HOST_RULE_TYPES = (RuleType.DOMAIN, RuleType.DOMAIN_SUFFIX, RuleType.DOMAIN_KEYWORD, RuleType.DOMAIN_WILDCARD, RuleType.DOMAIN_REGEX)
+IP_RULE_TYPES = (RuleType.IP_CIDR, RuleType.IP_CIDR6)
+# need data that is not available offline (geo databases, asn, rule providers, the source of the connection)
+OPAQUE_HOST_RULE_TYPES = (RuleType.GEOSITE,)
+OPAQUE_IP_RULE_TYPES = (RuleType.GEOIP, RuleType.IP_ASN)
+
+# tri-state predicate: True, False, or None when it cannot be decided offline
+Predicate = Callable[['Query'], Optional[bool]]
+
+
+class Query(object):
+
+    __slots__ = ('raw', 'host', 'ip', 'port', 'network', 'mask')
+
+    raw: str
+    host: Optional[str]
+    ip: Optional[IPAddress]
+    port: Optional[int]
+    network: Optional[str]
+    mask: int
+
+    def __init__(self, raw: str, host: Optional[str] = None, ip: Optional[IPAddress] = None, port: Optional[int] = None, network: Optional[str] = None):
+        self.raw = raw
+        self.host = host
+        self.ip = ip
+        self.port = port
+        self.network = network
+        self.mask = (HAS_HOST if host else 0) | (HAS_IP if ip is not None else 0) | (HAS_PORT if port is not None else 0) | (HAS_NETWORK if network else 0)
+
+    @classmethod
+    def parse(cls, line: str) -> 'Query':
+        """
+        Parse a line of whitespace separated tokens: a domain and/or an ip, optionally a port and `tcp`/`udp`.
+        """
+        host = ip = port = network = None
+        for token in line.split():
+            lower = token.lower()
+            if lower == 'tcp' or lower == 'udp':
+                network = lower
+            elif token.isdigit():
+                port = int(token)
+            elif ':' in token or token[-1].isdigit():
+                try:
+                    ip = ip_address(token.strip('[]'))
+                except ValueError:
+                    host = lower.rstrip('.')
+            else:
+                host = lower.rstrip('.')
+        return cls(line.strip(), host, ip, port, network)
+
+
+class MatchResult(object):
+
+    __slots__ = ('rule', 'undecided')
+
+    rule: Optional[Rule]        # first rule known to match
+    undecided: Optional[Rule]   # first rule before it whose outcome is unknown offline
+
+    def __init__(self, rule: Optional[Rule], undecided: Optional[Rule]):
+        self.rule = rule
+        self.undecided = undecided
+
+    @property
+    def strategy(self) -> Optional[str]:
+        return self.rule.strategy if self.rule is not None else None
+
+
+class _SuffixTrie(object):
+    """
+    Trie over reversed domain labels; every node keeps the first rule index of the `DOMAIN` and
+    `DOMAIN-SUFFIX` rules ending there, so a lookup walks the labels of the queried domain once.
+    """
+
+    def __init__(self):
+        self._root: Dict = {}
+
+    def add(self, domain: str, index: int, suffix: bool) -> None:
+        node = self._root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        key = '' if suffix else '.'     # labels are never empty, so these cannot clash with a child
+        if index < node.get(key, NO_MATCH):
+            node[key] = index
+
+    def lookup(self, domain: str) -> int:
+        best = NO_MATCH
+        node = self._root
+        labels = domain.split('.')
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return best
+            suffix = node.get('')
+            if suffix is not None and suffix < best:
+                best = suffix
+        exact = node.get('.')
+        if exact is not None and exact < best:
+            best = exact
+        return best
+
+
+class _KeywordAutomaton(object):
+    """
+    Aho-Corasick automaton over the `DOMAIN-KEYWORD` payloads; `_best[state]` is the first rule index
+    among the keywords ending in that state or any of its suffix states.
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._best: List[int] = [NO_MATCH]
+
+    def add(self, keyword: str, index: int) -> None:
+        state = 0
+        for c in keyword:
+            nxt = self._goto[state].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(NO_MATCH)
+            state = nxt
+        if index < self._best[state]:
+            self._best[state] = index
+
+    def build(self) -> None:
+        goto, fail, best = self._goto, self._fail, self._best
+        queue = list(goto[0].values())
+        for state in queue:
+            for c, nxt in goto[state].items():
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0) if state else 0
+                fail[nxt] = f if f != nxt else 0
+                if best[fail[nxt]] < best[nxt]:
+                    best[nxt] = best[fail[nxt]]
+                queue.append(nxt)
+
+    def lookup(self, text: str) -> int:
+        goto, fail, best = self._goto, self._fail, self._best
+        result = NO_MATCH
+        state = 0
+        for c in text:
+            nxt = goto[state].get(c)
+            while nxt is None and state:
+                state = fail[state]
+                nxt = goto[state].get(c)
+            state = nxt if nxt is not None else 0
+            if best[state] < result:
+                result = best[state]
+        return result
+
+
+class _IntervalTable(object):
+    """
+    Sorted table of disjoint address intervals, each holding the first rule index of the networks covering it.
+    Networks are either nested or disjoint, so a sweep with a stack of the open networks builds it in O(n log n).
+    """
+
+    def __init__(self):
+        self._networks: Dict[Tuple[int, int], int] = {}
+        self._starts: List[int] = []
+        self._values: List[int] = []
+
+    def add(self, first: int, last: int, index: int) -> None:
+        key = (first, last)
+        if index < self._networks.get(key, NO_MATCH):
+            self._networks[key] = index
+
+    def build(self) -> None:
+        starts, values = [], []
+
+        def emit(pos: int, value: int) -> None:
+            if starts and starts[-1] == pos:
+                values[-1] = value
+                if len(values) > 1 and values[-2] == value:
+                    starts.pop()
+                    values.pop()
+            elif not values or values[-1] != value:
+                starts.append(pos)
+                values.append(value)
+
+        stack: List[Tuple[int, int]] = []   # (last address, value)
+        for (first, last), index in sorted(self._networks.items(), key=lambda x: (x[0][0], -x[0][1])):
+            while stack and stack[-1][0] < first:
+                end, _ = stack.pop()
+                emit(end + 1, stack[-1][1] if stack else NO_MATCH)
+            value = min(index, stack[-1][1]) if stack else index
+            emit(first, value)
+            stack.append((last, value))
+        while stack:
+            end, _ = stack.pop()
+            emit(end + 1, stack[-1][1] if stack else NO_MATCH)
+        self._starts = starts
+        self._values = values
+        self._networks = {}
+
+    def lookup(self, address: int) -> int:
+        pos = bisect_right(self._starts, address) - 1
+        return self._values[pos] if pos >= 0 else NO_MATCH
+
+
+def _parse_ports(payload: str) -> List[Tuple[int, int]]:
+    ranges = []
+    for part in payload.split('/'):
+        lo, _, hi = part.strip().partition('-')
+        ranges.append((int(lo), int(hi) if hi else int(lo)))
+    return ranges
+
+
+def _suffix_matcher(payload: str) -> Callable[[IPAddress], bool]:
+    # IP-SUFFIX,8.8.8.8/24 matches the last 24 bits of the address
+    network = ip_network(payload, strict=False)
+    bits = network.max_prefixlen
+    mask = (1 << network.prefixlen) - 1
+    value = int(ip_address(payload.split('/')[0])) & mask
+    return lambda ip: ip.max_prefixlen == bits and (int(ip) & mask) == value
+
+
+class RuleMatcher(object):
+    """
+    Answer which rule the core would pick first for a domain or an ip, without running the core.
+
+    `DOMAIN`/`DOMAIN-SUFFIX` go to a reversed-label trie, `DOMAIN-KEYWORD` to an Aho-Corasick automaton,
+    `IP-CIDR`/`IP-CIDR6` to sorted interval tables, `DST-PORT` to a port table and `NETWORK` to a map;
+    each index returns the first rule index it matches, and the smallest one wins. The remaining rules
+    (regex, wildcard, logical, sub-rules, geo data...) are evaluated in order, only up to the best index found.
+
+    Rules needing data that is not available offline (geo databases, asn, rule providers, dns resolution of
+    ip rules without `no-resolve`, the source of the connection) make the result undecided from their position on.
+    With `geodata`, `GEOSITE` and `GEOIP` keys found in the local databases are evaluated as well.
+    """
+
+    rules: List[Rule]
+
+    def __init__(self, rules: List[Rule], geodata: Optional[GeoData] = None):
+        self.rules = rules
+        self._geodata = geodata
+        self._trie = _SuffixTrie()
+        self._keywords = _KeywordAutomaton()
+        self._ipv4 = _IntervalTable()
+        self._ipv6 = _IntervalTable()
+        self._ports: Optional[array] = None
+        self._networks: Dict[str, int] = {}
+        self._final = NO_MATCH
+        # rules evaluated one by one, in order: (index, predicate)
+        self._scan: List[Tuple[int, Predicate]] = []
+        # indexed rules that cannot be decided for a query lacking their attribute: query mask -> first index
+        self._undecided: List[int] = [NO_MATCH] * len(QUERY_MASKS)
+        self._predicates: Dict[Condition, Predicate] = {}
+        self._sub_matchers: Dict[int, RuleMatcher] = {}
+        for index, rule in enumerate(rules):
+            try:
+                self._add(index, rule)
+            except ValueError as e:
+                collector.record(UNINDEXED_RULE, rule, e)
+                self._scan.append((index, lambda q: None))
+        self._keywords.build()
+        self._has_keywords = len(self._keywords._goto) > 1
+        self._ipv4.build()
+        self._ipv6.build()
+
+    def _add(self, index: int, rule: Rule) -> None:
+        cond = rule.cond
+        type = cond.type
+        if type == RuleType.MATCH:
+            self._final = min(self._final, index)
+        elif type == RuleType.DOMAIN or type == RuleType.DOMAIN_SUFFIX:
+            self._trie.add(cond.match.lower().rstrip('.'), index, type == RuleType.DOMAIN_SUFFIX)
+        elif type == RuleType.DOMAIN_KEYWORD:
+            self._keywords.add(cond.match.lower(), index)
+        elif type in IP_RULE_TYPES:
+            network = ip_network(cond.match, strict=False)
+            table = self._ipv4 if network.version == 4 else self._ipv6
+            table.add(int(network.network_address), int(network.broadcast_address), index)
+            if not cond.no_resolve:
+                self._mark_undecided(index, lambda mask: bool(mask & HAS_HOST) and not (mask & HAS_IP))
+        elif type == RuleType.DST_PORT:
+            if self._ports is None:
+                self._ports = array('q', [NO_MATCH]) * 65536
+            for lo, hi in _parse_ports(cond.match):
+                for port in range(lo, hi + 1):
+                    if index < self._ports[port]:
+                        self._ports[port] = index
+            self._mark_undecided(index, lambda mask: not (mask & HAS_PORT))
+        elif type == RuleType.NETWORK:
+            network = cond.match.lower()
+            self._networks[network] = min(self._networks.get(network, NO_MATCH), index)
+            self._mark_undecided(index, lambda mask: not (mask & HAS_NETWORK))
+        elif type == RuleType.SUB_RULE:
+            guard = self._predicate(cond.children[0])
+            matcher = RuleMatcher(rule.sub_rules or [], self._geodata)
+            self._sub_matchers[index] = matcher
+            self._scan.append((index, guard))
+        else:
+            self._scan.append((index, self._predicate(cond)))
+
+    def _mark_undecided(self, index: int, undecided_for: Callable[[int], bool]) -> None:
+        for mask in QUERY_MASKS:
+            if index < self._undecided[mask] and undecided_for(mask):
+                self._undecided[mask] = index
+
+    def _predicate(self, cond: Condition) -> Predicate:
+        # conditions are hash-consed, so a subtree shared by several rules is compiled once
+        predicate = self._predicates.get(cond)
+        if predicate is None:
+            predicate = self._compile(cond)
+            self._predicates[cond] = predicate
+        return predicate
+
+    def _compile(self, cond: Condition) -> Predicate:
+        type = cond.type
+        if type in LOGICAL_RULE_TYPES:
+            children = [self._predicate(c) for c in cond.children]
+            if type == RuleType.LOGICAL_NOT:
+                child = children[0]
+                return lambda q: None if (r := child(q)) is None else not r
+            short = type == RuleType.LOGICAL_OR   # OR stops at True, AND at False
+            def logical(q: Query) -> Optional[bool]:
+                result = not short
+                for child in children:
+                    r = child(q)
+                    if r is None:
+                        result = None
+                    elif r == short:
+                        return short
+                return result
+            return logical
+        if type in HOST_RULE_TYPES:
+            match = cond.match.lower()
+            if type == RuleType.DOMAIN:
+                test = lambda host: host == match
+            elif type == RuleType.DOMAIN_SUFFIX:
+                dotted = '.' + match
+                test = lambda host: host == match or host.endswith(dotted)
+            elif type == RuleType.DOMAIN_KEYWORD:
+                test = lambda host: match in host
+            elif type == RuleType.DOMAIN_WILDCARD:
+                test = re.compile(fnmatch_translate(match)).match
+            else:
+                test = re.compile(cond.match).search
+            return lambda q: bool(test(q.host)) if q.host else False
+        if type in IP_RULE_TYPES or type == RuleType.IP_SUFFIX:
+            if type == RuleType.IP_SUFFIX:
+                test = _suffix_matcher(cond.match)
+            else:
+                network = ip_network(cond.match, strict=False)
+                test = lambda ip: ip in network
+            resolve = not cond.no_resolve
+            return lambda q: test(q.ip) if q.ip is not None else (None if resolve and q.host else False)
+        if type == RuleType.DST_PORT:
+            ranges = _parse_ports(cond.match)
+            return lambda q: any(lo <= q.port <= hi for lo, hi in ranges) if q.port is not None else None
+        if type == RuleType.NETWORK:
+            network = cond.match.lower()
+            return lambda q: q.network == network if q.network else None
+        if type == RuleType.GEOSITE and self._geodata is not None and self._geodata.has_geosite(cond.match):
+            domains = RuleMatcher([Rule.of(Condition.make(GEOSITE_RULE_TYPES[d.type], d.value), cond.match) for d in self._geodata.geosite_domains(cond.match)])
+            return lambda q: domains.match(q).rule is not None if q.host else False
+        if type == RuleType.GEOIP and self._geodata is not None and self._geodata.has_geoip(cond.match):
+            cidrs, reverse = self._geodata.geoip_cidrs(cond.match)
+            networks = RuleMatcher([Rule.of(Condition.make(RuleType.IP_CIDR, c, True), cond.match) for c in cidrs])
+            resolve = not cond.no_resolve
+            return lambda q: (networks.match(q).rule is not None) != reverse if q.ip is not None else (None if resolve and q.host else False)
+        if type in OPAQUE_HOST_RULE_TYPES:
+            return lambda q: None if q.host else False
+        if type in OPAQUE_IP_RULE_TYPES:
+            resolve = not cond.no_resolve
+            return lambda q: None if q.ip is not None or (resolve and q.host) else False
+        return lambda q: None
+
+    def _indexed(self, q: Query) -> int:
+        best = self._final
+        if q.host:
+            best = min(best, self._trie.lookup(q.host))
+            if self._has_keywords:
+                best = min(best, self._keywords.lookup(q.host))
+        if q.ip is not None:
+            table = self._ipv4 if q.ip.version == 4 else self._ipv6
+            best = min(best, table.lookup(int(q.ip)))
+        if q.port is not None and self._ports is not None and 0 <= q.port < 65536:
+            best = min(best, self._ports[q.port])
+        if q.network:
+            best = min(best, self._networks.get(q.network, NO_MATCH))
+        return best
+
+    def _match(self, q: Query) -> Tuple[Optional[Rule], Optional[Rule]]:
+        best = self._indexed(q)
+        undecided = self._undecided[q.mask]
+        for index, predicate in self._scan:
+            if index >= best:
+                break
+            r = predicate(q)
+            if r is None:
+                undecided = min(undecided, index)
+                continue
+            if not r:
+                continue
+            sub = self._sub_matchers.get(index)
+            if sub is None:
+                best = index
+                break
+            # a sub-rule matching nothing falls through to the next rule
+            rule, sub_undecided = sub._match(q)
+            if rule is not None:
+                return rule, self.rules[undecided] if undecided < index else sub_undecided
+            if sub_undecided is not None:
+                undecided = min(undecided, index)
+        return self.rules[best] if best != NO_MATCH else None, self.rules[undecided] if undecided < best else None
+
+    def match(self, q: Query) -> MatchResult:
+        return MatchResult(*self._match(q))
+
+
+def query_lines(matcher: RuleMatcher, lines: Iterable[str]) -> Iterable[Tuple[Query, MatchResult]]:
+    """
+    Match every non-empty line; results of repeated lines (common in traffic logs) are reused.
+    """
+    seen: Dict[str, MatchResult] = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        q = Query.parse(line)
+        result = seen.get(q.raw)
+        if result is None:
+            result = matcher.match(q)
+            if len(seen) < 1 << 20:
+                seen[q.raw] = result
+        yield q, result
+
+
+if __name__ == '__main__':
+    from random import randrange
+    from time import perf_counter
+
+    rules = [Rule(f'DOMAIN-SUFFIX,site{i}.com,P{i % 7}') for i in range(100000)]
+    rules += [Rule(f'DOMAIN-KEYWORD,kw{i},K') for i in range(2000)]
+    rules += [Rule(f'IP-CIDR,{randrange(1, 224)}.{randrange(256)}.0.0/16,IP,no-resolve') for i in range(20000)]
+    rules.append(Rule('MATCH,FINAL'))
+    start = perf_counter()
+    matcher = RuleMatcher(rules)
+    print(f'indexed {len(rules)} rules in {perf_counter() - start:.2f}s')
+    lines = [f'a{i}.site{randrange(200000)}.com' for i in range(500000)]
+    lines += [f'{randrange(1, 224)}.{randrange(256)}.{randrange(256)}.{randrange(256)}' for i in range(500000)]
+    start = perf_counter()
+    count = sum(1 for _ in query_lines(matcher, lines))
+    print(f'matched {count} queries in {perf_counter() - start:.2f}s')
@@ -0,0 +1,165 @@
+from os import chmod, path, replace
+from time import perf_counter, time
+from typing import Dict, List, Optional, Tuple
+
+METRIC_PREFIX = 'clash_subscribe_'
+
+SOURCE_REMOTE = 'remote'
+SOURCE_FILE = 'file'
+SOURCE_CACHE = 'cache'
+SOURCE_NONE = 'none'
+SOURCES = (SOURCE_REMOTE, SOURCE_FILE, SOURCE_CACHE, SOURCE_NONE)
+
+# name, help; every metric is a gauge, the textfile holds the state of the last run
+SUBSCRIPTION_METRICS: List[Tuple[str, str]] = [
+    ('download_seconds', 'time to download the subscription from the winning mirror'),
+    ('download_wire_bytes', 'bytes received on the wire'),
+    ('download_bytes', 'bytes of the decoded body'),
+    ('http_status', 'http status of the download, 0 when not downloaded'),
+    ('download_success', '1 when the download succeeded'),
+    ('cache_hit', '1 when the subscription was loaded from the cache'),
+    ('download_late', '1 when the download missed the fetch deadline'),
+    ('parse_seconds', 'time to parse the subscription'),
+    ('proxies', 'proxies in the subscription'),
+    ('proxy_groups', 'proxy groups in the subscription'),
+    ('rules', 'rules in the subscription'),
+]
+
+RUN_METRICS: List[Tuple[str, str]] = [
+    ('load_seconds', 'time to download and load every subscription'),
+    ('merge_seconds', 'time to merge the subscriptions'),
+    ('write_seconds', 'time to render and write the config'),
+    ('duration_seconds', 'duration of the whole run'),
+    ('proxies', 'proxies in the generated config'),
+    ('proxies_duplicate', 'proxies removed as duplicates of a proxy of higher priority'),
+    ('proxy_groups', 'proxy groups in the generated config'),
+    ('rules', 'rules in the generated config, before the target writer'),
+    ('rules_invalid', 'rules dropped for unknown geo keys'),
+    ('rules_dropped', 'rules dropped by the target writer'),
+    ('rule_providers', 'rule providers fetched or read at build time'),
+    ('rule_providers_failed', 'rule providers left for the core to fetch'),
+    ('output_bytes', 'size of the generated config'),
+    ('success', '1 when the config was written'),
+    ('profiles', 'profiles rendered from the subscriptions'),
+    ('profiles_failed', 'profiles whose config could not be written'),
+    ('last_run_timestamp_seconds', 'end of the run, unix time'),
+]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value: float) -> str:
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class SubscriptionMetrics(object):
+
+    name: str
+    source: str
+    values: Dict[str, float]
+
+    def __init__(self, name: str):
+        self.name = name
+        self.source = SOURCE_NONE
+        self.values = {'http_status': 0, 'download_success': 0, 'cache_hit': 0, 'download_late': 0}
+
+    def set(self, key: str, value: float) -> None:
+        self.values[key] = value
+
+
+class RunMetrics(object):
+    """
+    Numbers of one run, written for the node_exporter textfile collector.
+    """
+
+    subscriptions: Dict[str, SubscriptionMetrics]
+    values: Dict[str, float]
+    issues: Dict[str, int]  # diagnostics category -> count
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.values = {'success': 0, 'rules_invalid': 0, 'rules_dropped': 0}
+        self.issues = {}
+        self._start = perf_counter()
+
+    def subscription(self, name: str) -> SubscriptionMetrics:
+        m = self.subscriptions.get(name)
+        if m is None:
+            m = SubscriptionMetrics(name)
+            self.subscriptions[name] = m
+        return m
+
+    def set(self, key: str, value: float) -> None:
+        self.values[key] = value
+
+    def set_issues(self, issues: Dict[str, int]) -> None:
+        self.issues = dict(issues)
+
+    def render(self) -> str:
+        lines = []
+        for key, help in SUBSCRIPTION_METRICS:
+            samples = [(m.name, m.values[key]) for m in self.subscriptions.values() if key in m.values]
+            if not samples:
+                continue
+            name = f'{METRIC_PREFIX}subscription_{key}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            for sub_name, value in samples:
+                lines.append(f'{name}{{subscription="{_escape(sub_name)}"}} {_format(value)}')
+        if self.subscriptions:
+            name = f'{METRIC_PREFIX}subscription_source'
+            lines.append(f'# HELP {name} where the subscription was loaded from')
+            lines.append(f'# TYPE {name} gauge')
+            for m in self.subscriptions.values():
+                for source in SOURCES:
+                    lines.append(f'{name}{{subscription="{_escape(m.name)}",source="{source}"}} {1 if m.source == source else 0}')
+        if self.issues:
+            name = f'{METRIC_PREFIX}issues'
+            lines.append(f'# HELP {name} issues met during the run, by diagnostics category')
+            lines.append(f'# TYPE {name} gauge')
+            for category, n in sorted(self.issues.items()):
+                lines.append(f'{name}{{category="{_escape(category)}"}} {n}')
+        for key, help in RUN_METRICS:
+            value = self.values.get(key)
+            if value is None:
+                continue
+            name = f'{METRIC_PREFIX}{key}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_format(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename: str) -> None:
+        """
+        Finish the run and write the metrics; the file is replaced atomically, so the collector
+        never reads a partial file. It must end with `.prom` to be picked up.
+        """
+        self.values['duration_seconds'] = perf_counter() - self._start
+        self.values['last_run_timestamp_seconds'] = time()
+        # same directory as the target, `replace` is only atomic within a file system
+        tmp_filename = path.join(path.dirname(path.abspath(filename)), f'.{path.basename(filename)}.tmp')
+        with open(tmp_filename, 'w', encoding='utf-8') as ofile:
+            ofile.write(self.render())
+        chmod(tmp_filename, 0o644)
+        replace(tmp_filename, filename)
+
+
+class Timer(object):
+
+    elapsed: Optional[float]
+
+    def __init__(self):
+        self.elapsed = None
+
+    def __enter__(self) -> 'Timer':
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.elapsed = perf_counter() - self._start
@@ -0,0 +1,162 @@
+import asyncio
+import ssl
+from time import perf_counter
+from typing import Dict, List, Optional, Set, Tuple
+
+from data import Proxy, ProxyGroup, Rule
+from diagnostics import DROPPED_PROXY, collector
+
+# protocols carried over udp cannot be probed with a tcp connect
+UDP_PROXY_TYPES = {'hysteria', 'hysteria2', 'tuic', 'wireguard'}
+
+PROBE_DROP = 'drop'
+PROBE_DEMOTE = 'demote'
+
+# (server, port, sni or None for plain tcp)
+Endpoint = Tuple[str, int, Optional[str]]
+
+
+class ProbeResult(object):
+
+    latency: Optional[float]    # ms; None when unreachable or not probed
+    error: Optional[str]
+    probed: bool
+
+    def __init__(self, latency: Optional[float], error: Optional[str], probed: bool = True):
+        self.latency = latency
+        self.error = error
+        self.probed = probed
+
+    @property
+    def alive(self) -> bool:
+        return not self.probed or self.latency is not None
+
+    def __repr__(self) -> str:
+        if not self.probed:
+            return 'ProbeResult(not probed)'
+        if self.latency is None:
+            return f'ProbeResult(error={self.error})'
+        return f'ProbeResult(latency={self.latency:.1f}ms)'
+
+
+def _endpoint(proxy: Proxy, tls: bool) -> Optional[Endpoint]:
+    if proxy.type in UDP_PROXY_TYPES:
+        return None
+    server = proxy.server
+    port = proxy.port
+    if not server or port is None:
+        return None
+    sni = proxy.tls_server_name() if tls else None
+    return (str(server), int(port), sni)
+
+
+async def _probe_endpoint(endpoint: Endpoint, semaphore: asyncio.Semaphore, timeout: float, context: ssl.SSLContext) -> ProbeResult:
+    server, port, sni = endpoint
+    async with semaphore:
+        start = perf_counter()
+        try:
+            if sni is None:
+                connect = asyncio.open_connection(server, port)
+            else:
+                connect = asyncio.open_connection(server, port, ssl=context, server_hostname=sni)
+            _, writer = await asyncio.wait_for(connect, timeout)
+        except asyncio.TimeoutError:
+            return ProbeResult(None, 'timeout')
+        except (OSError, ssl.SSLError) as e:
+            return ProbeResult(None, str(e) or type(e).__name__)
+        latency = (perf_counter() - start) * 1000.0
+        writer.close()
+        try:
+            await asyncio.wait_for(writer.wait_closed(), timeout)
+        except (OSError, ssl.SSLError, asyncio.TimeoutError):
+            pass
+        return ProbeResult(latency, None)
+
+
+async def _probe_all(endpoints: List[Endpoint], concurrency: int, timeout: float) -> Dict[Endpoint, ProbeResult]:
+    context = ssl.create_default_context()
+    # only the handshake latency matters here; many nodes use self-signed certificates
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(_probe_endpoint(e, semaphore, timeout, context) for e in endpoints))
+    return dict(zip(endpoints, results))
+
+
+def probe_proxies(proxies: List[Proxy], concurrency: int = 64, timeout: int = 3000, tls: bool = False) -> Dict[str, ProbeResult]:
+    """
+    Measure the tcp connect (and, with `tls`, handshake) latency of every proxy endpoint concurrently.
+    Endpoints shared by several proxies are probed once.
+    """
+    endpoints: Dict[str, Optional[Endpoint]] = {p.name: _endpoint(p, tls) for p in proxies}
+    unique = list(set(e for e in endpoints.values() if e is not None))
+    measured = asyncio.run(_probe_all(unique, concurrency, timeout / 1000.0)) if unique else {}
+    not_probed = ProbeResult(None, None, False)
+    return {name: measured[e] if e is not None else not_probed for name, e in endpoints.items()}
+
+
+def apply_probe(proxies: List[Proxy], proxy_groups: List[ProxyGroup], results: Dict[str, ProbeResult], max_latency: Optional[int] = None, mode: str = PROBE_DEMOTE) -> Tuple[List[Proxy], Set[str]]:
+    """
+    Drop (or demote to the end of their groups) the unreachable proxies and those slower than `max_latency` ms,
+    and sort the proxies of every group by latency. Members that are not probed proxies keep their place in front.
+    A group is never emptied by dropping; its members are only sorted then.
+    Returns the remaining proxies and the names of the bad ones.
+    """
+    bad: Set[str] = set()
+    for name, result in results.items():
+        if not result.alive or (max_latency is not None and result.latency is not None and result.latency > max_latency):
+            bad.add(name)
+
+    def rank(name: str) -> Tuple[int, float]:
+        result = results.get(name)
+        if result is None:
+            return (0, 0.0)
+        if name in bad:
+            return (3, result.latency if result.latency is not None else 0.0)
+        if result.latency is None:
+            return (2, 0.0)
+        return (1, result.latency)
+
+    still_used: Set[str] = set()
+    for g in proxy_groups:
+        members = g.inner.get('proxies')
+        if not members:
+            continue
+        if mode == PROBE_DROP:
+            kept = [m for m in members if m not in bad]
+            if kept:
+                members = kept
+            else:
+                still_used.update(members)
+        g.inner['proxies'] = sorted(members, key=rank)
+    if mode == PROBE_DROP:
+        proxies = [p for p in proxies if p.name not in bad or p.name in still_used]
+    return proxies, bad
+
+
+def drop_rules(rules: List[Rule], dropped: Set[str], memo: Optional[Dict[int, List[Rule]]] = None) -> List[Rule]:
+    """
+    Drop the rules (and sub-rule entries) whose target is a proxy removed by `apply_probe`, as the core refuses them.
+    Rules may be shared with other merges: those to change are replaced, never modified.
+    """
+    if memo is None:
+        memo = {}
+    result = []
+    changed = False
+    for r in rules:
+        if r.sub_rules is not None:
+            sub_rules = memo.get(id(r.sub_rules))
+            if sub_rules is None:
+                memo[id(r.sub_rules)] = r.sub_rules     # a sub-rule referring to itself is left as is
+                sub_rules = drop_rules(r.sub_rules, dropped, memo)
+                memo[id(r.sub_rules)] = sub_rules
+            if sub_rules is not r.sub_rules:
+                r = Rule.of(r.cond, r.strategy)
+                r.sub_rules = sub_rules
+                changed = True
+        elif r.strategy in dropped:
+            collector.record(DROPPED_PROXY, r.raw, f'rule dropped, {r.strategy} is unreachable')
+            changed = True
+            continue
+        result.append(r)
+    return result if changed else rules
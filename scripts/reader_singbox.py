@@ -0,0 +1,380 @@
+import re
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Set
+
+from data import ISubscribeReader, Proxy, ProxyGroup, Rule
+from diagnostics import INVALID_PROXY, INVALID_PROXY_GROUP, INVALID_RULE, UNSUPPORTED_PROXY, UNSUPPORTED_RULE, collector
+from pyjson5 import loads as json5_loads
+from serializer import load_json
+
+# outbounds that are built in the clash core
+SINGBOX_BUILTIN_OUTBOUNDS: Dict[str, Optional[str]] = {
+    'direct': 'DIRECT',
+    'block': 'REJECT',
+    'dns': None,    # no outbound in clash; references are dropped
+}
+
+# singbox rule field -> clash rule type; a rule is converted when it has a single one of these fields
+SINGBOX2CLASH_RULETYPES: Dict[str, str] = {
+    'domain': 'DOMAIN',
+    'domain_suffix': 'DOMAIN-SUFFIX',
+    'domain_keyword': 'DOMAIN-KEYWORD',
+    'domain_regex': 'DOMAIN-REGEX',
+    'geosite': 'GEOSITE',
+    'geoip': 'GEOIP',
+    'ip_cidr': 'IP-CIDR',
+    'source_ip_cidr': 'SRC-IP-CIDR',
+    'port': 'DST-PORT',
+    'port_range': 'DST-PORT',
+    'source_port': 'SRC-PORT',
+    'source_port_range': 'SRC-PORT',
+    'process_name': 'PROCESS-NAME',
+    'process_path': 'PROCESS-PATH',
+    'network': 'NETWORK',
+}
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ns|us|µs|ms|s|m|h)')
+_DURATION_SECONDS = {'ns': 1e-9, 'us': 1e-6, 'µs': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value: Any) -> int:
+    """
+    Seconds of a go duration (`3m`, `1m30s`), as clash expects them; a number is taken as seconds.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    seconds = sum(float(n) * _DURATION_SECONDS[unit] for n, unit in _DURATION.findall(value))
+    return max(1, round(seconds))
+
+
+def _plugin_opts(raw: str) -> Dict[str, Any]:
+    # `obfs=http;obfs-host=example.com`, a bare key is a flag
+    result = {}
+    for part in raw.split(';'):
+        if not part:
+            continue
+        key, sep, value = part.partition('=')
+        result[key] = value if sep else True
+    return result
+
+
+def _tls(outbound: Dict, proxy: Dict, sni_key: str = 'servername') -> None:
+    tls = outbound.get('tls')
+    if not tls or not tls.get('enabled', False):
+        return
+    proxy['tls'] = True
+    server_name = tls.get('server_name')
+    if server_name:
+        proxy[sni_key] = server_name
+    if tls.get('insecure'):
+        proxy['skip-cert-verify'] = True
+    alpn = tls.get('alpn')
+    if alpn:
+        proxy['alpn'] = [alpn] if isinstance(alpn, str) else alpn
+    utls = tls.get('utls')
+    if utls and utls.get('enabled', False) and utls.get('fingerprint'):
+        proxy['client-fingerprint'] = utls['fingerprint']
+    reality = tls.get('reality')
+    if reality and reality.get('enabled', False):
+        proxy['reality-opts'] = {
+            'public-key': reality['public_key'],
+            'short-id': reality.get('short_id', ''),
+        }
+
+
+def _transport(outbound: Dict, proxy: Dict) -> None:
+    transport = outbound.get('transport')
+    if not transport:
+        proxy['network'] = 'tcp'
+        return
+    match transport['type']:
+        case 'ws' | 'httpupgrade':
+            opts = {'path': transport.get('path', '/')}
+            headers = transport.get('headers')
+            if transport['type'] == 'httpupgrade':
+                opts['v2ray-http-upgrade'] = True
+                host = transport.get('host')
+                if host:
+                    headers = {**(headers or {}), 'Host': host}
+            if headers:
+                opts['headers'] = headers
+            max_early_data = transport.get('max_early_data')
+            if max_early_data:
+                opts['max-early-data'] = max_early_data
+                opts['early-data-header-name'] = transport.get('early_data_header_name', 'Sec-WebSocket-Protocol')
+            proxy['network'] = 'ws'
+            proxy['ws-opts'] = opts
+        case 'grpc':
+            proxy['network'] = 'grpc'
+            proxy['grpc-opts'] = {'grpc-service-name': transport.get('service_name', '')}
+        case 'http':
+            host = transport.get('host')
+            path = transport.get('path', '/')
+            if proxy.get('tls'):
+                # singbox negotiates h2 over tls, clash needs it spelled out
+                opts = {'path': path}
+                if host:
+                    opts['host'] = host
+                proxy['network'] = 'h2'
+                proxy['h2-opts'] = opts
+            else:
+                opts = {'method': transport.get('method', 'GET'), 'path': [path]}
+                headers = dict(transport.get('headers') or {})
+                if host:
+                    headers['Host'] = host
+                if headers:
+                    opts['headers'] = {k: v if isinstance(v, list) else [v] for k, v in headers.items()}
+                proxy['network'] = 'http'
+                proxy['http-opts'] = opts
+        case _:
+            raise NotImplementedError(f"transport '{transport['type']}' is not supported in clash")
+
+
+def _udp(outbound: Dict, proxy: Dict) -> None:
+    # singbox enables both networks unless restricted
+    proxy['udp'] = outbound.get('network', '') != 'tcp'
+
+
+def _shadowsocks(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'ss'
+    proxy['cipher'] = outbound['method']
+    proxy['password'] = outbound['password']
+    _udp(outbound, proxy)
+    plugin = outbound.get('plugin')
+    if plugin == 'obfs-local':
+        opts = _plugin_opts(outbound.get('plugin_opts', ''))
+        proxy['plugin'] = 'obfs'
+        proxy['plugin-opts'] = {'mode': opts.get('obfs', 'http'), 'host': opts.get('obfs-host', '')}
+    elif plugin == 'v2ray-plugin':
+        proxy['plugin'] = 'v2ray-plugin'
+        proxy['plugin-opts'] = _plugin_opts(outbound.get('plugin_opts', ''))
+    elif plugin:
+        raise NotImplementedError(f"shadowsocks plugin '{plugin}' is not supported in clash")
+
+
+def _vmess(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'vmess'
+    proxy['uuid'] = outbound['uuid']
+    proxy['alterId'] = outbound.get('alter_id', 0)
+    proxy['cipher'] = outbound.get('security', 'auto')
+    _udp(outbound, proxy)
+    _tls(outbound, proxy)
+    _transport(outbound, proxy)
+
+
+def _vless(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'vless'
+    proxy['uuid'] = outbound['uuid']
+    flow = outbound.get('flow')
+    if flow:
+        proxy['flow'] = flow
+    _udp(outbound, proxy)
+    _tls(outbound, proxy)
+    _transport(outbound, proxy)
+
+
+def _trojan(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'trojan'
+    proxy['password'] = outbound['password']
+    _udp(outbound, proxy)
+    _tls(outbound, proxy, 'sni')
+    _transport(outbound, proxy)
+    proxy.pop('tls', None)  # implied for trojan
+
+
+def _hysteria2(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'hysteria2'
+    proxy['password'] = outbound.get('password', '')
+    if outbound.get('up_mbps'):
+        proxy['up'] = outbound['up_mbps']
+    if outbound.get('down_mbps'):
+        proxy['down'] = outbound['down_mbps']
+    obfs = outbound.get('obfs')
+    if obfs:
+        proxy['obfs'] = obfs.get('type', 'salamander')
+        proxy['obfs-password'] = obfs.get('password', '')
+    _tls(outbound, proxy, 'sni')
+    proxy.pop('tls', None)
+
+
+def _socks(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'socks5'
+    if outbound.get('username'):
+        proxy['username'] = outbound['username']
+        proxy['password'] = outbound.get('password', '')
+    _udp(outbound, proxy)
+
+
+def _http(outbound: Dict, proxy: Dict) -> None:
+    proxy['type'] = 'http'
+    if outbound.get('username'):
+        proxy['username'] = outbound['username']
+        proxy['password'] = outbound.get('password', '')
+    _tls(outbound, proxy, 'sni')
+
+
+# singbox outbound type -> filler of the clash proxy
+SINGBOX2CLASH_PROXIES: Dict[str, Callable[[Dict, Dict], None]] = {
+    'shadowsocks': _shadowsocks,
+    'vmess': _vmess,
+    'vless': _vless,
+    'trojan': _trojan,
+    'hysteria2': _hysteria2,
+    'socks': _socks,
+    'http': _http,
+}
+
+SINGBOX_GROUP_OUTBOUNDS = ('selector', 'urltest')
+
+
+class SingboxSubscribeReader(ISubscribeReader):
+    """
+    Reads a sing-box config: outbounds become clash proxies and proxy groups, the simple route rules become clash rules.
+    """
+
+    inner: Dict
+    builtins: Dict[str, Optional[str]]  # tag of a built-in outbound -> clash name
+    groups: Set[str]    # tags of the selector and urltest outbounds
+    converted: Set[str] # tags of the outbounds turned into clash proxies, see `_convert`
+    _proxies: Optional[List[Proxy]]
+
+    def __init__(self):
+        super().__init__()
+
+    def get_cache_name(self, filename: str) -> str:
+        return filename + '.json'
+
+    def read(self, ifile: BinaryIO, is_cache: bool, ofile_cache: Optional[BinaryIO] = None) -> None:
+        data = ifile.read()
+        try:
+            self.inner = load_json(data)
+        except ValueError:
+            # sing-box accepts comments and trailing commas
+            self.inner = json5_loads(data.decode('utf-8-sig'))
+        self.builtins = {}
+        self.groups = set()
+        self.converted = set()
+        self._proxies = None
+        for outbound in self.inner.get('outbounds') or []:
+            if outbound.get('type') in SINGBOX_BUILTIN_OUTBOUNDS:
+                self.builtins[outbound['tag']] = SINGBOX_BUILTIN_OUTBOUNDS[outbound['type']]
+            elif outbound.get('type') in SINGBOX_GROUP_OUTBOUNDS:
+                self.groups.add(outbound['tag'])
+        if not is_cache and ofile_cache is not None:
+            ofile_cache.write(data)
+
+    def _outbound_names(self, tags: List[str]) -> List[str]:
+        # outbounds that were not converted are left out, as are the ones clash has no counterpart for
+        self._convert()
+        result = []
+        for tag in tags:
+            if tag in self.builtins:
+                name = self.builtins[tag]
+                if name is not None:
+                    result.append(name)
+            elif tag in self.converted or tag in self.groups:
+                result.append(tag)
+        return result
+
+    def get_proxies(self) -> List[Proxy]:
+        if self.inner.get('outbounds') is None:
+            return None
+        return list(self._convert())
+
+    def _convert(self) -> List[Proxy]:
+        """
+        Convert the outbounds to clash proxies once, whichever of the getters asks first.
+        """
+        if self._proxies is not None:
+            return self._proxies
+        result = list()
+        for o in self.inner.get('outbounds') or []:
+            ty = o.get('type')
+            if ty in SINGBOX_BUILTIN_OUTBOUNDS or ty in SINGBOX_GROUP_OUTBOUNDS:
+                continue
+            filler = SINGBOX2CLASH_PROXIES.get(ty)
+            if filler is None:
+                collector.record(UNSUPPORTED_PROXY, o.get('tag'), f'outbound type {ty} not supported in clash')
+                continue
+            try:
+                proxy = {'name': o['tag'], 'type': '', 'server': o['server'], 'port': o['server_port']}
+                filler(o, proxy)
+                result.append(Proxy.parse(proxy))
+                self.converted.add(o['tag'])
+            except NotImplementedError as e:
+                collector.record(UNSUPPORTED_PROXY, o.get('tag'), e)
+            except Exception as e:
+                collector.record(INVALID_PROXY, o, e)
+        self._proxies = result
+        return result
+
+    def get_all_proxies(self, name: str) -> ProxyGroup:
+        outbounds = self.inner.get('outbounds')
+        if outbounds is None:
+            return None
+        self._convert()
+        inner = {
+            'name': name,
+            'type': 'select',
+            'proxies': [o['tag'] for o in outbounds if o.get('tag') in self.converted]
+        }
+        try:
+            return ProxyGroup(inner)
+        except Exception as e:
+            collector.record(INVALID_PROXY_GROUP, inner, e)
+            return None
+
+    def get_proxy_groups(self) -> List[ProxyGroup]:
+        result = list()
+        for o in self.inner.get('outbounds') or []:
+            ty = o.get('type')
+            if ty not in SINGBOX_GROUP_OUTBOUNDS:
+                continue
+            try:
+                inner = {
+                    'name': o['tag'],
+                    'type': 'select' if ty == 'selector' else 'url-test',
+                    'proxies': self._outbound_names(o['outbounds']),
+                }
+                if ty == 'urltest':
+                    if o.get('url'):
+                        inner['url'] = o['url']
+                    if o.get('interval'):
+                        inner['interval'] = parse_duration(o['interval'])
+                    if o.get('tolerance') is not None:
+                        inner['tolerance'] = o['tolerance']
+                result.append(ProxyGroup(inner))
+            except Exception as e:
+                collector.record(INVALID_PROXY_GROUP, o, e)
+        return result
+
+    def get_rules(self) -> List[Rule]:
+        route = self.inner.get('route')
+        if route is None:
+            return None
+        result = list()
+        for r in route.get('rules') or []:
+            fields = [k for k in r if k not in ('outbound', 'action')]
+            if r.get('action', 'route') != 'route' or len(fields) != 1 or fields[0] not in SINGBOX2CLASH_RULETYPES:
+                # singbox rules match on every field at once; only the single field ones have a clash equivalent
+                collector.record(UNSUPPORTED_RULE, r, 'rule not expressible in clash')
+                continue
+            targets = self._outbound_names([r.get('outbound', '')])
+            if not targets:
+                collector.record(UNSUPPORTED_RULE, r, 'rule to a dns or unconverted outbound')
+                continue
+            field = fields[0]
+            rule_type = SINGBOX2CLASH_RULETYPES[field]
+            values = r[field]
+            for value in values if isinstance(values, list) else [values]:
+                if field.endswith('port_range'):
+                    value = str(value).replace(':', '-')
+                try:
+                    result.append(Rule(f'{rule_type},{value},{targets[0]}'))
+                except Exception as e:
+                    collector.record(INVALID_RULE, r, e)
+        final = route.get('final')
+        if final:
+            targets = self._outbound_names([final])
+            if targets:
+                result.append(Rule(f'MATCH,{targets[0]}'))
+        return result
@@ -1,12 +1,52 @@
 from io import BufferedIOBase, BytesIO, TextIOWrapper
-from typing import BinaryIO, Dict, List, Optional
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional
 from urllib.parse import parse_qs, unquote_plus, urlparse
 from data import ISubscribeReader, Proxy, ProxyGroup, Rule
+from diagnostics import UNSUPPORTED_LINK, collector
 from base64 import b64decode
+from binascii import a2b_base64
 from json import load as json_load, dump as json_dump
 
 HEADER_VMESS = b'vmess://'
 
+B64_CHUNK_SIZE = 64 * 1024
+_B64_URLSAFE = bytes.maketrans(b'-_', b'+/')
+_B64_IGNORED = b' \t\r\n\v\f'
+
+def iter_b64_lines(ifile: BinaryIO, chunk_size: int = B64_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Decode a base64 stream chunk by chunk and yield the decoded lines.
+    Accepts standard and url-safe alphabets, line-wrapped input and missing padding; padding ends the payload.
+    """
+    pending = b''   # base64 characters not forming a full quantum yet
+    tail = b''      # decoded bytes not terminated by a newline yet
+    padded = False
+    while True:
+        chunk = ifile.read(chunk_size)
+        if not chunk:
+            break
+        chunk = chunk.translate(_B64_URLSAFE, _B64_IGNORED)
+        pos = 0 if padded else chunk.find(b'=')
+        if pos >= 0:
+            if chunk[pos:].strip(b'='):
+                raise ValueError('invalid base64 payload: data after padding')
+            chunk = chunk[:pos]
+            padded = True
+        pending += chunk
+        cut = len(pending) - len(pending) % 4
+        if cut == 0:
+            continue
+        lines = (tail + a2b_base64(pending[:cut])).split(b'\n')
+        pending = pending[cut:]
+        tail = lines.pop()
+        yield from lines
+    if len(pending) == 1:
+        raise ValueError('invalid base64 payload: truncated quantum')
+    if pending:
+        tail += a2b_base64(pending + b'=' * (4 - len(pending)))
+    if tail:
+        yield from tail.split(b'\n')
+
 def record_cvt_v2(url: str):
     pos = len(HEADER_VMESS)
     data = b64decode(url[pos:])
@@ -126,23 +166,20 @@ class SubscribeReaderSimple(ISubscribeReader):
         return filename + '.txt'
 
     def read(self, ifile: BinaryIO, is_cache: bool, ofile_cache: Optional[BinaryIO] = None) -> None:
-        links: List[str] = list()
+        lines: Iterable[bytes]
         if not is_cache:
-            raw = ifile.read()
-            data = b64decode(raw)
-            for record_line in data.splitlines():
-                links.append(record_line.decode('utf-8').strip())
-            if ofile_cache is not None:
-                writer = TextIOWrapper(ofile_cache, encoding='utf-8')
-                writer.writelines(link + '\n' for link in links)
-                writer.flush()
+            lines = iter_b64_lines(ifile)
         else:
-            for line in ifile:
-                line = line.rstrip(b'\n\r')
-                if line:
-                    links.append(line.decode('utf-8'))
+            lines = ifile
+            ofile_cache = None
         self.inner = list()
-        for link in links:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if ofile_cache is not None:
+                ofile_cache.write(line + b'\n')
+            link = line.decode('utf-8')
             if link.startswith('vmess://'):
                 record = record_cvt_v2(link)
                 self.inner.append(record)
@@ -150,11 +187,11 @@ class SubscribeReaderSimple(ISubscribeReader):
                 record = record_cvt_ss(link)
                 self.inner.append(record)
             else:
-                print(f'Unsupported link: {link}')
+                collector.record(UNSUPPORTED_LINK, link.split('://', 1)[0] + '://')
 
 
     def get_proxies(self) -> List[Proxy]:
-        proxies = [Proxy(p) for p in self.inner]
+        proxies = [Proxy.parse(p) for p in self.inner]
         return proxies
     
     def get_all_proxies(self, name: str) -> ProxyGroup:
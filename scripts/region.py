@@ -0,0 +1,113 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from data import GeneralGroup, Proxy, ProxyGroup
+
+DEFAULT_TEST_URL = 'https://www.gstatic.com/generate_204'
+
+# code, group name, keywords (flags, abbreviations, english and chinese names, major cities)
+REGIONS: List[Tuple[str, str, List[str]]] = [
+    ('HK', '🇭🇰 Hong Kong', ['🇭🇰', 'HK', 'HKG', 'Hong Kong', 'HongKong', '香港', '港']),
+    ('TW', '🇹🇼 Taiwan', ['🇹🇼', 'TW', 'TWN', 'Taiwan', 'Taipei', '台湾', '臺灣', '台北', '新北', '彰化']),
+    ('JP', '🇯🇵 Japan', ['🇯🇵', 'JP', 'JPN', 'Japan', 'Tokyo', 'Osaka', '日本', '东京', '東京', '大阪', '埼玉']),
+    ('KR', '🇰🇷 Korea', ['🇰🇷', 'KR', 'KOR', 'Korea', 'Seoul', 'Chuncheon', '韩国', '韓國', '首尔', '春川']),
+    ('SG', '🇸🇬 Singapore', ['🇸🇬', 'SG', 'SGP', 'Singapore', '新加坡', '狮城', '獅城']),
+    ('US', '🇺🇸 United States', ['🇺🇸', 'US', 'USA', 'United States', 'America', 'Los Angeles', 'San Jose', 'Silicon Valley',
+                                'Seattle', 'New York', 'Chicago', 'Dallas', 'Phoenix', 'Fremont', 'Ashburn', '美国', '美國', '洛杉矶', '圣何塞', '硅谷', '西雅图', '纽约', '芝加哥', '凤凰城']),
+    ('GB', '🇬🇧 United Kingdom', ['🇬🇧', 'UK', 'GB', 'GBR', 'United Kingdom', 'Britain', 'England', 'London', '英国', '英國', '伦敦']),
+    ('DE', '🇩🇪 Germany', ['🇩🇪', 'DE', 'DEU', 'Germany', 'Frankfurt', '德国', '德國', '法兰克福']),
+    ('FR', '🇫🇷 France', ['🇫🇷', 'FR', 'FRA', 'France', 'Paris', '法国', '法國', '巴黎']),
+    ('NL', '🇳🇱 Netherlands', ['🇳🇱', 'NL', 'NLD', 'Netherlands', 'Amsterdam', '荷兰', '荷蘭', '阿姆斯特丹']),
+    ('RU', '🇷🇺 Russia', ['🇷🇺', 'RU', 'RUS', 'Russia', 'Moscow', '俄罗斯', '俄羅斯', '莫斯科']),
+    ('IN', '🇮🇳 India', ['🇮🇳', 'IND', 'India', 'Mumbai', '印度', '孟买']),
+    ('CA', '🇨🇦 Canada', ['🇨🇦', 'CA', 'CAN', 'Canada', 'Toronto', 'Vancouver', 'Montreal', '加拿大', '多伦多', '温哥华']),
+    ('AU', '🇦🇺 Australia', ['🇦🇺', 'AU', 'AUS', 'Australia', 'Sydney', 'Melbourne', '澳大利亚', '澳洲', '悉尼']),
+    ('TR', '🇹🇷 Turkey', ['🇹🇷', 'TR', 'TUR', 'Turkey', 'Türkiye', 'Istanbul', '土耳其', '伊斯坦布尔']),
+    ('AR', '🇦🇷 Argentina', ['🇦🇷', 'AR', 'ARG', 'Argentina', 'Buenos Aires', '阿根廷']),
+]
+
+
+def _keyword_pattern(keyword: str) -> str:
+    escaped = re.escape(keyword)
+    # latin keywords must not be glued to other letters: 'US-LA' and 'HK01' match, 'PLUS' and 'Russia' for US do not
+    if keyword[0].isascii() and keyword[0].isalpha():
+        escaped = r'(?<![A-Za-z])' + escaped
+    if keyword[-1].isascii() and keyword[-1].isalpha():
+        escaped = escaped + r'(?![A-Za-z])'
+    return escaped
+
+
+def _compile() -> Tuple[re.Pattern, Dict[str, str]]:
+    table: Dict[str, str] = {}
+    for code, _, keywords in REGIONS:
+        for keyword in keywords:
+            table[keyword.casefold()] = code
+    # longest first, so that 'Hong Kong' wins over 'HK' style prefixes at the same position
+    keywords = sorted(table.keys(), key=len, reverse=True)
+    pattern = re.compile('|'.join(_keyword_pattern(k) for k in keywords), re.IGNORECASE)
+    return pattern, table
+
+
+REGION_PATTERN, REGION_KEYWORDS = _compile()
+REGION_NAMES: Dict[str, str] = {code: name for code, name, _ in REGIONS}
+
+
+def _original_name(name: str) -> str:
+    # drop the '[<subscription>]-' prefix added by `Info.modify_by_name`
+    if name.startswith('['):
+        pos = name.find(']-')
+        if pos > 0:
+            return name[pos+2:]
+    return name
+
+
+def classify(name: str) -> Optional[str]:
+    m = REGION_PATTERN.search(_original_name(name))
+    if m is None:
+        return None
+    return REGION_KEYWORDS.get(m.group(0).casefold())
+
+
+def make_region_groups(proxies: List[Proxy], group_type: str = 'url-test', url: str = DEFAULT_TEST_URL, interval: int = 300, tolerance: int = 50, min_size: int = 1) -> List[ProxyGroup]:
+    """
+    Sort the proxies into regions by name and build one `url-test` or `fallback` group per region.
+    """
+    members: Dict[str, List[str]] = {}
+    for p in proxies:
+        code = classify(p.name)
+        if code is not None:
+            members.setdefault(code, []).append(p.name)
+    groups = []
+    for code, _, _ in REGIONS:
+        names = members.get(code)
+        if names is None or len(names) < min_size:
+            continue
+        inner = {
+            'name': REGION_NAMES[code],
+            'type': group_type,
+            'proxies': names,
+            'url': url,
+            'interval': interval,
+        }
+        if group_type == 'url-test':
+            inner['tolerance'] = tolerance
+        groups.append(ProxyGroup(inner))
+    return groups
+
+
+def add_region_groups(proxy_groups: List[ProxyGroup], region_groups: List[ProxyGroup]) -> None:
+    """
+    Append the region groups and put them in front of the general `PROXY` group.
+    """
+    names = [g.name for g in region_groups]
+    for g in proxy_groups:
+        if g.name == GeneralGroup.PROXY.value:
+            g.inner['proxies'] = names + [n for n in g.inner['proxies'] if n not in names]
+    proxy_groups.extend(region_groups)
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    for name in argv[1:]:
+        print(f'{name} -> {classify(name)}')
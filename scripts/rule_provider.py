@@ -0,0 +1,278 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import path
+from typing import Dict, List, Optional, Tuple
+
+from cache import CacheStore
+from data import Condition
+from diagnostics import INVALID_RULE, UNRESOLVED_RULE_PROVIDER, collector
+from http_pool import HTTPPool
+from utils import DownloadResult, download_config
+
+try:
+    from yaml import CLoader as Loader
+except ImportError as e:
+    print('[warning] unable to load libyaml; use python module instead', e)
+    from yaml import Loader
+
+# cache entry type of the rule provider payloads, stored under `rule-provider:<url>`
+RULE_PROVIDER_TYPE = 'rule-provider'
+
+TYPE_HTTP = 'http'
+TYPE_FILE = 'file'
+TYPE_INLINE = 'inline'
+
+BEHAVIOR_DOMAIN = 'domain'
+BEHAVIOR_IPCIDR = 'ipcidr'
+BEHAVIOR_CLASSICAL = 'classical'
+BEHAVIORS = (BEHAVIOR_DOMAIN, BEHAVIOR_IPCIDR, BEHAVIOR_CLASSICAL)
+
+FORMAT_YAML = 'yaml'
+FORMAT_TEXT = 'text'
+FORMAT_MRS = 'mrs'    # binary, only read by the core
+
+FORMAT_EXTENSIONS = {
+    FORMAT_YAML: 'yaml',
+    FORMAT_TEXT: 'list',
+    FORMAT_MRS: 'mrs',
+}
+
+
+class RuleSetPayload(object):
+    """
+    Entries of a provider: the domains or cidrs of a domain/ipcidr provider, the conditions of a classical one.
+    """
+
+    behavior: str
+    entries: List[str]
+    conditions: List[Condition]
+    invalid: List[str]
+
+    def __init__(self, behavior: str):
+        self.behavior = behavior
+        self.entries = []
+        self.conditions = []
+        self.invalid = []
+
+    def __len__(self) -> int:
+        return len(self.conditions) if self.behavior == BEHAVIOR_CLASSICAL else len(self.entries)
+
+
+# (content hash, behavior, format) -> payload; profiles forked afterwards inherit it
+_parsed: Dict[Tuple[str, str, str], RuleSetPayload] = {}
+
+
+def _lines(content: bytes, format: str) -> List[str]:
+    if format == FORMAT_YAML:
+        loader = Loader(content)
+        try:
+            obj = loader.get_single_data()
+        finally:
+            loader.dispose()
+        items = obj.get('payload') if isinstance(obj, dict) else None
+        return [str(item).strip() for item in items or [] if item is not None]
+    lines = []
+    for line in content.decode('utf-8-sig').splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            lines.append(line)
+    return lines
+
+
+def parse_payload(content: bytes, hash: str, behavior: str, format: str) -> RuleSetPayload:
+    key = (hash, behavior, format)
+    payload = _parsed.get(key)
+    if payload is not None:
+        return payload
+    if format not in (FORMAT_YAML, FORMAT_TEXT):
+        raise ValueError(f'rule provider format {format} cannot be parsed')
+    if behavior not in BEHAVIORS:
+        raise ValueError(f'unknown rule provider behavior: {behavior}')
+    payload = RuleSetPayload(behavior)
+    for line in _lines(content, format):
+        if behavior == BEHAVIOR_CLASSICAL:
+            try:
+                payload.conditions.append(Condition.parse(line))
+            except Exception:
+                payload.invalid.append(line)
+        elif ',' in line or ' ' in line:
+            payload.invalid.append(line)
+        else:
+            payload.entries.append(line)
+    _parsed[key] = payload
+    return payload
+
+
+class RuleProvider(object):
+
+    name: str   # first name it was declared under
+    type: str
+    behavior: str
+    format: str
+    url: Optional[str]
+    path: Optional[str]     # absolute path of a file provider
+    content: Optional[bytes]
+    hash: Optional[str]     # sha256 of the content
+    source: Optional[str]   # remote, cache, file, inline
+
+    def __init__(self, name: str, spec: Dict, base_dir: str):
+        self.name = name
+        self.type = spec.get('type', '')
+        self.behavior = spec.get('behavior', BEHAVIOR_CLASSICAL)
+        self.format = spec.get('format', FORMAT_YAML)
+        self.url = spec.get('url') if self.type == TYPE_HTTP else None
+        self.path = None
+        if self.type == TYPE_FILE and spec.get('path'):
+            self.path = path.normpath(path.join(base_dir, spec['path']))
+        self.content = None
+        self.hash = None
+        self.source = None
+        if self.type == TYPE_INLINE:
+            # parsed like a text provider; the config keeps it inline
+            self.format = FORMAT_TEXT
+            self._set('\n'.join(str(item) for item in spec.get('payload') or []).encode('utf-8'), TYPE_INLINE)
+
+    @staticmethod
+    def key(spec: Dict, base_dir: str) -> str:
+        type = spec.get('type', '')
+        if type == TYPE_HTTP:
+            source = spec.get('url')
+        elif type == TYPE_FILE:
+            source = path.normpath(path.join(base_dir, spec.get('path') or ''))
+        else:
+            source = repr(spec.get('payload'))
+        return f"{type}:{spec.get('behavior')}:{spec.get('format')}:{source}"
+
+    @property
+    def cache_name(self) -> str:
+        return f'{RULE_PROVIDER_TYPE}:{self.url}'
+
+    @property
+    def resolved(self) -> bool:
+        return self.content is not None
+
+    @property
+    def id(self) -> str:
+        # names the local copies: the same content read the same way is written once, and kept across runs
+        return hashlib.sha256(f'{self.hash}:{self.behavior}:{self.format}'.encode('utf-8')).hexdigest()[:16]
+
+    def payload(self) -> RuleSetPayload:
+        return parse_payload(self.content, self.hash, self.behavior, self.format)
+
+    def _set(self, content: bytes, source: str, hash: Optional[str] = None) -> None:
+        self.content = content
+        self.hash = hash or hashlib.sha256(content).hexdigest()
+        self.source = source
+
+    def __repr__(self) -> str:
+        return f'RuleProvider(name={self.name}, type={self.type}, behavior={self.behavior}, format={self.format}, source={self.source})'
+
+
+def _download(url: str, headers: Dict[str, str], timeout: int, pool: HTTPPool) -> Tuple[DownloadResult, bytes]:
+    ofile = BytesIO()
+    result = download_config(url, ofile, timeout, pool, None, headers)
+    if result.status != 304 and result.size == 0:
+        raise ValueError('empty response')
+    return result, ofile.getvalue()
+
+
+class RuleProviders(object):
+    """
+    Rule providers of a run: those of the subscriptions by their (prefixed) name, and the payload of every
+    provider used by a config, fetched once per source whatever the number of names and profiles using it.
+    """
+
+    specs: Dict[str, Dict]  # rule provider of a subscription, by name
+    providers: Dict[str, RuleProvider]  # `RuleProvider.key` -> provider
+
+    def __init__(self):
+        self.specs = {}
+        self.providers = {}
+
+    def spec(self, name: str) -> Optional[Dict]:
+        return self.specs.get(name)
+
+    def add(self, name: str, spec: Dict, base_dir: str) -> RuleProvider:
+        key = RuleProvider.key(spec, base_dir)
+        provider = self.providers.get(key)
+        if provider is None:
+            provider = RuleProvider(name, spec, base_dir)
+            self.providers[key] = provider
+        return provider
+
+    def get(self, spec: Dict, base_dir: str) -> Optional[RuleProvider]:
+        provider = self.providers.get(RuleProvider.key(spec, base_dir))
+        return provider if provider is not None and provider.resolved else None
+
+    @property
+    def resolved(self) -> int:
+        return sum(1 for p in self.providers.values() if p.resolved)
+
+    def resolve(self, store: CacheStore, timeout: int = 5000, no_update: bool = False, max_workers: int = 8) -> None:
+        """
+        Fetch the http providers with conditional requests against their cached copy, which is used when the
+        server answers `304` or fails; read the file providers. Payloads downloaded anew are checked.
+        """
+        pending = [p for p in self.providers.values() if not p.resolved]
+        remote = [p for p in pending if p.url and not no_update]
+        if remote:
+            requests = []
+            for p in remote:
+                headers = {}
+                # validators only help if the version they describe is still in the cache
+                if store.latest(p.cache_name) is not None:
+                    etag, last_modified = store.validators(p.cache_name)
+                    if etag:
+                        headers['If-None-Match'] = etag
+                    if last_modified:
+                        headers['If-Modified-Since'] = last_modified
+                requests.append((p, headers))
+            with HTTPPool() as pool, ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(requests)))) as executor:
+                futures = [(p, executor.submit(_download, p.url, headers, timeout, pool)) for p, headers in requests]
+                # the store is only used from this thread
+                for p, future in futures:
+                    try:
+                        result, content = future.result()
+                        store.record_fetch(p.cache_name, result.status, result.encoding, result.wire_size, result.size)
+                        if result.status == 304:
+                            print(f'># rule provider {p.name} not modified')
+                            continue
+                        with store.writer(p.cache_name, RULE_PROVIDER_TYPE) as ofile_cache:
+                            ofile_cache.write(content)
+                            entry = ofile_cache.commit()
+                        store.record_validators(p.cache_name, result.etag, result.last_modified)
+                        p._set(content, 'remote', entry.hash)
+                        print(f'># rule provider {p.name} downloaded ({result.size} bytes, sha256 {entry.hash[:12]})')
+                        self._check(p)
+                    except Exception as e:
+                        print(f'>! failed to fetch rule provider {p.name} from {p.url}', e)
+        for p in pending:
+            if p.resolved:
+                continue
+            try:
+                if p.url:
+                    entry = store.latest(p.cache_name)
+                    ifile = store.open(p.cache_name, RULE_PROVIDER_TYPE) if entry is not None else None
+                    if ifile is not None:
+                        with ifile:
+                            p._set(ifile.read(), 'cache', entry.hash)
+                elif p.path and path.isfile(p.path):
+                    with open(p.path, 'rb') as ifile:
+                        p._set(ifile.read(), 'file')
+            except Exception as e:
+                print(f'>! failed to read rule provider {p.name}', e)
+            if not p.resolved and p.type in (TYPE_HTTP, TYPE_FILE):
+                collector.record(UNRESOLVED_RULE_PROVIDER, p.name, p.url or p.path)
+
+    def _check(self, p: RuleProvider) -> None:
+        if p.format == FORMAT_MRS:
+            return
+        try:
+            payload = p.payload()
+        except Exception as e:
+            print(f'>! rule provider {p.name} cannot be parsed', e)
+            return
+        for line in payload.invalid:
+            collector.record(INVALID_RULE, f'{p.name}: {line}')
+        print(f'>#   {len(payload)} {payload.behavior} entries' + (f', {len(payload.invalid)} invalid' if payload.invalid else ''))
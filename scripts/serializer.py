@@ -0,0 +1,240 @@
+import json
+import re
+from abc import ABC, abstractmethod
+from mmap import mmap
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    from yaml import CDumper
+except ImportError:
+    CDumper = None
+
+# keys written unquoted; anything else (and the words yaml 1.1 reads as booleans or null) is quoted
+_YAML_PLAIN_KEY = re.compile('[A-Za-z_][A-Za-z0-9_.-]*')
+_YAML_RESERVED = {'y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null'}
+# characters a yaml double-quoted scalar must escape although json leaves them raw
+_YAML_UNPRINTABLE = re.compile('[\x7f-\x9f\u2028\u2029\ufeff\ud800-\udfff\ufffe\uffff]')
+
+
+class ISerializer(ABC):
+
+    name: str
+    pretty: bool
+
+    def __init__(self, pretty: bool):
+        self.pretty = pretty
+
+    @abstractmethod
+    def dump(self, obj: Any, ofile: BinaryIO) -> None:
+        pass
+
+    def __repr__(self) -> str:
+        return f'{self.name} ({"pretty" if self.pretty else "compact"})'
+
+
+class OrjsonSerializer(ISerializer):
+
+    name = 'orjson'
+
+    def dump(self, obj: Any, ofile: BinaryIO) -> None:
+        ofile.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 if self.pretty else 0))
+
+
+class UjsonSerializer(ISerializer):
+
+    name = 'ujson'
+
+    def dump(self, obj: Any, ofile: BinaryIO) -> None:
+        content = ujson.dumps(obj, indent=2 if self.pretty else 0, ensure_ascii=False, escape_forward_slashes=False)
+        ofile.write(content.encode('utf-8'))
+
+
+class StdJsonSerializer(ISerializer):
+
+    name = 'json'
+
+    def dump(self, obj: Any, ofile: BinaryIO) -> None:
+        if self.pretty:
+            content = json.dumps(obj, indent=2, ensure_ascii=False)
+        else:
+            content = json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+        ofile.write(content.encode('utf-8'))
+
+
+class LibyamlSerializer(ISerializer):
+    """
+    Block style yaml through libyaml; lists shared by several groups become anchors and aliases.
+    """
+
+    name = 'libyaml'
+
+    def dump(self, obj: Any, ofile: BinaryIO) -> None:
+        dumper = CDumper(stream=ofile, encoding='utf-8', allow_unicode=True, sort_keys=False, default_flow_style=False if self.pretty else None)
+        try:
+            dumper.open()
+            dumper.represent(obj)
+            dumper.close()
+        finally:
+            dumper.dispose()
+
+
+def _yaml_float(value: float) -> str:
+    # yaml 1.1 spells the special values its own way, and reads an exponent without a dot as a string
+    if value != value:
+        return '.nan'
+    if value in (float('inf'), float('-inf')):
+        return '.inf' if value > 0 else '-.inf'
+    text = repr(value)
+    if 'e' in text and '.' not in text:
+        mantissa, exponent = text.split('e')
+        text = f'{mantissa}.0e{exponent}'
+    return text
+
+
+class FlowYamlSerializer(ISerializer):
+    """
+    Hand-rolled yaml emitter: mappings in block style, every list item on its own line in json flow style
+    (compact) or everything in block style (pretty). Scalars are written as json, which is valid yaml,
+    so no quoting rules are involved; this is what keeps it fast on the long regular lists of proxies and rules.
+    """
+
+    name = 'flow-yaml'
+
+    def __init__(self, pretty: bool):
+        super().__init__(pretty)
+        self._encode: Callable[[Any], str] = json.JSONEncoder(ensure_ascii=False, separators=(', ', ': '), default=str).encode
+        self._keys: Dict[Any, str] = {}
+
+    def _scalar(self, value: Any) -> str:
+        if isinstance(value, float):
+            return _yaml_float(value)
+        text = self._encode(value)
+        if isinstance(value, str) and _YAML_UNPRINTABLE.search(text):
+            text = _YAML_UNPRINTABLE.sub(lambda m: f'\\u{ord(m.group(0)):04x}', text)
+        return text
+
+    def _key(self, key: Any) -> str:
+        if not isinstance(key, str):
+            # numbers, booleans and null stay plain scalars, so the key keeps its type
+            return self._scalar(key)
+        text = self._keys.get(key)
+        if text is None:
+            text = key
+            if not _YAML_PLAIN_KEY.fullmatch(text) or text.lower() in _YAML_RESERVED:
+                text = self._scalar(text)
+            self._keys[key] = text
+        return text
+
+    def _flow(self, value: Any) -> str:
+        if isinstance(value, dict):
+            return '{' + ', '.join(f'{self._key(k)}: {self._flow(v)}' for k, v in value.items()) + '}'
+        if isinstance(value, (list, tuple)):
+            return '[' + ', '.join(self._flow(v) for v in value) + ']'
+        return self._scalar(value)
+
+    def _block(self, value: Any, indent: str, out: List[str]) -> None:
+        # `value` is a non-empty dict or list; lines are appended to `out`
+        if isinstance(value, dict):
+            for k, v in value.items():
+                key = self._key(k)
+                if isinstance(v, (dict, list, tuple)) and len(v) > 0:
+                    out.append(f'{indent}{key}:\n')
+                    self._block(v, indent + '  ', out)
+                else:
+                    out.append(f'{indent}{key}: {self._flow(v)}\n')
+            return
+        for v in value:
+            if not self.pretty or not isinstance(v, (dict, list, tuple)) or len(v) == 0:
+                out.append(f'{indent}- {self._flow(v)}\n')
+                continue
+            # first entry of a nested collection goes on the line of the dash
+            inner: List[str] = []
+            self._block(v, indent + '  ', inner)
+            inner[0] = f'{indent}- {inner[0][len(indent) + 2:]}'
+            out.extend(inner)
+
+    def dump(self, obj: Any, ofile: BinaryIO) -> None:
+        out: List[str] = []
+        if isinstance(obj, (dict, list, tuple)) and len(obj) > 0:
+            self._block(obj, '', out)
+        else:
+            out.append(self._flow(obj) + '\n')
+        ofile.write(''.join(out).encode('utf-8'))
+
+
+JSON_SERIALIZERS: Dict[str, type] = {'json': StdJsonSerializer}
+if ujson is not None:
+    JSON_SERIALIZERS = {'ujson': UjsonSerializer, **JSON_SERIALIZERS}
+if orjson is not None:
+    JSON_SERIALIZERS = {'orjson': OrjsonSerializer, **JSON_SERIALIZERS}
+
+# the hand-rolled emitter is several times faster than libyaml on generated configs, but libyaml stays
+# the default where it is installed; `--serializer flow-yaml` opts in
+YAML_SERIALIZERS: Dict[str, type] = {'flow-yaml': FlowYamlSerializer}
+if CDumper is not None:
+    YAML_SERIALIZERS = {'libyaml': LibyamlSerializer, **YAML_SERIALIZERS}
+
+
+def load_json(data: Union[bytes, mmap]) -> Any:
+    """
+    Parse json with the fastest available backend; raises `ValueError` on invalid input. `data` may be a memory map.
+    """
+    if orjson is not None:
+        if isinstance(data, (bytes, bytearray, str)):
+            return orjson.loads(data)
+        with memoryview(data) as view:
+            return orjson.loads(view)
+    return json.loads(data if isinstance(data, (bytes, bytearray, str)) else bytes(data))
+
+
+def get_serializer(format: str, pretty: bool = True, name: Optional[str] = None) -> ISerializer:
+    """
+    The fastest available backend for `format` (`json` or `yaml`), or the one named.
+    """
+    backends = JSON_SERIALIZERS if format == 'json' else YAML_SERIALIZERS
+    if name is None:
+        return next(iter(backends.values()))(pretty)
+    cls = backends.get(name)
+    if cls is None:
+        raise ValueError(f'serializer {name} is not available for {format}; available: {", ".join(backends)}')
+    return cls(pretty)
+
+
+if __name__ == '__main__':
+    from io import BytesIO
+    from time import perf_counter
+
+    # benchmark on a config of 50k rules and 5k proxies
+    proxies = [{'name': f'🇭🇰 node-{i}', 'type': 'ss', 'server': f's{i}.example.com', 'port': 443, 'cipher': 'aes-128-gcm', 'password': 'p', 'udp': True} for i in range(5000)]
+    config = {
+        'mixed-port': 7890,
+        'dns': {'enable': True, 'nameserver': ['223.5.5.5', 'tls://1.1.1.1']},
+        'proxies': proxies,
+        'proxy-groups': [{'name': f'G{i}', 'type': 'select', 'proxies': [p['name'] for p in proxies[i::50]]} for i in range(50)],
+        'rules': [f'DOMAIN-SUFFIX,site{i}.example.com,G{i % 50}' for i in range(50000)] + ['MATCH,G0'],
+    }
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+    from yaml import load as yaml_load
+    for format, backends in (('json', JSON_SERIALIZERS), ('yaml', YAML_SERIALIZERS)):
+        for name in backends:
+            for pretty in (True, False):
+                s = get_serializer(format, pretty, name)
+                buf = BytesIO()
+                start = perf_counter()
+                s.dump(config, buf)
+                elapsed = perf_counter() - start
+                data = buf.getvalue()
+                loaded = json.loads(data) if format == 'json' else yaml_load(data, Loader=Loader)
+                print(f'{format:>4} {s!r:>22}: {elapsed * 1000:8.1f} ms, {len(data):>9} bytes, round trip {"ok" if loaded == config else "MISMATCH"}')
+    print(f'default: json -> {get_serializer("json")!r}, yaml -> {get_serializer("yaml")!r}')
@@ -0,0 +1,193 @@
+import gzip
+import hashlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Semaphore
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+GZIP_LEVEL = 6
+
+
+class IConfigRenderer(ABC):
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def fingerprint(self, name: str) -> str:
+        """
+        Digest of every input of the profile (subscriptions, template, options); must be cheap, it is computed per request.
+        """
+        pass
+
+    @abstractmethod
+    def render(self, name: str) -> Tuple[bytes, str]:
+        """
+        Config of the profile and its content type.
+        """
+        pass
+
+
+class RenderedConfig(object):
+
+    __slots__ = ('body', 'content_type', 'etag', 'etag_gzip', '_gzip')
+
+    body: bytes
+    content_type: str
+    etag: str
+    etag_gzip: str  # every representation gets its own strong tag
+
+    def __init__(self, body: bytes, content_type: str):
+        self.body = body
+        self.content_type = content_type
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = f'"{digest}"'
+        self.etag_gzip = f'"{digest}-gzip"'
+        self._gzip = None
+
+    def gzipped(self) -> bytes:
+        # compressed on first use only; a concurrent duplicate compression is harmless
+        if self._gzip is None:
+            self._gzip = gzip.compress(self.body, GZIP_LEVEL, mtime=0)
+        return self._gzip
+
+
+def accepts_gzip(header: Optional[str]) -> bool:
+    if not header:
+        return False
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        if coding.strip().lower() not in ('gzip', '*'):
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        return q > 0
+    return False
+
+
+def etag_matches(header: str, rendered: RenderedConfig) -> bool:
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == rendered.etag or tag == rendered.etag_gzip:
+            return True
+    return False
+
+
+class ConfigServer(ThreadingHTTPServer):
+    """
+    Serves `GET /<profile>`, rendering on demand. Outputs are kept per (profile, fingerprint) in a small LRU,
+    so polling clients cost a fingerprint and, with `If-None-Match`, a 304. Concurrent requests for the same
+    missing output wait for a single render, and at most `concurrency` renders run at once.
+    """
+
+    daemon_threads = True
+
+    renderer: IConfigRenderer
+    max_entries: int
+    renders: int
+
+    def __init__(self, address: Tuple[str, int], renderer: IConfigRenderer, concurrency: int = 2, max_entries: int = 32):
+        super().__init__(address, ConfigRequestHandler)
+        self.renderer = renderer
+        self.max_entries = max_entries
+        self.renders = 0
+        self._lock = Lock()
+        self._slots = Semaphore(concurrency)
+        self._cache: OrderedDict[Tuple[str, str], RenderedConfig] = OrderedDict()
+        self._flights: Dict[Tuple[str, str], Lock] = {}
+
+    def _lookup(self, key: Tuple[str, str]) -> Optional[RenderedConfig]:
+        # with self._lock
+        rendered = self._cache.get(key)
+        if rendered is not None:
+            self._cache.move_to_end(key)
+        return rendered
+
+    def get(self, name: str) -> RenderedConfig:
+        key = (name, self.renderer.fingerprint(name))
+        with self._lock:
+            rendered = self._lookup(key)
+            if rendered is not None:
+                return rendered
+            flight = self._flights.setdefault(key, Lock())
+        with flight:
+            with self._lock:
+                rendered = self._lookup(key)
+            if rendered is not None:
+                return rendered
+            try:
+                with self._slots:
+                    body, content_type = self.renderer.render(name)
+                rendered = RenderedConfig(body, content_type)
+                with self._lock:
+                    self._cache[key] = rendered
+                    while len(self._cache) > self.max_entries:
+                        self._cache.popitem(last=False)
+                    self.renders += 1
+            finally:
+                with self._lock:
+                    self._flights.pop(key, None)
+        return rendered
+
+
+class ConfigRequestHandler(BaseHTTPRequestHandler):
+
+    server: ConfigServer
+    server_version = 'clash-subscribe-tool'
+
+    def do_GET(self) -> None:
+        self._serve(True)
+
+    def do_HEAD(self) -> None:
+        self._serve(False)
+
+    def _serve(self, with_body: bool) -> None:
+        name = unquote(urlsplit(self.path).path.strip('/'))
+        if name not in self.server.renderer.names():
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        try:
+            rendered = self.server.get(name)
+        except Exception as e:
+            print(f'>! failed to render {name}', e)
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+        compressed = accepts_gzip(self.headers.get('Accept-Encoding'))
+        etag = rendered.etag_gzip if compressed else rendered.etag
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None and etag_matches(if_none_match, rendered):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self._send_cache_headers(etag)
+            self.end_headers()
+            return
+        body = rendered.gzipped() if compressed else rendered.body
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', rendered.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self._send_cache_headers(etag)
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _send_cache_headers(self, etag: str) -> None:
+        self.send_header('ETag', etag)
+        # clients may keep the config but have to revalidate it
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+
+    def log_message(self, format: str, *args) -> None:
+        print(f'># {self.address_string()} {format % args}')
@@ -1,26 +1,259 @@
 from collections.abc import Iterable
+import hashlib
 import importlib
-from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
-from urllib import request
+import zlib
+from os import fdopen, remove
+from queue import Empty, Queue
+from tempfile import mkstemp
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Type, Union
 
 from data import IConfigWriter, ISubscribeReader
+from http_pool import HTTPPool
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+# a few bytes of brotli can expand to gigabytes in one call; only the versions able to bound it (>= 1.2) are used
+if brotli is not None and not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+    brotli = None
 
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.5060.114 Safari/537.36 Edg/103.0.1264.62'
 
-def download_config(url: str, timeout: int = 5000) -> Tuple[bytes, Optional[str]]:
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# decompression bomb limits
+MAX_DECODED_SIZE = 256 * 1024 * 1024
+MAX_DECODED_RATIO = 200
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+
+class ContentDecoder:
+    """
+    Incremental decoder for a `Content-Encoding`, bounded by `MAX_DECODED_SIZE` and `MAX_DECODED_RATIO`.
+    """
+
+    encoding: str
+    wire_size: int
+    size: int
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self.wire_size = 0
+        self.size = 0
+        self._inner = None
+        if encoding == 'gzip' or encoding == 'x-gzip':
+            self._inner = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._inner = None  # zlib-wrapped or raw, decided by the first byte
+        elif encoding == 'br' and brotli is not None:
+            self._inner = brotli.Decompressor()
+        elif encoding != 'identity' and encoding != '':
+            raise ValueError(f'unsupported content encoding: {encoding}')
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        self.wire_size += len(data)
+        if self.encoding == 'identity' or self.encoding == '':
+            yield self._count(data)
+        elif self.encoding == 'br':
+            yield self._count(self._inner.process(data, output_buffer_limit=DOWNLOAD_CHUNK_SIZE))
+            while not self._inner.can_accept_more_data():
+                yield self._count(self._inner.process(b'', output_buffer_limit=DOWNLOAD_CHUNK_SIZE))
+        else:
+            if self._inner is None:
+                # RFC 9110 deflate is zlib-wrapped, but some servers send raw deflate
+                raw = len(data) < 2 or (data[0] & 0x0f) != 8 or (data[0] << 8 | data[1]) % 31 != 0
+                self._inner = zlib.decompressobj(-zlib.MAX_WBITS if raw else zlib.MAX_WBITS)
+            gzip = self.encoding != 'deflate'
+            while data:
+                if gzip and self._inner.eof:
+                    # a gzip body may hold several members, one after the other; zeros may pad the last one
+                    data = data.lstrip(b'\x00')
+                    if not data:
+                        break
+                    self._inner = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                yield self._count(self._inner.decompress(data, DOWNLOAD_CHUNK_SIZE))
+                data = self._inner.unconsumed_tail
+                if not data and gzip and self._inner.eof:
+                    data = self._inner.unused_data
+
+    def flush(self) -> bytes:
+        if self._inner is not None and self.encoding != 'br':
+            return self._count(self._inner.flush())
+        return b''
+
+    def _count(self, data: bytes) -> bytes:
+        self.size += len(data)
+        if self.size > MAX_DECODED_SIZE:
+            raise ValueError(f'decoded body exceeds {MAX_DECODED_SIZE} bytes')
+        if self.encoding not in ('identity', '') and self.size > MAX_DECODED_RATIO * max(self.wire_size, DOWNLOAD_CHUNK_SIZE):
+            raise ValueError(f'decoded body exceeds ratio {MAX_DECODED_RATIO}')
+        return data
+
+
+class DownloadResult:
+
+    filename: Optional[str]
+    status: int
+    encoding: str
+    wire_size: int
+    size: int
+    sha256: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    def __init__(self, filename: Optional[str], status: int, encoding: str, wire_size: int, size: int, sha256: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.filename = filename
+        self.status = status
+        self.encoding = encoding
+        self.wire_size = wire_size
+        self.size = size
+        self.sha256 = sha256
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def ratio(self) -> float:
+        return self.size / self.wire_size if self.wire_size > 0 else 1.0
+
+    def __repr__(self) -> str:
+        return f'DownloadResult(filename={self.filename}, status={self.status}, encoding={self.encoding}, wire_size={self.wire_size}, size={self.size}, sha256={self.sha256[:12]})'
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def download_config(url: str, ofile: BinaryIO, timeout: int = 5000, pool: Optional[HTTPPool] = None, cancel: Optional[Event] = None, extra_headers: Optional[Dict[str, str]] = None) -> DownloadResult:
+    """
+    Stream the response body into `ofile` in large chunks, decoding and hashing it on the way.
+    Connections are taken from `pool` so that downloads from the same host share keep-alive connections.
+    With conditional `extra_headers`, a `304` is returned with an empty body.
+    """
+    if pool is None:
+        with HTTPPool() as pool:
+            return download_config(url, ofile, timeout, pool, cancel, extra_headers)
     filename: str | None = None
-    req = request.Request(url)
-    req.add_header('User-Agent', USER_AGENT)
-    resp = request.urlopen(req, timeout=timeout/1000.0)
-    content_disposition = [p.strip() for p in resp.getheader('Content-Disposition', default='').split(';')]
-    if len(content_disposition) >= 2 and content_disposition[0] == "attachment":
-        for kv in content_disposition[1:]:
-            q = kv.split('=', 1)
-            if len(q) == 2 and q[0] == 'filename':
-                filename = q[1]
+    headers = {
+        'User-Agent': USER_AGENT,
+        'Accept-Encoding': ACCEPT_ENCODING,
+    }
+    if extra_headers:
+        headers.update(extra_headers)
+    with pool.request('GET', url, headers, timeout/1000.0) as resp:
+        content_disposition = [p.strip() for p in resp.getheader('Content-Disposition', default='').split(';')]
+        if len(content_disposition) >= 2 and content_disposition[0] == "attachment":
+            for kv in content_disposition[1:]:
+                q = kv.split('=', 1)
+                if len(q) == 2 and q[0] == 'filename':
+                    filename = q[1]
+                    break
+        decoder = ContentDecoder(resp.getheader('Content-Encoding', default='identity').strip().lower())
+        digest = hashlib.sha256()
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled(url)
+            chunk = resp.read1(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
                 break
-    raw = resp.read()
-    return raw, filename
+            for data in decoder.feed(chunk):
+                digest.update(data)
+                ofile.write(data)
+        data = decoder.flush()
+        digest.update(data)
+        ofile.write(data)
+        status = resp.status
+        etag = resp.getheader('ETag')
+        last_modified = resp.getheader('Last-Modified')
+    return DownloadResult(filename, status, decoder.encoding, decoder.wire_size, decoder.size, digest.hexdigest(), etag, last_modified)
+
+
+class MirrorAttempt:
+
+    url: str
+    path: Optional[str]
+    result: Optional[DownloadResult]
+    error: Optional[BaseException]
+    latency: float
+    done: bool
+
+    def __init__(self, url: str):
+        self.url = url
+        self.path = None
+        self.result = None
+        self.error = None
+        self.latency = 0.0
+        self.done = False
+
+    @property
+    def cancelled(self) -> bool:
+        return not self.done or isinstance(self.error, DownloadCancelled)
+
+
+def download_hedged(urls: List[str], tmp_dir: str, timeout: int = 5000, pool: Optional[HTTPPool] = None, hedge_delay: int = 2000, cancel: Optional[Event] = None) -> Tuple[Optional[MirrorAttempt], List[MirrorAttempt]]:
+    """
+    Download from the first url, and start the next mirror whenever no attempt has completed within `hedge_delay` ms
+    or an attempt failed. The first complete, non-empty body wins and the other attempts are cancelled.
+    Returns the winner, whose body is left in the temporary file `path` for the caller to consume and remove,
+    and every attempt started. Setting `cancel` aborts every attempt and starts no other one.
+    """
+    if cancel is None:
+        cancel = Event()
+    lock = Lock()
+    finished: Queue = Queue()
+    attempts: List[MirrorAttempt] = []
+    winner: List[MirrorAttempt] = []
+
+    def run(attempt: MirrorAttempt) -> None:
+        start = monotonic()
+        fd, attempt.path = mkstemp(dir=tmp_dir, suffix='.download')
+        try:
+            with fdopen(fd, 'wb') as ofile:
+                attempt.result = download_config(attempt.url, ofile, timeout, pool, cancel)
+            if attempt.result.size == 0:
+                raise ValueError('empty response')
+        except BaseException as e:
+            attempt.error = e
+        attempt.latency = monotonic() - start
+        with lock:
+            if attempt.error is None and not winner:
+                winner.append(attempt)
+            else:
+                remove(attempt.path)
+                attempt.path = None
+                if attempt.error is None:
+                    attempt.error = DownloadCancelled(attempt.url)
+            attempt.done = True
+        finished.put(attempt)
+
+    def start_next() -> None:
+        attempt = MirrorAttempt(urls[len(attempts)])
+        attempts.append(attempt)
+        Thread(target=run, args=(attempt,), daemon=True).start()
+
+    start_next()
+    running = 1
+    while running > 0:
+        try:
+            attempt = finished.get(timeout=hedge_delay/1000.0 if len(attempts) < len(urls) else None)
+        except Empty:
+            if not cancel.is_set():
+                start_next()
+                running += 1
+            continue
+        running -= 1
+        if attempt.error is None:
+            cancel.set()
+            return attempt, attempts
+        if len(attempts) < len(urls) and not cancel.is_set():
+            start_next()
+            running += 1
+    return None, attempts
 
 
 
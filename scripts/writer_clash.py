@@ -1,11 +1,17 @@
-from typing import BinaryIO, Dict, List, Optional
-from data import IConfigWriter, Proxy, ProxyGroup, Rule
+from os import getpid, makedirs, path, replace
+from typing import Any, BinaryIO, Dict, List, Optional, Set, Tuple
+from data import IConfigWriter, Proxy, ProxyGroup, Rule, RuleType, collect_sub_rules, rule_set_names
+from diagnostics import UNRESOLVED_RULE_PROVIDER, collector
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import CLoader as Loader
 except ImportError as e:
     print('[warning] unable to load libyaml; use python module instead', e)
-    from yaml import Loader, Dumper
+    from yaml import Loader
 from jinja2 import Template
+from time import perf_counter
+
+from rule_provider import FORMAT_EXTENSIONS, TYPE_FILE, TYPE_HTTP, RuleProvider, RuleProviders
+from serializer import ISerializer, get_serializer
 
 from utils import insert_in_list
 
@@ -16,38 +22,132 @@ RULE_PLACEHOLDER = '__RULE_PLACEHOLDER__'
 class ClashConfigWriter(IConfigWriter):
 
     _template: Optional[Template]
+    _serializer: ISerializer
+    _rule_providers: Optional[RuleProviders]
+    _rule_set_dir: str
+    _home_dir: str  # directory of the config, which the core resolves provider paths against
 
     def __init__(self):
         super().__init__()
         self._template = None
+        self._serializer = get_serializer('yaml')
+        self._rule_providers = None
+        self._rule_set_dir = path.abspath('ruleset')
+        self._home_dir = path.abspath(path.curdir)
+
+    def configure(self, pretty: bool = True, serializer: Optional[str] = None, rule_providers: Optional[RuleProviders] = None, rule_set_dir: Optional[str] = None, home_dir: Optional[str] = None, **options) -> None:
+        self._serializer = get_serializer('yaml', pretty, serializer)
+        self._rule_providers = rule_providers
+        if rule_set_dir is not None:
+            self._rule_set_dir = rule_set_dir
+        if home_dir is not None:
+            self._home_dir = home_dir
 
     def template(self, ifile: BinaryIO) -> None:
         content = ifile.read().decode('utf-8')
         self._template = Template(content)
 
-    def write(self, ofile: BinaryIO, proxies: List[Proxy], proxy_groups: List[ProxyGroup], rules: List[Rule], **kwargs) -> None:
+    def _render(self, **kwargs) -> Dict[str, Any]:
         if self._template is None:
             raise ValueError('template not initialized')
         content = self._template.render(**kwargs)
         loader = Loader(stream=content)
-        template = None
         try:
-            template = loader.get_single_data()
+            return loader.get_single_data()
         finally:
             loader.dispose()
+
+    def rule_providers(self, **kwargs) -> Dict[str, Dict]:
+        providers = self._render(**kwargs).get('rule-providers')
+        if not isinstance(providers, dict):
+            return {}
+        return {name: provider for name, provider in providers.items() if isinstance(provider, dict)}
+
+    def _local_rule_provider(self, provider: RuleProvider) -> Dict[str, Any]:
+        # named by content: an unchanged provider is not written again, and the config does not change
+        filename = path.join(self._rule_set_dir, f'{provider.id}.{FORMAT_EXTENSIONS.get(provider.format, provider.format)}')
+        if not path.exists(filename):
+            makedirs(self._rule_set_dir, exist_ok=True)
+            # profiles rendered in parallel may write the same file
+            tmp_filename = f'{filename}.{getpid()}.tmp'
+            with open(tmp_filename, 'wb') as ofile:
+                ofile.write(provider.content)
+            replace(tmp_filename, filename)
+        relpath = path.relpath(filename, self._home_dir)
+        return {
+            'type': 'file',
+            'behavior': provider.behavior,
+            'format': provider.format,
+            'path': filename if relpath.startswith('..') else f'./{relpath}',
+        }
+
+    def _write_rule_providers(self, declared: Optional[Dict], rules: List[Rule]) -> Tuple[Dict[str, Any], Set[str]]:
+        """
+        Rule providers of the config, and the names of those the rules refer to but the config cannot have.
+        """
+        result = dict(declared or {})
+        missing = set()
+        providers = self._rule_providers
+        if providers is None:
+            return result, missing
+        for name in sorted(rule_set_names(rules)):
+            spec = providers.spec(name)
+            if name in result or spec is None:
+                continue
+            if spec.get('type') == TYPE_HTTP:
+                # the path chosen by the subscription may collide with another one; the core picks its own
+                result[name] = {key: value for key, value in spec.items() if key != 'path'}
+            elif spec.get('type') == TYPE_FILE:
+                # a file of the subscription's author; only a copy read here can be used
+                provider = providers.get(spec, self._home_dir)
+                if provider is not None:
+                    result[name] = self._local_rule_provider(provider)
+                else:
+                    missing.add(name)
+            else:
+                result[name] = spec
+        for name, spec in result.items():
+            if isinstance(spec, dict) and spec.get('type') == TYPE_HTTP:
+                provider = providers.get(spec, self._home_dir)
+                if provider is not None:
+                    result[name] = self._local_rule_provider(provider)
+        return result, missing
+
+    def _drop_rules(self, rules: List[Rule], missing: Set[str]) -> List[Rule]:
+        # the core refuses a config whose rules name an unknown provider
+        result = []
+        for r in rules:
+            names = [cond.match for cond in r.cond.walk() if cond.type == RuleType.RULE_SET and cond.match in missing]
+            if names:
+                collector.record(UNRESOLVED_RULE_PROVIDER, r.raw, f'rule dropped, {names[0]} not found')
+                self.dropped_rules += 1
+            else:
+                result.append(r)
+        return result
+
+    def write(self, ofile: BinaryIO, proxies: List[Proxy], proxy_groups: List[ProxyGroup], rules: List[Rule], **kwargs) -> None:
+        template = self._render(**kwargs)
+        self.dropped_rules = 0
+        rule_providers, missing = self._write_rule_providers(template.get('rule-providers'), rules)
+        if missing:
+            rules = self._drop_rules(rules, missing)
         template_proxies = template.get('proxies')
-        template['proxies'] = insert_in_list(template_proxies, lambda x: x.get('name') == PROXY_PLACEHOLDER, [p.inner for p in proxies])
+        template['proxies'] = insert_in_list(template_proxies, lambda x: x.get('name') == PROXY_PLACEHOLDER, [p.to_clash() for p in proxies])
         template_proxy_groups = template.get('proxy-groups')
         template['proxy-groups'] = insert_in_list(template_proxy_groups, lambda x: x.get('name') == PROXY_GROUP_PLACEHOLDER, [pg.inner for pg in proxy_groups])
         template_rules = template.get('rules')
         template['rules'] = insert_in_list(template_rules, lambda x: x == RULE_PLACEHOLDER, [rule.raw for rule in rules])
-        dumper = Dumper(stream=ofile, encoding='utf-8', allow_unicode=True, sort_keys=False)
-        try:
-            dumper.open()
-            dumper.represent(template)
-            dumper.close()
-        finally:
-            dumper.dispose()
+        sub_rules = collect_sub_rules(rules)
+        if len(sub_rules) > 0:
+            template_sub_rules = template.get('sub-rules') or {}
+            for name, items in sub_rules.items():
+                template_sub_rules[name] = [rule.raw for rule in (self._drop_rules(items, missing) if missing else items)]
+            template['sub-rules'] = template_sub_rules
+        if len(rule_providers) > 0:
+            template['rule-providers'] = rule_providers
+        start = perf_counter()
+        self._serializer.dump(template, ofile)
+        print(f'># serialized with {self._serializer} in {(perf_counter() - start) * 1000:.0f}ms')
 
 
 
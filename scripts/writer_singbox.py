@@ -1,11 +1,16 @@
-from io import TextIOWrapper
-from typing import Any, BinaryIO, Dict, List, Optional, Set, Tuple
+import re
+from os import getpid, makedirs, path, replace
+from time import perf_counter
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Set, Tuple
 from collections import OrderedDict
 
 from jinja2 import Template
-from data import IConfigWriter, Proxy, ProxyGroup, Rule, RuleType
+from data import LOGICAL_RULE_TYPES, Condition, IConfigWriter, Proxy, ProxyGroup, Rule, RuleType, ShadowsocksProxy, VmessProxy
+from diagnostics import UNKNOWN_GEO_KEY, UNSUPPORTED_PROXY, UNSUPPORTED_PROXY_GROUP, UNSUPPORTED_RULE, collector
+from geodata import DOMAIN_FULL, DOMAIN_PLAIN, DOMAIN_REGEX, DOMAIN_ROOT, GeoData
 from pyjson5 import loads as json5_loads
-from json import dump as json_dump
+from rule_provider import BEHAVIOR_DOMAIN, BEHAVIOR_IPCIDR, FORMAT_MRS, RuleProvider, RuleProviders
+from serializer import ISerializer, get_serializer
 
 from utils import insert_in_list
 
@@ -38,7 +43,11 @@ CLASH2SINGBOX_ALLOWED_RULETYPES: Dict[RuleType, str] = {
     RuleType.UID: 'user_id',
     RuleType.NETWORK: 'network',
     #RuleType.DSCP: None, # not supported in singbox
-    RuleType.RULE_SET: '',
+    RuleType.RULE_SET: 'rule_set',    # local rule set converted from the provider
+    RuleType.LOGICAL_AND: 'logical',
+    RuleType.LOGICAL_OR: 'logical',
+    RuleType.LOGICAL_NOT: 'logical',
+    RuleType.SUB_RULE: 'logical',   # inlined as logical rules
     RuleType.MATCH: ''
 }
 
@@ -51,6 +60,14 @@ CLASH2SINGBOX_GROUP_DOMAIN_KEYS: Set[RuleType] = {
     RuleType.IP_CIDR6
 }
 
+# conditions a rule set cannot hold: sing-box rule sets do not reference other rule sets
+RULE_SET_NESTED_TYPES: Set[RuleType] = {
+    RuleType.GEOSITE,
+    RuleType.GEOIP,
+    RuleType.SRC_GEOIP,
+    RuleType.RULE_SET,
+}
+
 SINGBOX_GEOIP_RULESET: Dict[str, Dict] = {
     'CN': {
         "type": "remote",
@@ -75,28 +92,74 @@ SINGBOX_GEOSITE_RULESET: Dict[str, Dict] = {
     }
 }
 
+GEOSITE_FIELDS: Dict[int, str] = {
+    DOMAIN_PLAIN: 'domain_keyword',
+    DOMAIN_REGEX: 'domain_regex',
+    DOMAIN_ROOT: 'domain_suffix',
+    DOMAIN_FULL: 'domain',
+}
+
 class Clash2SingboxTransformer:
 
     geoip: Dict[str, Any]
     geosite: Dict[str, Any]
+    rule_providers: Dict[str, Any]  # rule provider name -> local rule set
     match_rule_target: Optional[str]
+    dropped_rules: int  # rules that cannot be expressed in singbox
+    geodata: Optional[GeoData]  # local geo databases; referenced tags become local rule sets
+    rule_set_dir: str
+    rule_set_serializer: ISerializer
+    providers: Optional[RuleProviders]  # resolved rule providers, converted to local rule sets
+    home_dir: str
+    _proxy_transforms: Dict[type, Callable[[Any], dict]]
 
     def __init__(self):
         self.geoip = dict()
         self.geosite = dict()
+        self.rule_providers = dict()
         self.match_rule_target = None
+        self.dropped_rules = 0
+        self.geodata = None
+        self.rule_set_dir = path.abspath('ruleset')
+        self.rule_set_serializer = get_serializer('json', False)
+        self.providers = None
+        self.home_dir = path.abspath(path.curdir)
+        # typed proxy class -> emitter
+        self._proxy_transforms = {
+            ShadowsocksProxy: self._ss_transform,
+            VmessProxy: self._vmess_transform,
+        }
 
     def transform_proxy(self, proxy: Proxy) -> dict:
-        match proxy.type:
-            case 'vmess':
-                return self._vmess_transform(proxy.inner)
-            case 'ss':
-                return self._ss_transform(proxy.inner)
-            case _:
-                raise NotImplementedError(f"Proxy type '{proxy.type}' is not supported yet.")
+        transform = self._proxy_transforms.get(type(proxy))
+        if transform is None:
+            raise NotImplementedError(f"Proxy type '{proxy.type}' is not supported yet.")
+        return transform(proxy)
             
     def transform_proxy_group(self, group: ProxyGroup) -> dict:
-        # TODO: handle url test: "type": "urltest"
+        if group.inner.get('include-all-providers'):
+            # the other dynamic members were expanded when the subscription was read
+            if not group.inner['proxies']:
+                raise NotImplementedError('members only come from proxy providers, which are not resolved')
+            collector.record(UNSUPPORTED_PROXY_GROUP, group.name, 'the proxies of providers are left out')
+        group_type = group.inner.get('type')
+        if group_type in ('url-test', 'fallback'):
+            # singbox has no fallback outbound; urltest is the closest
+            result = {
+                'type': 'urltest',
+                'tag': group.name,
+                'outbounds': group.inner['proxies'],
+            }
+            url = group.inner.get('url')
+            if url:
+                result['url'] = url
+            interval = group.inner.get('interval')
+            if interval:
+                result['interval'] = f'{interval}s'
+            tolerance = group.inner.get('tolerance')
+            if tolerance is not None:
+                result['tolerance'] = tolerance
+            return result
         result = {
             'type': 'selector',
             'tag': group.name,
@@ -104,24 +167,46 @@ class Clash2SingboxTransformer:
         }
         return result
     
-    def transform_rules(self, rules: List[Rule]) -> List[dict]:
-        # group by target
-        rules_grouped: OrderedDict[str, List[Rule]] = OrderedDict()
+    def _supported(self, rule: Rule) -> bool:
+        if CLASH2SINGBOX_ALLOWED_RULETYPES.get(rule.type) is None:
+            collector.record(UNSUPPORTED_RULE, rule, 'rule type not supported in singbox')
+            self.dropped_rules += 1
+            return False
+        return True
+
+    def _group_rules(self, rules: List[Rule]) -> List[Tuple[str, List[Rule]]]:
+        """
+        Rules by target, in the order of the first rule of each target. The rules inlined from a sub-rule keep
+        their place: nothing is grouped across them, and among them only consecutive rules to the same target are.
+        """
+        result: List[Tuple[str, List[Rule]]] = []
+        grouped: OrderedDict[str, List[Rule]] = OrderedDict()
         for rule in rules:
-            tgt = CLASH2SINGBOX_ALLOWED_RULETYPES.get(rule.type)
-            if tgt is None:
-                # TODO: log
-                print(f'>! rule type {rule.type} is not supported in singbox, skipped')
-                continue
-            target = rule.strategy
-            rule_grouped_items = rules_grouped.get(target)
-            if rule_grouped_items is None:
-                rule_grouped_items = []
-                rules_grouped[target] = rule_grouped_items
-            rule_grouped_items.append(rule)
+            if rule.type == RuleType.SUB_RULE:
+                result.extend(grouped.items())
+                grouped = OrderedDict()
+                run = None
+                for inlined in self._inline_sub_rules([rule], None, set()):
+                    if not self._supported(inlined):
+                        continue
+                    if run is not None and run[0] == inlined.strategy:
+                        run[1].append(inlined)
+                    else:
+                        run = (inlined.strategy, [inlined])
+                        result.append(run)
+            elif self._supported(rule):
+                rule_grouped_items = grouped.get(rule.strategy)
+                if rule_grouped_items is None:
+                    rule_grouped_items = []
+                    grouped[rule.strategy] = rule_grouped_items
+                rule_grouped_items.append(rule)
+        result.extend(grouped.items())
+        return result
+
+    def transform_rules(self, rules: List[Rule]) -> List[dict]:
         result = list()
         match_rule = None
-        for outbound, rules in rules_grouped.items():
+        for outbound, rules in self._group_rules(rules):
             print(f'> {len(rules)} rules to {outbound}')
             group_domain: Optional[Dict[str, List]] = None # field -> values # domain || domain_suffix || domain_keyword || domain_regex || [geosite] || [geoip] || ip_cidr || ip_is_private
             group_geosite: Optional[Dict[str, Any]] = None # GEO-KEY -> value geosite
@@ -130,9 +215,18 @@ class Clash2SingboxTransformer:
             group_src_ip: Optional[Dict[str, List]] = None # field -> values # [source_geoip] || source_ip_cidr || source_ip_is_private
             group_src_geoip: Optional[Dict[str, Any]] = None # GEO-KEY -> value # source_geoip
             group_src_port: Optional[Dict[str, List]] = None # field -> values # src_port || src_port_range
+            group_rule_set: Optional[Dict[str, Any]] = None # rule set tag -> value # rule providers
             group_others: OrderedDict[RuleType, Dict[str, Any]] = OrderedDict() # other rules that cannot be grouped
+            group_logical: List[Dict[str, Any]] = [] # logical rules, kept one by one
             for rule in rules:
-                if rule.type in CLASH2SINGBOX_GROUP_DOMAIN_KEYS:
+                if rule.type in LOGICAL_RULE_TYPES:
+                    obj = self._logical_rule(rule.cond)
+                    if obj is None:
+                        collector.record(UNSUPPORTED_RULE, rule, 'conditions not supported in singbox')
+                        self.dropped_rules += 1
+                    else:
+                        group_logical.append(obj)
+                elif rule.type in CLASH2SINGBOX_GROUP_DOMAIN_KEYS:
                     if group_domain is None:
                         group_domain = dict()
                     field = CLASH2SINGBOX_ALLOWED_RULETYPES[rule.type]
@@ -166,6 +260,15 @@ class Clash2SingboxTransformer:
                     if group_src_geoip is None:
                         group_src_geoip = dict()
                     group_src_geoip[rule.match] = True
+                elif rule.type == RuleType.RULE_SET:
+                    tag = self._mark_rule_provider(rule.match)
+                    if tag is None:
+                        collector.record(UNSUPPORTED_RULE, rule, 'rule provider not resolved or in mrs format')
+                        self.dropped_rules += 1
+                        continue
+                    if group_rule_set is None:
+                        group_rule_set = dict()
+                    group_rule_set[tag] = True
                 elif rule.type == RuleType.SRC_PORT:
                     if group_src_port is None:
                         group_src_port = dict()
@@ -187,10 +290,12 @@ class Clash2SingboxTransformer:
                         values.append(rule.match)
                     elif rule.type == RuleType.MATCH:
                         if match_rule is not None:
-                            print(f'>! multiple match rules found, only the first one is kept, others are skipped')
+                            collector.record(UNSUPPORTED_RULE, rule, 'only the first MATCH rule is kept')
+                            self.dropped_rules += 1
                         match_rule = rule
                     else:    
-                        print(f'>! rule type {rule.type} unimplemented, skipped')
+                        collector.record(UNSUPPORTED_RULE, rule, 'unimplemented')
+                        self.dropped_rules += 1
             if group_domain is not None:
                 obj = self._gen_rule(group_domain, outbound)
                 result.append(obj)
@@ -202,6 +307,9 @@ class Clash2SingboxTransformer:
                 for geo_key in group_geoip.keys():
                     obj = self._gen_geoip_rule(geo_key, outbound)
                     result.append(obj)
+            if group_rule_set is not None:
+                obj = self._gen_rule({'rule_set': list(group_rule_set.keys())}, outbound)
+                result.append(obj)
             if group_port is not None:
                 obj = self._gen_rule(group_port, outbound)
                 result.append(obj)
@@ -218,33 +326,113 @@ class Clash2SingboxTransformer:
             for _, rule_obj in group_others.items():
                 obj = self._gen_rule(rule_obj, outbound)
                 result.append(obj)
+            for rule_obj in group_logical:
+                obj = self._gen_rule(rule_obj, outbound)
+                result.append(obj)
         if match_rule is not None:
             self.match_rule_target = match_rule.strategy
         return result
     
+    def _inline_sub_rules(self, rules: List[Rule], prefix: Optional[Condition], visiting: Set[str]) -> List[Rule]:
+        # singbox has no sub-rules: `SUB-RULE,(cond),name` becomes `AND,((cond),(rule))` for every rule of the sub-rule
+        result = []
+        for rule in rules:
+            if rule.type == RuleType.SUB_RULE:
+                if rule.sub_rules is None or rule.strategy in visiting:
+                    collector.record(UNSUPPORTED_RULE, rule, 'sub-rule missing or recursive')
+                    self.dropped_rules += 1
+                    continue
+                cond = rule.cond.children[0]
+                if prefix is not None:
+                    cond = Condition.make(RuleType.LOGICAL_AND, children=(prefix, cond))
+                visiting.add(rule.strategy)
+                result.extend(self._inline_sub_rules(rule.sub_rules, cond, visiting))
+                visiting.discard(rule.strategy)
+            elif prefix is None:
+                result.append(rule)
+            elif rule.type == RuleType.MATCH:
+                result.append(Rule.of(prefix, rule.strategy))
+            else:
+                result.append(Rule.of(Condition.make(RuleType.LOGICAL_AND, children=(prefix, rule.cond)), rule.strategy))
+        return result
+
+    def _logical_rule(self, cond: Condition) -> Optional[dict]:
+        if cond.type == RuleType.LOGICAL_NOT:
+            inner = self._headless_rule(cond.children[0])
+            if inner is None:
+                return None
+            inner['invert'] = not inner.get('invert', False)
+            return inner
+        children = []
+        for c in cond.children:
+            obj = self._headless_rule(c)
+            if obj is None:
+                return None
+            children.append(obj)
+        return {
+            'type': 'logical',
+            'mode': 'and' if cond.type == RuleType.LOGICAL_AND else 'or',
+            'rules': children,
+        }
+
+    def _headless_rule(self, cond: Condition) -> Optional[dict]:
+        if cond.type in LOGICAL_RULE_TYPES:
+            return self._logical_rule(cond)
+        field = CLASH2SINGBOX_ALLOWED_RULETYPES.get(cond.type)
+        if not field:
+            return None
+        if cond.type == RuleType.GEOSITE:
+            geo_key = cond.match.upper()
+            self._mark_geosite(geo_key)
+            return {'rule_set': f'geosite-{geo_key.lower()}'}
+        if cond.type == RuleType.GEOIP or cond.type == RuleType.SRC_GEOIP:
+            geo_key = cond.match.upper()
+            self._mark_geoip(geo_key)
+            obj = {'rule_set': f'geoip-{geo_key.lower()}'}
+            if cond.type == RuleType.SRC_GEOIP:
+                obj['rule_set_ipcidr_match_source'] = True
+            return obj
+        if cond.type == RuleType.RULE_SET:
+            tag = self._mark_rule_provider(cond.match)
+            return {'rule_set': tag} if tag is not None else None
+        if cond.type == RuleType.DST_PORT or cond.type == RuleType.SRC_PORT:
+            single_field, range_field = field.split(';')
+            single, ranges = Clash2SingboxTransformer.parse_port_range(cond.match)
+            obj = {}
+            if len(single) > 0:
+                obj[single_field] = single
+            if len(ranges) > 0:
+                obj[range_field] = [f'{r[0]}:{r[1]}' for r in ranges]
+            return obj
+        if cond.type == RuleType.NETWORK:
+            return {field: [cond.match.lower()]}
+        return {field: [cond.match]}
+
     def clear(self):
         self.geoip.clear()
         self.geosite.clear()
+        self.rule_providers.clear()
         self.match_rule_target = None
+        self.dropped_rules = 0
 
-    def _ss_transform(self, proxy: dict) -> dict:
+    def _ss_transform(self, proxy: ShadowsocksProxy) -> dict:
         result = {
             'type': 'shadowsocks',
-            'tag': proxy['name'],
-            'server': proxy['server'],
-            'server_port': proxy['port'],
-            'method': proxy['cipher'],
-            'password': proxy['password'],
+            'tag': proxy.name,
+            'server': proxy.server,
+            'server_port': proxy.port,
+            'method': proxy.cipher,
+            'password': proxy.password,
         }
-        if proxy.get('udp', False) == False:
-            result['network'] = 'tcp',
-        plugin = proxy.get('plugin')
+        if not proxy.udp:
+            result['network'] = 'tcp'
+        plugin = proxy.plugin
         if plugin == 'obfs':
-            plugin_opts = proxy['plugin-opts']
+            plugin_opts = proxy.plugin_opts
             result['plugin'] = 'obfs-local'
-            result['plugin_opts'] = f'obfs={plugin_opts['mode']};obfs-host={plugin_opts['host']}'
+            result['plugin_opts'] = 'obfs=' + plugin_opts['mode'] + ';obfs-host=' + plugin_opts['host']
         elif plugin == 'v2ray-plugin':
-            plugin_opts = proxy.get['plugin-opts']
+            plugin_opts = proxy.plugin_opts
             # TODO: v2ray-plugin
             pass
         elif plugin is not None:
@@ -252,16 +440,16 @@ class Clash2SingboxTransformer:
         # TODO: Dial Fields
         return result
     
-    def _vmess_transform(self, proxy: dict) -> dict:
+    def _vmess_transform(self, proxy: VmessProxy) -> dict:
         result = {
             'type': 'vmess',
-            'tag': proxy['name'],
-            'server': proxy['server'],
-            'server_port': proxy['port'],
-            'uuid': proxy['uuid'],
-            'security': proxy.get('cipher', 'auto'),
+            'tag': proxy.name,
+            'server': proxy.server,
+            'server_port': proxy.port,
+            'uuid': proxy.uuid,
+            'security': proxy.cipher or 'auto',
         }
-        alter = proxy.get('alterId')
+        alter = proxy.alter_id
         if alter is not None:
             if isinstance(alter, str):
                 try:
@@ -270,17 +458,17 @@ class Clash2SingboxTransformer:
                     result['alter_id'] = alter
             else:
                 result['alter_id'] = alter
-        if proxy.get('udp', False) == False:
+        if not proxy.udp:
             result['network'] = 'tcp'
-        clash_network = proxy.get('network')
+        clash_network = proxy.network
         if clash_network == 'tcp':
             pass
         elif clash_network == 'http':
-            http_opts = proxy['http-opts']
+            http_opts = proxy.http_opts
             result_transport = {
                 'type': 'http',
             }
-            servername = proxy.get('servername')
+            servername = proxy.servername
             if servername:
                 result_transport['host'] = [servername]
             path = http_opts.get('path')
@@ -294,11 +482,11 @@ class Clash2SingboxTransformer:
                 result_transport['headers'] = headers
             result['transport'] = result_transport
         elif clash_network == 'h2':
-            h2_opts = proxy['h2-opts']
+            h2_opts = proxy.h2_opts
             result_transport = {
                 'type': 'http',
             }
-            servername = proxy.get('servername')
+            servername = proxy.servername
             if servername:
                 result_transport['host'] = [servername]
             path = h2_opts.get('path')
@@ -307,11 +495,11 @@ class Clash2SingboxTransformer:
             headers = h2_opts.get('headers')
             if headers:
                 result_transport['headers'] = headers
-            result_transport["idle_timeout"] = "15s",
+            result_transport["idle_timeout"] = "15s"
             result_transport["ping_timeout"] = "15s"
             result['transport'] = result_transport
         elif clash_network == 'grpc':
-            grpc_opts = proxy['grpc-opts']
+            grpc_opts = proxy.grpc_opts
             result_transport = {
                 'type': 'grpc',
             }
@@ -320,7 +508,7 @@ class Clash2SingboxTransformer:
                 result_transport['service_name'] = grpc_service_name
             result['transport'] = result_transport
         elif clash_network == 'ws':
-            ws_opts = proxy['ws-opts']
+            ws_opts = proxy.ws_opts
             v2ray_http_upgrade = ws_opts.get('v2ray-http-upgrade')
             if not v2ray_http_upgrade:
                 result_transport = {
@@ -343,7 +531,7 @@ class Clash2SingboxTransformer:
                 result_transport = {
                     'type': 'httpupgrade',
                 }
-                servername = proxy.get('servername')
+                servername = proxy.servername
                 if servername:
                     result_transport['host'] = [servername] 
                 path = ws_opts.get('path')
@@ -409,11 +597,102 @@ class Clash2SingboxTransformer:
         rule['outbound'] = outbound
         return rule
     
+    def _local_rule_set(self, tag: str, rules: List[dict], name: Optional[str] = None) -> dict:
+        # sing-box source format, written next to the config so that startup does not wait on downloads
+        makedirs(self.rule_set_dir, exist_ok=True)
+        filename = path.join(self.rule_set_dir, f'{name or tag}.json')
+        # profiles rendered in parallel may write the same rule set
+        tmp_filename = f'{filename}.{getpid()}.tmp'
+        with open(tmp_filename, 'wb') as ofile:
+            self.rule_set_serializer.dump({'version': 1, 'rules': rules}, ofile)
+        replace(tmp_filename, filename)
+        return self._rule_set_file(tag, filename)
+
+    @staticmethod
+    def _rule_set_file(tag: str, filename: str) -> dict:
+        return {
+            'tag': tag,
+            'type': 'local',
+            'format': 'source',
+            'path': filename,
+        }
+
+    @staticmethod
+    def _domain_entry(entry: str) -> Tuple[str, str]:
+        # domain provider syntax: `+.` the domain and its subdomains, `.` its subdomains only, `*` a single label
+        if entry.startswith('+.'):
+            return 'domain_suffix', entry[2:]
+        if entry.startswith('.'):
+            return 'domain_suffix', entry
+        if '*' in entry:
+            labels = ('[^.]+' if label == '*' else re.escape(label) for label in entry.split('.'))
+            return 'domain_regex', '^' + r'\.'.join(labels) + '$'
+        return 'domain', entry
+
+    def _provider_rules(self, provider: RuleProvider) -> List[dict]:
+        payload = provider.payload()
+        if payload.behavior == BEHAVIOR_DOMAIN:
+            rule: Dict[str, List[str]] = {}
+            for entry in payload.entries:
+                field, value = Clash2SingboxTransformer._domain_entry(entry)
+                Clash2SingboxTransformer.get_or_default(rule, field).append(value)
+            return [rule] if rule else []
+        if payload.behavior == BEHAVIOR_IPCIDR:
+            return [{'ip_cidr': list(payload.entries)}] if payload.entries else []
+        # classical: the rule set matches when any of its rules does, so single field rules are merged
+        group_domain: Dict[str, List] = {}
+        group_fields: OrderedDict[str, Dict[str, List]] = OrderedDict()
+        others: List[dict] = []
+        for cond in payload.conditions:
+            if any(c.type in RULE_SET_NESTED_TYPES for c in cond.walk()):
+                collector.record(UNSUPPORTED_RULE, f'{provider.name}: {cond.raw}', 'not allowed in a singbox rule set')
+                continue
+            if cond.type in CLASH2SINGBOX_GROUP_DOMAIN_KEYS:
+                field = CLASH2SINGBOX_ALLOWED_RULETYPES[cond.type]
+                Clash2SingboxTransformer.get_or_default(group_domain, field).append(cond.match)
+                continue
+            obj = self._headless_rule(cond)
+            if obj is None:
+                collector.record(UNSUPPORTED_RULE, f'{provider.name}: {cond.raw}', 'rule type not supported in singbox')
+            elif len(obj) == 1 and cond.type not in LOGICAL_RULE_TYPES:
+                field, values = next(iter(obj.items()))
+                Clash2SingboxTransformer.get_or_default(group_fields.setdefault(field, {}), field).extend(values)
+            else:
+                others.append(obj)
+        result = [group_domain] if group_domain else []
+        result.extend(group_fields.values())
+        result.extend(others)
+        return result
+
+    def _mark_rule_provider(self, name: str) -> Optional[str]:
+        ruleset = self.rule_providers.get(name)
+        if ruleset is None:
+            spec = self.providers.spec(name) if self.providers is not None else None
+            provider = self.providers.get(spec, self.home_dir) if spec is not None else None
+            if provider is None or provider.format == FORMAT_MRS:
+                return None
+            tag = f'provider-{name}'
+            # named by content: a provider converted by an earlier run or another profile is not parsed again
+            filename = path.join(self.rule_set_dir, f'provider-{provider.id}.json')
+            if path.exists(filename):
+                ruleset = Clash2SingboxTransformer._rule_set_file(tag, filename)
+            else:
+                ruleset = self._local_rule_set(tag, self._provider_rules(provider), f'provider-{provider.id}')
+            self.rule_providers[name] = ruleset
+        return ruleset['tag']
+
     def _mark_geoip(self, geo_key: str) -> bool:
         if self.geoip.get(geo_key) is None:
+            if self.geodata is not None and self.geodata.has_geoip(geo_key):
+                cidrs, reverse = self.geodata.geoip_cidrs(geo_key)
+                rule = {'ip_cidr': cidrs}
+                if reverse:
+                    rule['invert'] = True
+                self.geoip[geo_key] = self._local_rule_set(f'geoip-{geo_key.lower()}', [rule])
+                return True
             template = SINGBOX_GEOIP_RULESET.get(geo_key)
             if template is None:
-                print(f'>! geoip ruleset for {geo_key} not found')
+                collector.record(UNKNOWN_GEO_KEY, f'GEOIP,{geo_key}', 'no geoip rule set')
                 return False
             ruleset = {
                 'tag': f'geoip-{geo_key.lower()}',
@@ -425,9 +704,16 @@ class Clash2SingboxTransformer:
 
     def _mark_geosite(self, geo_key: str) -> bool:
         if self.geosite.get(geo_key) is None:
+            if self.geodata is not None and self.geodata.has_geosite(geo_key):
+                rule: Dict[str, List[str]] = {}
+                for domain in self.geodata.geosite_domains(geo_key):
+                    field = GEOSITE_FIELDS[domain.type]
+                    Clash2SingboxTransformer.get_or_default(rule, field).append(domain.value)
+                self.geosite[geo_key] = self._local_rule_set(f'geosite-{geo_key.lower()}', [rule])
+                return True
             template = SINGBOX_GEOSITE_RULESET.get(geo_key)
             if template is None:
-                print(f'>! geosite ruleset for {geo_key} not found')
+                collector.record(UNKNOWN_GEO_KEY, f'GEOSITE,{geo_key}', 'no geosite rule set')
                 return False
             ruleset = {
                 'tag': f'geosite-{geo_key.lower()}',
@@ -439,7 +725,7 @@ class Clash2SingboxTransformer:
     def _gen_geoip_rule(self, geo_key: str, outbound: str) -> dict:
         geo_key = geo_key.upper()
         rule = {
-            'rule_set': f'geoip-{geo_key}',
+            'rule_set': f'geoip-{geo_key.lower()}',
             'outbound': outbound,
         }
         self._mark_geoip(geo_key)
@@ -448,7 +734,7 @@ class Clash2SingboxTransformer:
     def _gen_src_geoip_rule(self, geo_key: str, outbound: str) -> dict:
         geo_key = geo_key.upper()
         rule = {
-            'rule_set': f'geoip-{geo_key}',
+            'rule_set': f'geoip-{geo_key.lower()}',
             'rule_set_ipcidr_match_source': True,
             'outbound': outbound,
         }
@@ -458,7 +744,7 @@ class Clash2SingboxTransformer:
     def _gen_geosite_rule(self, geo_key: str, outbound: str) -> dict:
         geo_key = geo_key.upper()
         rule = {
-            'rule_set': f'geosite-{geo_key}',
+            'rule_set': f'geosite-{geo_key.lower()}',
             'outbound': outbound,
         }
         self._mark_geosite(geo_key)
@@ -474,11 +760,24 @@ class SingboxConfigWriter(IConfigWriter):
 
     _transformer: Clash2SingboxTransformer
     _template: Optional[Template]
+    _serializer: ISerializer
 
     def __init__(self):
         super().__init__()
         self._transformer = Clash2SingboxTransformer()
         self._template = None
+        self._serializer = get_serializer('json')
+
+    def configure(self, geodata: Optional[GeoData] = None, rule_set_dir: Optional[str] = None, pretty: bool = True, serializer: Optional[str] = None, rule_providers: Optional[RuleProviders] = None, home_dir: Optional[str] = None, **options) -> None:
+        self._transformer.geodata = geodata
+        if rule_set_dir is not None:
+            self._transformer.rule_set_dir = rule_set_dir
+        self._transformer.providers = rule_providers
+        if home_dir is not None:
+            self._transformer.home_dir = home_dir
+        self._serializer = get_serializer('json', pretty, serializer)
+        # rule sets are only read by the core
+        self._transformer.rule_set_serializer = get_serializer('json', False, serializer)
 
     def template(self, ifile: BinaryIO) -> None:
         content = ifile.read().decode('utf-8')
@@ -497,15 +796,16 @@ class SingboxConfigWriter(IConfigWriter):
                 sp = t.transform_proxy(p)
                 singbox_proxies.append(sp)
             except Exception as e:
-                print(f'>! failed to transform proxy {p.name}: {e}')
+                collector.record(UNSUPPORTED_PROXY, p.name, e)
         singbox_proxy_groups = list()
         for g in proxy_groups:
             try:
                 sg = t.transform_proxy_group(g)
                 singbox_proxy_groups.append(sg)
             except Exception as e:
-                print(f'>! failed to transform proxy group {g.name}: {e}')
+                collector.record(UNSUPPORTED_PROXY_GROUP, g.name, e)
         singbox_rules = t.transform_rules(rules)
+        self.dropped_rules = t.dropped_rules
 
         template_outbounds: List = obj.get('outbounds')
         template_outbounds = insert_in_list(template_outbounds, lambda x: x == PROXY_PLACEHOLDER, singbox_proxies)
@@ -522,14 +822,16 @@ class SingboxConfigWriter(IConfigWriter):
         geo_ruleset = list()
         geo_ruleset.extend(t.geosite.values())
         geo_ruleset.extend(t.geoip.values())
+        geo_ruleset.extend(t.rule_providers.values())
         if len(geo_ruleset) > 0:
             template_route_ruleset: List = template_route.get('rule_set')
             template_route['rule_set'] = insert_in_list(template_route_ruleset, lambda x: x == RULESET_PLACEHOLDER, geo_ruleset)
         if t.match_rule_target is not None:
             template_route['final'] = t.match_rule_target
 
-        w = TextIOWrapper(ofile, 'utf-8')
-        json_dump(obj, w, indent=2)
+        start = perf_counter()
+        self._serializer.dump(obj, ofile)
+        print(f'># serialized with {self._serializer} in {(perf_counter() - start) * 1000:.0f}ms')
             
         
 
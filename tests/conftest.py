@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the scripts are imported by their bare module names, as they import each other
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'scripts'))
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import cache
+from cache import CODEC_LZMA, CacheStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    with CacheStore(str(tmp_path / 'cache'), keep_versions=2) as store:
+        yield store
+
+
+def last_used(store: CacheStore, name: str) -> float:
+    return store._db.execute('SELECT last_used FROM subscriptions WHERE name = ?', (name,)).fetchone()[0]
+
+
+def put(store: CacheStore, name: str, content: bytes, type: str = 'clash'):
+    with store.writer(name, type) as w:
+        w.write(content)
+        return w.commit()
+
+
+def test_put_and_open(store):
+    entry = put(store, 'a', b'proxies: []\n' * 1000)
+    assert entry.size == 12000 and entry.stored_size < entry.size
+    with store.open('a', 'clash') as ifile:
+        assert ifile.read() == b'proxies: []\n' * 1000
+    assert store.open('b', 'clash') is None
+    with pytest.raises(ValueError):
+        store.open('a', 'singbox')
+
+
+def test_versions_share_blobs(tmp_path):
+    with CacheStore(str(tmp_path), codec=CODEC_LZMA, keep_versions=2) as store:
+        first = put(store, 'a', b'one')
+        put(store, 'b', b'one')
+        second = put(store, 'a', b'two')
+        third = put(store, 'a', b'three')
+        assert [e.hash for e in store.history('a')] == [third.hash, second.hash]
+        # the blob of `one` is still used by `b`
+        assert os.path.exists(store.blob_path(first.hash))
+        with store.open('b', 'clash') as ifile:
+            assert ifile.read() == b'one'
+
+
+def test_corrupted_blob(store):
+    entry = put(store, 'a', b'content')
+    with open(store.blob_path(entry.hash), 'wb') as f:
+        f.write(cache.zlib.compress(b'other'))
+    with pytest.raises(ValueError):
+        with store.open('a', 'clash') as ifile:
+            ifile.read()
+
+
+def test_open_updates_last_used_coarsely(store, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time', lambda: now[0])
+    put(store, 'a', b'content')
+    now[0] += 60
+    store.open('a', 'clash').close()
+    assert last_used(store, 'a') == 1000.0
+    now[0] += cache.LAST_USED_GRANULARITY
+    store.open('a', 'clash').close()
+    assert last_used(store, 'a') == now[0]
+
+
+def test_gc(store, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time', lambda: now[0])
+    put(store, 'old', b'x' * 100)
+    now[0] += 10
+    put(store, 'used', b'y' * 100)
+    put(store, 'gone', b'z' * 100)
+    now[0] += cache.LAST_USED_GRANULARITY
+    store.open('used', 'clash').close()
+    stray = store.blob_path('f' * 64)
+    os.makedirs(os.path.dirname(stray), exist_ok=True)
+    open(stray, 'wb').close()
+
+    report = store.gc(max_age=60, keep_names={'old', 'used'})
+    assert sorted(report.removed_subscriptions) == ['gone', 'old']
+    assert report.removed_blobs == 2 and report.removed_files == 1
+    assert store.latest('used') is not None and not os.path.exists(stray)
+
+    put(store, 'new', b'w' * 100)
+    report = store.gc(max_bytes=store.total_bytes() - 1)
+    # the least recently used goes first
+    assert report.removed_subscriptions == ['used']
+    assert store.names('clash') == ['new']
+
+
+def test_import_legacy(store, tmp_path):
+    legacy = tmp_path / 'legacy'
+    legacy.mkdir()
+    (legacy / 'a.yaml').write_bytes(b'a')
+    (legacy / 'b.yaml').write_bytes(b'b')
+    index = {'a': str(legacy / 'a.yaml'), 'b': str(legacy / 'b.yaml'), 'missing': str(legacy / 'c.yaml')}
+    assert store.import_legacy(index, {'a': 'clash', 'missing': 'clash'}) == 1
+    assert not (legacy / 'a.yaml').exists() and (legacy / 'b.yaml').exists()
+    with store.open('a', 'clash') as ifile:
+        assert ifile.read() == b'a'
+    # imported once
+    assert store.import_legacy(index, {'a': 'clash'}) == 0
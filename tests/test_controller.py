@@ -0,0 +1,273 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pytest
+
+import controller as ctl
+from controller import Controller, ControllerError, WarmupReport, restore_selections
+from data import Info, NameMap
+from reader_clash import ClashSubscribeReader
+
+
+class FakeCore(ThreadingHTTPServer):
+    """
+    Stand-in for the controller of the core: the proxies and groups of `state`, selections, delay tests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, state: Dict[str, Dict], secret: str = ''):
+        super().__init__(('127.0.0.1', 0), FakeCoreHandler)
+        self.state = state
+        self.secret = secret
+        self.selected: List[tuple] = []
+        self.delay_requests: List[Dict] = []
+        self.delay_seconds = 0.0
+        self.active = 0
+        self.max_active = 0
+        self.connections = 0
+        self.drop_after_response = False    # hang up a kept alive connection, as an idle timeout does
+        self.lock = Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        return f'http://{host}:{port}'
+
+
+class FakeCoreHandler(BaseHTTPRequestHandler):
+
+    server: FakeCore
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, status: int, body: Optional[Dict] = None) -> None:
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.server.drop_after_response:
+            self.close_connection = True
+
+    def _authorized(self) -> bool:
+        if self.server.secret and self.headers.get('Authorization') != f'Bearer {self.server.secret}':
+            self._reply(401, {'message': 'Unauthorized'})
+            return False
+        return True
+
+    def do_GET(self) -> None:
+        if not self._authorized():
+            return
+        parts = urlsplit(self.path)
+        segments = [unquote(s) for s in parts.path.strip('/').split('/')]
+        if segments == ['version']:
+            self._reply(200, {'version': 'v1.0.0'})
+        elif segments == ['proxies']:
+            self._reply(200, {'proxies': self.server.state})
+        elif len(segments) == 3 and segments[0] == 'group' and segments[2] == 'delay':
+            group = self.server.state.get(segments[1])
+            if group is None:
+                self._reply(404, {'message': 'resource not found'})
+                return
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active, self.server.active)
+                self.server.delay_requests.append({'group': segments[1], **{k: v[0] for k, v in parse_qs(parts.query).items()}})
+            sleep(self.server.delay_seconds)
+            with self.server.lock:
+                self.server.active -= 1
+            self._reply(200, {m: 10 + i for i, m in enumerate(group['all'])})
+        else:
+            self._reply(404, {'message': 'resource not found'})
+
+    def do_PUT(self) -> None:
+        if not self._authorized():
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        segments = [unquote(s) for s in urlsplit(self.path).path.strip('/').split('/')]
+        if len(segments) == 2 and segments[0] == 'proxies':
+            group = self.server.state.get(segments[1])
+            if group is None or body['name'] not in group.get('all', ()):
+                self._reply(400, {'message': 'Selector update error: proxy not exist'})
+                return
+            group['now'] = body['name']
+            self.server.selected.append((segments[1], body['name']))
+            self._reply(204)
+        else:
+            self._reply(404, {'message': 'resource not found'})
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def selector(now: str, members: List[str]) -> Dict:
+    return {'type': 'Selector', 'now': now, 'all': members}
+
+
+@pytest.fixture
+def core():
+    servers = []
+
+    def start(state: Dict[str, Dict], secret: str = '') -> FakeCore:
+        server = FakeCore(state, secret)
+        Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_proxies_and_select(core):
+    server = core({
+        'GLOBAL': selector('DIRECT', ['DIRECT', 'Proxy']),
+        'Proxy': selector('a', ['a', 'b']),
+        'Auto': {'type': 'URLTest', 'now': 'a', 'all': ['a', 'b']},
+        'a': {'type': 'Shadowsocks'},
+        'b': {'type': 'Trojan'},
+    }, 'hunter2')
+    controller = Controller(server.url, 'hunter2')
+    try:
+        assert controller.version() == 'v1.0.0'
+        assert set(controller.proxies()) == {'GLOBAL', 'Proxy', 'Auto', 'a', 'b'}
+        assert controller.selections() == {'GLOBAL': 'DIRECT', 'Proxy': 'a'}
+        controller.select('Proxy', 'b')
+        assert server.selected == [('Proxy', 'b')]
+        assert controller.selections()['Proxy'] == 'b'
+        with pytest.raises(ControllerError) as e:
+            controller.select('Proxy', 'c')
+        assert e.value.status == 400
+        assert 'proxy not exist' in str(e.value)
+    finally:
+        controller.close()
+    with pytest.raises(ControllerError) as e:
+        Controller(server.url, 'wrong').version()
+    assert e.value.status == 401
+
+
+def test_group_names_are_quoted(core):
+    server = core({'🇭🇰 Hong Kong/1': selector('a', ['a', 'b'])})
+    controller = Controller(server.url)
+    try:
+        controller.select('🇭🇰 Hong Kong/1', 'b')
+        assert server.selected == [('🇭🇰 Hong Kong/1', 'b')]
+        assert controller.group_delay('🇭🇰 Hong Kong/1', 'http://example.com/generate_204', 1000) == {'a': 10, 'b': 11}
+        assert server.delay_requests == [{'group': '🇭🇰 Hong Kong/1', 'url': 'http://example.com/generate_204', 'timeout': '1000'}]
+    finally:
+        controller.close()
+
+
+def test_group_delays_concurrency(core):
+    state = {f'auto{i}': {'type': 'URLTest', 'now': 'a', 'all': ['a', 'b']} for i in range(6)}
+    state['fallback'] = {'type': 'Fallback', 'now': 'a', 'all': ['a']}
+    state['Proxy'] = selector('a', ['a', 'b'])
+    state['missing'] = {'type': 'LoadBalance', 'now': 'a', 'all': ['a']}
+    server = core(state)
+    server.delay_seconds = 0.1
+    controller = Controller(server.url)
+    report = WarmupReport()
+    # the controller no longer knows this group by the time it is tested
+    original = controller.proxies
+    controller.proxies = lambda: {**original(), 'gone': {'type': 'URLTest', 'all': ['a']}}
+    try:
+        ctl.test_group_delays(controller, 'http://example.com/generate_204', 500, 2, report)
+    finally:
+        controller.close()
+    assert server.max_active == 2
+    assert set(report.delays) == {f'auto{i}' for i in range(6)} | {'fallback', 'missing'}
+    assert report.delays['auto0'] == {'a': 10, 'b': 11}
+    assert set(report.failed) == {'gone'}
+    assert '404' in report.failed['gone']
+    assert 'Proxy' not in {r['group'] for r in server.delay_requests}
+
+
+def make_info(name: str, proxies: List[Dict], groups: List[Dict]) -> Info:
+    reader = ClashSubscribeReader()
+    reader.inner = {'proxies': proxies, 'proxy-groups': groups}
+    info = Info(reader, name, 1, False)
+    info.modify_by_name(name)
+    return info
+
+
+def ss(name: str, server: str) -> Dict:
+    return {'name': name, 'type': 'ss', 'server': server, 'port': 443, 'cipher': 'aes-128-gcm', 'password': 'x'}
+
+
+def test_restore_selections_through_names(core):
+    # `old` was renamed to `main` in the subscriptions; `backup` serves hk1 too, and was deduplicated away
+    main = make_info('main', [ss('hk1', '1.1.1.1'), ss('jp1', '2.2.2.2')], [{'name': 'Select', 'type': 'select', 'proxies': ['hk1', 'jp1']}])
+    backup = make_info('backup', [ss('hk-copy', '1.1.1.1'), ss('us1', '3.3.3.3')], [])
+    proxies = list(main.proxies.values()) + [backup.proxies['us1']]
+    groups = list(main.proxy_groups_other.values())
+    names = NameMap([main, backup], proxies, groups)
+    server = core({
+        'Proxy': selector('[main]-jp1', ['[main]-hk1', '[main]-jp1', '[backup]-us1']),
+        '[main]-Select': selector('[main]-hk1', ['[main]-hk1', '[main]-jp1']),
+        'Fallback': selector('[main]-hk1', ['[main]-hk1']),
+        'Auto': {'type': 'URLTest', 'now': '[main]-hk1', 'all': ['[main]-hk1']},
+    })
+    previous = {
+        'Proxy': '[backup]-hk-copy',        # deduplicated: the kept copy
+        '[old]-Select': '[old]-jp1',        # renamed subscription: the group and the proxy
+        'Fallback': '[backup]-us1',         # not a member any more
+        'Auto': '[main]-hk1',               # not a select group
+        '[old]-Gone': '[old]-hk1',          # no such group now
+    }
+    controller = Controller(server.url)
+    report = WarmupReport()
+    try:
+        restore_selections(controller, previous, names.resolve, report)
+    finally:
+        controller.close()
+    assert sorted(server.selected) == [('Proxy', '[main]-hk1'), ('[main]-Select', '[main]-jp1')]
+    assert sorted(report.restored) == [('Proxy', '[backup]-hk-copy', '[main]-hk1'), ('[main]-Select', '[old]-jp1', '[main]-jp1')]
+    assert sorted(report.lost) == [('Auto', '[main]-hk1'), ('Fallback', '[backup]-us1'), ('[old]-Gone', '[old]-hk1')]
+
+
+def test_renamed_group_yields_to_the_same_name(core):
+    server = core({'Proxy': selector('a', ['a', 'b', 'c'])})
+    controller = Controller(server.url)
+    report = WarmupReport()
+    resolve = {'Old': 'Proxy', 'a': 'a', 'b': 'b', 'c': 'c'}.get
+    try:
+        restore_selections(controller, {'Old': 'c', 'Proxy': 'b'}, resolve, report)
+    finally:
+        controller.close()
+    assert server.selected == [('Proxy', 'b')]
+    assert report.restored == [('Proxy', 'b', 'b')]
+
+
+def test_keep_alive_retry(core):
+    server = core({'Proxy': selector('a', ['a', 'b'])})
+    controller = Controller(server.url)
+    try:
+        assert controller.version() == 'v1.0.0'
+        assert controller.version() == 'v1.0.0'
+        assert server.connections == 1
+        # the core hangs up the idle connection after the next answer, without saying so
+        server.drop_after_response = True
+        assert controller.version() == 'v1.0.0'
+        sleep(0.1)
+        server.drop_after_response = False
+        assert controller.selections() == {'Proxy': 'a'}
+        assert server.connections == 2
+    finally:
+        controller.close()
+
+
+def test_unreachable_controller():
+    controller = Controller('127.0.0.1:1', timeout=1)
+    with pytest.raises(OSError):
+        controller.version()
@@ -0,0 +1,88 @@
+import gc
+from typing import Dict, List
+
+import pytest
+
+from data import Condition, Info, Proxy, Rule, RuleType, dedupe_proxies
+from reader_clash import ClashSubscribeReader
+
+
+@pytest.mark.parametrize('raw', [
+    'DOMAIN-SUFFIX,example.com,Proxy',
+    'IP-CIDR,10.0.0.0/8,DIRECT,no-resolve',
+    'AND,((DOMAIN,a.com),(NETWORK,udp)),REJECT',
+    'OR,((DOMAIN-KEYWORD,ads),(AND,((DST-PORT,443),(NOT,((NETWORK,tcp)))))),REJECT',
+    'NOT,((GEOIP,CN,no-resolve)),Proxy',
+    'SUB-RULE,(OR,((NETWORK,tcp),(DOMAIN,b.com))),sub',
+    'MATCH,Proxy',
+])
+def test_rule_round_trip(raw):
+    rule = Rule(raw)
+    assert rule.raw == raw
+    assert Rule(rule.raw).cond is rule.cond
+
+
+def test_condition_interning():
+    a = Rule('AND,((DOMAIN,a.com),(NETWORK,udp)),A')
+    b = Rule('OR,((NETWORK,udp),(DOMAIN,b.com)),B')
+    assert a.cond.children[1] is b.cond.children[0]
+    assert Condition.parse('NETWORK,udp') is b.cond.children[0]
+    assert Condition.make(RuleType.DOMAIN, 'a.com') is a.cond.children[0]
+    # no-resolve is part of the identity
+    assert Condition.parse('GEOIP,CN') is not Condition.parse('GEOIP,CN,no-resolve')
+    sub = Rule('SUB-RULE,(AND,((DOMAIN,a.com),(NETWORK,udp))),s')
+    assert sub.cond.children[0] is a.cond
+
+
+def test_condition_interning_is_weak():
+    key = (RuleType.DOMAIN, 'only-here.example', None, ())
+    Condition.make(*key)
+    gc.collect()
+    assert key not in Condition._interned
+
+
+@pytest.mark.parametrize('raw', ['AND,(DOMAIN,a.com),A', 'NOT,((DOMAIN,a.com),(DOMAIN,b.com)),A', 'AND,((MATCH,x)),A'])
+def test_invalid_logical_rules(raw):
+    with pytest.raises(ValueError):
+        Rule(raw)
+
+
+def ss(name: str, server: str, **extra) -> Dict:
+    proxy = {'name': name, 'type': 'ss', 'server': server, 'port': 443, 'cipher': 'aes-128-gcm', 'password': 'x'}
+    proxy.update(extra)
+    return proxy
+
+
+def test_fingerprint():
+    base = Proxy.parse(ss('a', 'example.com')).fingerprint
+    assert Proxy.parse(ss('b', 'Example.COM.')).fingerprint == base
+    assert Proxy.parse(ss('c', 'example.com', port='443')).fingerprint == base
+    assert Proxy.parse(ss('d', 'example.com', udp=False)).fingerprint == base
+    assert Proxy.parse(ss('e', 'example.com', udp=True)).fingerprint != base
+    assert Proxy.parse(ss('f', 'example.com', password='y')).fingerprint != base
+    assert Proxy.parse(ss('g', 'example.com', port=8443)).fingerprint != base
+
+
+def make_info(name: str, priority: int, proxies: List[Dict], groups: List[Dict]) -> Info:
+    reader = ClashSubscribeReader()
+    reader.inner = {'proxies': proxies, 'proxy-groups': groups}
+    return Info(reader, name, priority, False)
+
+
+def test_dedupe_proxies():
+    main = make_info('main', 1, [ss('hk', '1.1.1.1'), ss('jp', '2.2.2.2')], [{'name': 'G', 'type': 'select', 'proxies': ['hk', 'hk-copy', 'us']}])
+    backup = make_info('backup', 2, [ss('hk-copy', '1.1.1.1'), ss('us', '3.3.3.3')], [])
+    proxies = [*main.proxies.values(), *backup.proxies.values()]
+    groups = list(main.proxy_groups_other.values())
+    sub = Rule('SUB-RULE,(NETWORK,udp),s')
+    sub.sub_rules = [Rule('DOMAIN,a.com,hk-copy')]
+    rules = [Rule('DOMAIN,b.com,hk-copy'), sub, Rule('MATCH,us')]
+
+    proxies, result, report = dedupe_proxies([main, backup], proxies, groups, rules)
+    assert [p.name for p in proxies] == ['hk', 'jp', 'us']
+    assert report.aliases == {'hk-copy': 'hk'} and report.sources == {('backup', 'main'): 1}
+    assert groups[0].inner['proxies'] == ['hk', 'us']
+    assert [r.raw for r in result] == ['DOMAIN,b.com,hk', 'SUB-RULE,(NETWORK,udp),s', 'MATCH,us']
+    assert result[1].sub_rules[0].strategy == 'hk'
+    # rules are shared with other merges, so they are replaced rather than modified
+    assert rules[0].strategy == 'hk-copy' and sub.sub_rules[0].strategy == 'hk-copy'
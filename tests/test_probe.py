@@ -0,0 +1,181 @@
+import socket
+import ssl
+import subprocess
+from threading import Thread
+from typing import List, Optional
+
+import pytest
+
+from data import Proxy, ProxyGroup, Rule
+from probe import PROBE_DEMOTE, PROBE_DROP, ProbeResult, apply_probe, drop_rules, probe_proxies
+
+
+def proxy(name: str, port: int, type: str = 'ss', **extra) -> Proxy:
+    return Proxy.parse({'name': name, 'type': type, 'server': '127.0.0.1', 'port': port, 'cipher': 'aes-128-gcm', 'password': 'x', **extra})
+
+
+def group(name: str, members: List[str]) -> ProxyGroup:
+    return ProxyGroup({'name': name, 'type': 'select', 'proxies': list(members)})
+
+
+@pytest.fixture
+def listener():
+    # the kernel completes the connect from the backlog, nothing has to accept
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def closed_port() -> int:
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def tls_listener(tmp_path):
+    cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                        '-keyout', str(key), '-out', str(cert)], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('openssl is needed to make a certificate')
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(str(cert), str(key))
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            try:
+                with context.wrap_socket(conn, server_side=True):
+                    pass
+            except (OSError, ssl.SSLError):
+                pass
+
+    Thread(target=serve, daemon=True).start()
+    yield sock
+    sock.close()
+
+
+def port_of(sock: socket.socket) -> int:
+    return sock.getsockname()[1]
+
+
+def test_reachable(listener):
+    results = probe_proxies([proxy('a', port_of(listener))], timeout=2000)
+    assert results['a'].probed
+    assert results['a'].alive
+    assert results['a'].latency is not None and results['a'].latency >= 0
+    assert results['a'].error is None
+
+
+def test_refused(closed_port):
+    results = probe_proxies([proxy('a', closed_port)], timeout=2000)
+    assert results['a'].probed
+    assert not results['a'].alive
+    assert results['a'].latency is None
+    assert results['a'].error
+
+
+def test_timeout(listener):
+    # connected, but the handshake never gets an answer
+    results = probe_proxies([proxy('a', port_of(listener), tls=True)], timeout=200, tls=True)
+    assert not results['a'].alive
+    assert results['a'].error == 'timeout'
+
+
+def test_tls_handshake(tls_listener):
+    results = probe_proxies([proxy('a', port_of(tls_listener), 'trojan', sni='example.com')], timeout=5000, tls=True)
+    assert results['a'].alive
+    assert results['a'].latency is not None
+
+
+def test_tls_handshake_failure():
+    # a listener that hangs up without a server hello
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+
+    def hang_up():
+        conn, _ = sock.accept()
+        conn.recv(1024)
+        conn.close()
+
+    t = Thread(target=hang_up, daemon=True)
+    t.start()
+    try:
+        results = probe_proxies([proxy('a', port_of(sock), 'trojan')], timeout=2000, tls=True)
+    finally:
+        t.join(5)
+        sock.close()
+    assert not results['a'].alive
+    assert results['a'].error and results['a'].error != 'timeout'
+
+
+def test_shared_endpoint_and_not_probed(listener):
+    port = port_of(listener)
+    results = probe_proxies([proxy('a', port), proxy('b', port), proxy('h', port, 'hysteria2')], timeout=2000)
+    assert results['a'] is results['b']
+    assert not results['h'].probed
+    assert results['h'].alive
+
+
+def results(**latencies: Optional[float]):
+    return {name: ProbeResult(latency, None if latency is not None else 'timeout') for name, latency in latencies.items()}
+
+
+def test_demote_sorts_by_latency():
+    proxies = [proxy(name, 1) for name in 'abcd']
+    groups = [group('g', ['DIRECT', 'a', 'b', 'c', 'd', 'other'])]
+    kept, bad = apply_probe(proxies, groups, results(a=50.0, b=None, c=10.0, d=300.0), max_latency=200, mode=PROBE_DEMOTE)
+    assert kept == proxies
+    assert bad == {'b', 'd'}
+    # members that are not probed proxies stay in front, the bad ones go last
+    assert groups[0].inner['proxies'] == ['DIRECT', 'other', 'c', 'a', 'b', 'd']
+
+
+def test_drop_removes_bad_proxies():
+    proxies = [proxy(name, 1) for name in 'abc']
+    groups = [group('g', ['a', 'b', 'c']), group('h', ['g', 'b'])]
+    kept, bad = apply_probe(proxies, groups, results(a=30.0, b=None, c=10.0), mode=PROBE_DROP)
+    assert bad == {'b'}
+    assert [p.name for p in kept] == ['a', 'c']
+    assert groups[0].inner['proxies'] == ['c', 'a']
+    assert groups[1].inner['proxies'] == ['g']
+
+
+def test_drop_never_empties_a_group():
+    proxies = [proxy(name, 1) for name in 'abc']
+    groups = [group('g', ['a', 'b']), group('h', ['b', 'c'])]
+    kept, bad = apply_probe(proxies, groups, results(a=None, b=None, c=20.0), mode=PROBE_DROP)
+    assert bad == {'a', 'b'}
+    # g only has bad members: it keeps them, sorted, and so do the proxies
+    assert groups[0].inner['proxies'] == ['a', 'b']
+    assert groups[1].inner['proxies'] == ['c']
+    assert [p.name for p in kept] == ['a', 'b', 'c']
+
+
+def test_drop_rules_to_dropped_proxies():
+    proxies = [proxy(name, 1) for name in 'abc']
+    groups = [group('g', ['a', 'b', 'c'])]
+    kept, bad = apply_probe(proxies, groups, results(a=30.0, b=None, c=10.0), mode=PROBE_DROP)
+    sub = Rule('SUB-RULE,(NETWORK,udp),s')
+    sub.sub_rules = [Rule('DOMAIN,a.com,b'), Rule('MATCH,g')]
+    rules = [Rule('DOMAIN,b.com,b'), Rule('DOMAIN,c.com,c'), sub, Rule('MATCH,g')]
+    result = drop_rules(rules, bad - set(p.name for p in kept))
+    assert [r.raw for r in result] == ['DOMAIN,c.com,c', 'SUB-RULE,(NETWORK,udp),s', 'MATCH,g']
+    assert [r.raw for r in result[1].sub_rules] == ['MATCH,g']
+    # the rules may be shared with other merges
+    assert len(rules) == 4 and len(sub.sub_rules) == 2
+    assert drop_rules(result, {'b'}) is result
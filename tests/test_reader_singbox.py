@@ -0,0 +1,23 @@
+import json
+from io import BytesIO
+
+from reader_singbox import SingboxSubscribeReader
+
+
+CONFIG = {
+    'outbounds': [
+        {'type': 'selector', 'tag': 'G', 'outbounds': ['a', 'b', 'direct']},
+        {'type': 'shadowsocks', 'tag': 'a', 'server': 'x', 'server_port': 1, 'method': 'aes-128-gcm', 'password': 'p'},
+        {'type': 'wireguard', 'tag': 'b'},
+        {'type': 'direct', 'tag': 'direct'},
+    ],
+    'route': {'rules': [{'domain': ['x.com'], 'outbound': 'a'}], 'final': 'G'},
+}
+
+
+def test_groups_and_rules_before_proxies():
+    reader = SingboxSubscribeReader()
+    reader.read(BytesIO(json.dumps(CONFIG).encode()), True)
+    assert [g.inner['proxies'] for g in reader.get_proxy_groups()] == [['a', 'DIRECT']]
+    assert [str(r) for r in reader.get_rules()] == ['DOMAIN,x.com,a', 'MATCH,G']
+    assert [p.name for p in reader.get_proxies()] == ['a']
@@ -0,0 +1,51 @@
+from base64 import b64encode, urlsafe_b64encode
+from io import BytesIO
+
+import pytest
+
+from reader_subs import iter_b64_lines
+
+
+LINES = [b'ss://YWVzLTEyOC1nY206cA@1.1.1.1:443#a', b'trojan://p@2.2.2.2:443?sni=x#b\xe6\x97\xa5', b'vmess://e30']
+
+
+def decode(data: bytes, chunk_size: int) -> list:
+    return list(iter_b64_lines(BytesIO(data), chunk_size))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4, 5, 7, 64 * 1024])
+def test_chunk_boundaries(chunk_size):
+    data = b64encode(b'\n'.join(LINES))
+    assert decode(data, chunk_size) == LINES
+    # line-wrapped as MIME does
+    wrapped = b'\r\n'.join(data[i:i + 76] for i in range(0, len(data), 76))
+    assert decode(wrapped, chunk_size) == LINES
+
+
+def test_url_safe_alphabet():
+    content = b'\xfb\xff\xbf\n' * 3
+    data = urlsafe_b64encode(content)
+    assert b'-' in data and b'_' in data
+    assert decode(data, 5) == [b'\xfb\xff\xbf'] * 3
+
+
+@pytest.mark.parametrize('content', [b'a', b'ab', b'abc', b'abcd'])
+def test_missing_padding(content):
+    data = b64encode(content).rstrip(b'=')
+    assert decode(data, 2) == [content]
+
+
+def test_truncated_quantum():
+    with pytest.raises(ValueError):
+        decode(b64encode(b'abc') + b'Q', 4)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 64 * 1024])
+def test_padding_ends_the_payload(chunk_size):
+    data = b64encode(b'ab\ncd')
+    assert data.endswith(b'=')
+    assert decode(data + b'\n', chunk_size) == [b'ab', b'cd']
+    with pytest.raises(ValueError):
+        decode(b64encode(b'a') + b64encode(b'b'), chunk_size)
+    with pytest.raises(ValueError):
+        decode(data + b'\nYQ', chunk_size)
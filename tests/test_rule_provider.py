@@ -0,0 +1,33 @@
+from cache import CacheStore
+from rule_provider import BEHAVIOR_DOMAIN, RuleProviders
+
+
+def test_get(tmp_path):
+    (tmp_path / 'ads.list').write_bytes(b'# ads\nads.example.com\nbad entry\n')
+    providers = RuleProviders()
+    inline = {'type': 'inline', 'behavior': 'classical', 'payload': ['DOMAIN,a.com', 'NETWORK,udp']}
+    local = {'type': 'file', 'behavior': 'domain', 'format': 'text', 'path': 'ads.list'}
+    missing = {'type': 'file', 'behavior': 'domain', 'format': 'text', 'path': 'missing.list'}
+    remote = {'type': 'http', 'behavior': 'domain', 'url': 'http://127.0.0.1:9/rules.yaml'}
+    # the same source declared under several names is a single provider
+    first = providers.add('ads', local, str(tmp_path))
+    assert providers.add('[sub]-ads', dict(local), str(tmp_path)) is first
+    providers.add('inline', inline, str(tmp_path))
+    providers.add('missing', missing, str(tmp_path))
+    providers.add('remote', remote, str(tmp_path))
+    assert len(providers.providers) == 4
+
+    # inline providers are resolved as soon as they are declared
+    assert providers.get(inline, str(tmp_path)).payload().conditions[1].raw == 'NETWORK,udp'
+    assert providers.get(local, str(tmp_path)) is None
+    with CacheStore(str(tmp_path / 'cache')) as store:
+        providers.resolve(store, no_update=True)
+    p = providers.get(local, str(tmp_path / 'other' / '..'))
+    assert p is first and p.source == 'file'
+    payload = p.payload()
+    assert payload.behavior == BEHAVIOR_DOMAIN
+    assert payload.entries == ['ads.example.com'] and payload.invalid == ['bad entry']
+    assert providers.get(missing, str(tmp_path)) is None
+    assert providers.get(remote, str(tmp_path)) is None
+    assert providers.get({**local, 'behavior': 'classical'}, str(tmp_path)) is None
+    assert providers.resolved == 2
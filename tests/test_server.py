@@ -0,0 +1,151 @@
+import gzip
+from http.client import HTTPConnection
+from threading import Event, Lock, Thread
+from time import sleep
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from server import ConfigServer, IConfigRenderer
+
+
+class FakeRenderer(IConfigRenderer):
+
+    def __init__(self, profiles: List[str]):
+        self.profiles = profiles
+        self.versions: Dict[str, int] = {name: 1 for name in profiles}
+        self.release = Event()
+        self.release.set()
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = Lock()
+
+    def names(self) -> List[str]:
+        return self.profiles
+
+    def fingerprint(self, name: str) -> str:
+        return str(self.versions[name])
+
+    def render(self, name: str) -> Tuple[bytes, str]:
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self.release.wait(5)
+            return f'config of {name} v{self.versions[name]}\n'.encode('utf-8') * 100, 'text/yaml; charset=utf-8'
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def start(renderer: IConfigRenderer, concurrency: int = 2) -> ConfigServer:
+    server = ConfigServer(('127.0.0.1', 0), renderer, concurrency)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def renderer():
+    return FakeRenderer(['a', 'b', 'c', 'd', 'e'])
+
+
+@pytest.fixture
+def server(renderer):
+    server = start(renderer)
+    yield server
+    renderer.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def get(server: ConfigServer, path: str, headers: Optional[Dict[str, str]] = None):
+    conn = HTTPConnection(*server.server_address, timeout=10)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, {k.lower(): v for k, v in response.getheaders()}, response.read()
+    finally:
+        conn.close()
+
+
+def test_ok_with_etag(server):
+    status, headers, body = get(server, '/a')
+    assert status == 200
+    assert body.startswith(b'config of a v1')
+    assert headers['content-type'] == 'text/yaml; charset=utf-8'
+    assert headers['content-length'] == str(len(body))
+    assert headers['etag'].startswith('"') and headers['etag'].endswith('"')
+    assert 'content-encoding' not in headers
+    assert headers['vary'] == 'Accept-Encoding'
+
+
+def test_not_modified(server, renderer):
+    _, headers, _ = get(server, '/a')
+    status, headers_304, body = get(server, '/a', {'If-None-Match': headers['etag']})
+    assert status == 304
+    assert body == b''
+    assert headers_304['etag'] == headers['etag']
+    # a new input makes a new output, and the old tag no longer matches
+    renderer.versions['a'] = 2
+    status, headers_new, body = get(server, '/a', {'If-None-Match': headers['etag']})
+    assert status == 200
+    assert body.startswith(b'config of a v2')
+    assert headers_new['etag'] != headers['etag']
+
+
+def test_gzip(server):
+    _, _, plain = get(server, '/a')
+    status, headers, body = get(server, '/a', {'Accept-Encoding': 'br;q=1, gzip;q=0.8'})
+    assert status == 200
+    assert headers['content-encoding'] == 'gzip'
+    assert headers['etag'].endswith('-gzip"')
+    assert gzip.decompress(body) == plain
+    status, headers_304, _ = get(server, '/a', {'Accept-Encoding': 'gzip', 'If-None-Match': headers['etag']})
+    assert status == 304
+    assert headers_304['etag'] == headers['etag']
+    _, headers, _ = get(server, '/a', {'Accept-Encoding': 'gzip;q=0'})
+    assert 'content-encoding' not in headers
+
+
+def test_unknown_profile(server, renderer):
+    status, _, _ = get(server, '/nope')
+    assert status == 404
+    assert renderer.calls == 0
+
+
+def test_single_flight(server, renderer):
+    renderer.release.clear()
+    results = []
+    threads = [Thread(target=lambda: results.append(get(server, '/a'))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    renderer.release.set()
+    for t in threads:
+        t.join(10)
+    assert [status for status, _, _ in results] == [200] * 8
+    assert len({body for _, _, body in results}) == 1
+    assert renderer.calls == 1
+    assert server.renders == 1
+
+
+def test_concurrency_cap(server, renderer):
+    renderer.release.clear()
+    results = []
+    threads = [Thread(target=lambda name=name: results.append(get(server, f'/{name}'))) for name in renderer.profiles]
+    for t in threads:
+        t.start()
+    # wait until the slots are taken and the other requests queue behind them
+    for _ in range(100):
+        if renderer.active == 2:
+            break
+        sleep(0.02)
+    sleep(0.1)
+    assert renderer.active == 2
+    renderer.release.set()
+    for t in threads:
+        t.join(10)
+    assert sorted(status for status, _, _ in results) == [200] * 5
+    assert renderer.max_active == 2
+    assert renderer.calls == 5
@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional
+
+import pytest
+
+import writer_singbox
+from data import Proxy, ProxyGroup, Rule, expand_proxy_groups
+from diagnostics import UNKNOWN_GEO_KEY, UNSUPPORTED_RULE, Diagnostics
+from writer_singbox import Clash2SingboxTransformer
+
+
+def sub_rule(raw: str, rules: List[str]) -> Rule:
+    rule = Rule(raw)
+    rule.sub_rules = [Rule(r) for r in rules]
+    return rule
+
+
+def matches(rule: Dict, domain: str, network: str) -> bool:
+    if rule.get('type') == 'logical':
+        results = [matches(r, domain, network) for r in rule['rules']]
+        return all(results) if rule['mode'] == 'and' else any(results)
+    # the fields of a rule are or'ed, except network which restricts them
+    if 'network' in rule and network not in rule['network']:
+        return False
+    fields = [k for k in rule if k in ('domain', 'domain_suffix')]
+    if not fields:
+        return True
+    return domain in rule.get('domain', ()) or any(domain == s or domain.endswith('.' + s) for s in rule.get('domain_suffix', ()))
+
+
+def route(rules: List[Dict], final: Optional[str], domain: str, network: str) -> Optional[str]:
+    for rule in rules:
+        if matches(rule, domain, network):
+            return rule['outbound']
+    return final
+
+
+def test_inlined_sub_rules_keep_their_place():
+    rules = [
+        Rule('DOMAIN,x.com,PROXY'),
+        sub_rule('SUB-RULE,(NETWORK,tcp),tcp-only', ['DOMAIN,a.com,REJECT', 'MATCH,DIRECT']),
+        Rule('DOMAIN-SUFFIX,y.com,PROXY'),
+        Rule('DOMAIN,z.com,DIRECT'),
+        Rule('DOMAIN,w.com,PROXY'),
+        Rule('MATCH,PROXY'),
+    ]
+    t = Clash2SingboxTransformer()
+    result = t.transform_rules(rules)
+    assert t.dropped_rules == 0
+    assert [r['outbound'] for r in result] == ['PROXY', 'REJECT', 'DIRECT', 'PROXY', 'DIRECT']
+    # first match, as clash evaluates the rules
+    expected = {
+        ('x.com', 'tcp'): 'PROXY',
+        ('a.com', 'tcp'): 'REJECT',
+        ('y.com', 'tcp'): 'DIRECT',
+        ('y.com', 'udp'): 'PROXY',
+        ('z.com', 'udp'): 'DIRECT',
+        ('w.com', 'udp'): 'PROXY',
+        ('other.com', 'udp'): 'PROXY',
+        ('a.com', 'udp'): 'PROXY',
+    }
+    for (domain, network), outbound in expected.items():
+        assert route(result, t.match_rule_target, domain, network) == outbound, (domain, network)
+
+
+def test_rules_grouped_by_target_outside_sub_rules():
+    rules = [
+        Rule('DOMAIN,a.com,PROXY'),
+        Rule('DOMAIN,b.com,DIRECT'),
+        Rule('DOMAIN-SUFFIX,c.com,PROXY'),
+    ]
+    result = Clash2SingboxTransformer().transform_rules(rules)
+    assert result == [
+        {'domain': ['a.com'], 'domain_suffix': ['c.com'], 'outbound': 'PROXY'},
+        {'domain': ['b.com'], 'outbound': 'DIRECT'},
+    ]
+
+
+def test_nested_sub_rules():
+    inner = sub_rule('SUB-RULE,(DOMAIN-SUFFIX,example.com),inner', ['DOMAIN,a.example.com,REJECT', 'MATCH,DIRECT'])
+    outer = Rule('SUB-RULE,(NETWORK,tcp),outer')
+    outer.sub_rules = [inner, Rule('MATCH,PROXY')]
+    rules = [outer, Rule('DOMAIN,a.example.com,DIRECT'), Rule('MATCH,REJECT')]
+    t = Clash2SingboxTransformer()
+    result = t.transform_rules(rules)
+    assert route(result, t.match_rule_target, 'a.example.com', 'tcp') == 'REJECT'
+    assert route(result, t.match_rule_target, 'b.example.com', 'tcp') == 'DIRECT'
+    assert route(result, t.match_rule_target, 'other.com', 'tcp') == 'PROXY'
+    assert route(result, t.match_rule_target, 'a.example.com', 'udp') == 'DIRECT'
+    assert route(result, t.match_rule_target, 'other.com', 'udp') == 'REJECT'
+
+
+def test_provider_groups():
+    proxies = [Proxy.parse({'name': n, 'type': 'ss', 'server': 'a', 'port': 1, 'cipher': 'aes-128-gcm', 'password': 'p'}) for n in ('hk1', 'jp1')]
+    only = ProxyGroup({'name': 'P', 'type': 'select', 'include-all-providers': True})
+    mixed = ProxyGroup({'name': 'H', 'type': 'select', 'include-all': True, 'include-all-providers': True, 'filter': 'hk'})
+    expand_proxy_groups(proxies, [only, mixed])
+    # the core still adds the proxies of providers
+    assert only.inner == {'name': 'P', 'type': 'select', 'include-all-providers': True, 'proxies': []}
+    assert mixed.inner['filter'] == 'hk' and mixed.inner['proxies'] == ['hk1']
+
+    t = Clash2SingboxTransformer()
+    with pytest.raises(NotImplementedError):
+        t.transform_proxy_group(only)
+    assert t.transform_proxy_group(mixed)['outbounds'] == ['hk1']
+
+
+def test_dropped_rules_recorded(monkeypatch):
+    diagnostics = Diagnostics()
+    monkeypatch.setattr(writer_singbox, 'collector', diagnostics)
+    t = Clash2SingboxTransformer()
+    t.transform_rules([Rule('GEOSITE,no-such-site,a'), Rule('MATCH,a'), Rule('MATCH,b')])
+    assert t.dropped_rules == 1
+    assert diagnostics.by_category() == {UNKNOWN_GEO_KEY: 1, UNSUPPORTED_RULE: 1}